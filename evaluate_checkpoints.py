@@ -0,0 +1,85 @@
+import argparse
+
+import torch
+
+from utils.get_dataset_mnist import get_dataset_mnist
+from utils.get_dataset_cifar10 import get_dataset_cifar10
+from utils.get_dataset_cifar100 import get_dataset_cifar100
+from utils.get_dataset_cifar100_alternative_dist import get_dataset_cifar100_alternative_dist
+from utils.save_global_results import save_global_results
+from utils.checkpoint_evaluation import find_checkpoints, evaluate_checkpoints
+
+from models.architectures.net_mnist import Net_mnist
+from models.architectures.net_cifar10 import Net_cifar10
+from models.architectures.net_cifar100 import Net_cifar100
+
+
+def main(args):
+    """
+    In this function, we test again the models saved by a run of main.py (after each task of each method) and
+    rebuild the global results of the experiment (global_results_{dataset}.xlsx) from the checkpoints alone,
+    without training.
+
+    :param args: arguments from the command line
+    :return: None
+    """
+    print("Arguments: ", args)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Get the datasets
+    if args.dataset == "mnist":
+        datasets = get_dataset_mnist(args)
+        model = Net_mnist()
+    elif args.dataset == "cifar10":
+        datasets = get_dataset_cifar10(args)
+        model = Net_cifar10()
+    elif args.dataset == "cifar100":
+        datasets = get_dataset_cifar100(args)
+        model = Net_cifar100()
+    elif args.dataset == "cifar100-alternative-dist":
+        datasets = get_dataset_cifar100_alternative_dist(args)
+        model = Net_cifar100()
+
+    # Find the checkpoints of the experiment
+    checkpoints = find_checkpoints(f'./models/models_saved/{args.exp_name}', args.dataset)
+    entries = [] # (method, number of tasks trained)
+    for method, paths in checkpoints.items():
+        if None not in paths and any(t not in paths for t in range(1, args.num_tasks + 1)):
+            print(f"Skip {method}: the checkpoints of some tasks are missing ({sorted(paths)})")
+            continue
+        entries += [(method, num_tasks) for num_tasks in sorted(paths, key=lambda t: t or 0)]
+    print(f"Testing {len(entries)} checkpoints of {len(set(m for m, _ in entries))} methods...")
+
+    state_dicts = [torch.load(checkpoints[method][num_tasks], map_location="cpu") for method, num_tasks in entries]
+    accuracy, loss = evaluate_checkpoints(model, state_dicts, datasets, device, args.eval_batch_size,
+                                          args.models_per_pass)
+
+    # Results in the format of main.py: {method: [[test accuracy of each task, average accuracy] after each task]}
+    dicc_results_test = {}
+    for (method, num_tasks), accuracy_tasks, loss_tasks in zip(entries, accuracy.tolist(), loss.tolist()):
+        name = "Joint datasets" if num_tasks is None else method
+        dicc_results_test.setdefault(name, []).append([accuracy_tasks, sum(accuracy_tasks) / len(accuracy_tasks)])
+        trained = "all the tasks (joint)" if num_tasks is None else f"task {num_tasks}"
+        print(f"{method} after {trained}: Accuracy: {[round(a, 2) for a in accuracy_tasks]}, "
+              f"Loss: {[round(l, 6) for l in loss_tasks]}")
+
+    # Save the results
+    save_global_results(dicc_results_test, args)
+    print(f"Results saved in ./results/{args.exp_name}/global_results_{args.dataset}.xlsx")
+
+
+if __name__ == '__main__':
+    argparse = argparse.ArgumentParser()
+
+    # General parameters
+    argparse.add_argument('--exp_name', type=str, default="CL_methods", help="Name of the experiment to test again.")
+    argparse.add_argument('--dataset', type=str, default="cifar100",
+                          choices=["mnist", "cifar10", "cifar100", "cifar100-alternative-dist"],
+                          help="Dataset of the experiment.")
+    argparse.add_argument('--num_tasks', type=int, default=2, help="Number of tasks in the continual learning setup.")
+    argparse.add_argument('--eval_batch_size', type=int, default=1000, help="Batch size of the test sets.")
+    argparse.add_argument('--models_per_pass', type=int, default=8,
+                          help="Maximum number of checkpoints stacked in the same forward pass.")
+
+    # Run the main function
+    main(argparse.parse_args())
@@ -8,10 +8,12 @@ from utils.get_dataset_cifar10 import get_dataset_cifar10
 from utils.get_dataset_cifar100 import get_dataset_cifar100
 from utils.get_dataset_cifar100_alternative_dist import get_dataset_cifar100_alternative_dist
 from utils.save_global_results import save_global_results
+from utils.evaluation import baseline_accuracy
 
 from methods.naive_training import naive_training
-from methods.rehearsal_training import rehearsal_training
+from methods.rehearsal_training import rehearsal_training, rehearsal_buffer_training
 from methods.ewc import ewc_training
+from methods.si import si_training
 from methods.lwf import lwf_training
 from methods.bimeco import bimeco_training
 from methods.lwf_with_bimeco import lwf_with_bimeco
@@ -78,9 +80,14 @@ def main(args):
     dicc_results_test["Rehearsal 10%"] = rehearsal_training(datasets, args, rehearsal_prop=0.1, random_rehearsal=True)
     dicc_results_test["Rehearsal 30%"] = rehearsal_training(datasets, args, rehearsal_prop=0.3, random_rehearsal=True)
     dicc_results_test["Rehearsal 50%"] = rehearsal_training(datasets, args, rehearsal_prop=0.5, random_rehearsal=True)
+    dicc_results_test["Rehearsal buffer"] = rehearsal_buffer_training(datasets, args)
 
     # # Train the model using the EWC approach
     dicc_results_test["EWC"] = ewc_training(datasets, args)
+    dicc_results_test["EWC KFAC"] = ewc_training(datasets, args, kfac=True)
+
+    # Train the model using the SI approach
+    dicc_results_test["SI"] = si_training(datasets, args)
 
     # Train the model using the LwF approach
     dicc_results_test["LwF"] = lwf_training(datasets, args)
@@ -97,8 +104,10 @@ def main(args):
     dicc_results_test["LwF AuxNet + BiMeCo"] = lwf_with_bimeco(datasets, args, aux_training=True)
     dicc_results_test["LwF AuxNet lossANCL + BiMeCo "] = lwf_with_bimeco(datasets, args, aux_training=True, loss_ANCL=True)
 
-    # Save the results
-    save_global_results(dicc_results_test, args)
+    # Save the results (each method returns its test accuracies and the costs of its tasks)
+    costs = {method: costs_method for method, (_, costs_method) in dicc_results_test.items()}
+    dicc_results_test = {method: test_acc for method, (test_acc, _) in dicc_results_test.items()}
+    save_global_results(dicc_results_test, args, baseline=baseline_accuracy(datasets), costs=costs)
 
     # Create the .txt file and save the arguments
     with open(f'./results/{args.exp_name}/args_{args.exp_name}_{args.dataset}.txt', 'w') as f:
@@ -118,6 +127,14 @@ if __name__ == '__main__':
     argparse.add_argument('--lr_patience', type=int, default=10, help="Number of epochs to wait before reducing the learning rate.")
     argparse.add_argument('--lr_min', type=float, default=1e-8, help="Minimum learning rate threshold.")
     argparse.add_argument('--batch_size', type=int, default=200, help="Batch size for training.")
+    argparse.add_argument('--eval_batch_size', type=int, default=1000, help="Batch size for validation and test (no activations are kept for the backward pass).")
+    argparse.add_argument('--eval_every', type=int, default=1, help="Number of epochs between tests of the model during the training of a task.")
+    argparse.add_argument('--eval_subset', type=int, default=0, help="Number of test samples per class used in the tests during training (0: full test sets).")
+    argparse.add_argument('--eval_tolerance', type=float, default=0, help="Maximum width (accuracy points, %%) of the confidence interval of the approximate tests during training (0: exact tests).")
+    argparse.add_argument('--eval_confidence', type=float, default=0.95, help="Confidence level of the interval of the approximate tests.")
+    argparse.add_argument('--time_to_accuracy', type=float, default=0.9, help="Fraction of the accuracy of the best model of a task used for the time to accuracy of the task.")
+    argparse.add_argument('--time_phases', action='store_true', help="Time the phases of each method (training, data loading, tests, Fisher, teacher, herding, checkpoints, Excel files).")
+    argparse.add_argument('--eval_async', action='store_true', help="Run the tests during training in a background thread, on snapshots of the weights.")
     argparse.add_argument('--num_tasks', type=int, default=2, help="Number of tasks in the continual learning setup.")
 
     # Dataset parameters: mnist, cifar10, cifar100, cifar100-alternative-dist
@@ -128,11 +145,19 @@ if __name__ == '__main__':
     argparse.add_argument('--ewc_lambda' , type=float, default=100000,
                         help="Regularization parameter for Elastic Weight Consolidation (EWC).")
 
+    # SI parameters
+    argparse.add_argument('--si_c' , type=float, default=0.1,
+                        help="Regularization parameter for Synaptic Intelligence (SI).")
+    argparse.add_argument('--si_epsilon' , type=float, default=1e-3,
+                        help="Damping parameter of the importance in Synaptic Intelligence (SI).")
+
     # Distillation parameters (LwF)
     argparse.add_argument('--lwf_lambda' , type=float, default=0.8,
                         help="Hyperparameter controlling the importance of distillation loss in Learning without Forgetting (LwF).")
     argparse.add_argument('--lwf_aux_lambda' , type=float, default=0.75,
                         help="Hyperparameter controlling the importance of auxiliary distillation loss in LwF.")
+    argparse.add_argument('--teacher_cache' , type=str, default="float32", choices=["off", "float32", "float16"],
+                        help="Storage of the cached logits of the frozen teachers in LwF (off to run the teachers every batch).")
 
     # BiMeCo parameters
     argparse.add_argument('--memory_size' , type=int, default=22500,
@@ -145,6 +170,26 @@ if __name__ == '__main__':
                         help="Regularization parameter controlling the difference between short-term and long-term networks in BiMeCo.")
     argparse.add_argument('--m' , type=float, default=0.15,
                         help="Momentum parameter for updating the model weights.")
+    argparse.add_argument('--bimeco_ema_every' , type=int, default=0,
+                        help="Number of training steps between updates of the long-term network in BiMeCo (0: once per epoch).")
+    argparse.add_argument('--bimeco_ema_buffers' , action='store_true',
+                        help="Also update the buffers (e.g. BatchNorm statistics) of the long-term network in BiMeCo.")
+    argparse.add_argument('--bimeco_vmap' , action='store_true',
+                        help="Train the short-term and long-term networks of BiMeCo together with torch.func.vmap (models without BatchNorm).")
+    argparse.add_argument('--replay_replacement' , action='store_true',
+                        help="Draw the exemplars replayed in BiMeCo and LwF with memory buffer with replacement.")
+    argparse.add_argument('--replay_class_balanced' , action='store_true',
+                        help="Draw the exemplars replayed in BiMeCo and LwF with memory buffer with the same probability for each class.")
+    argparse.add_argument('--replay_fraction' , type=float, default=0.5,
+                        help="Fraction of each batch replayed from the buffer of memory_size samples in rehearsal with a buffer.")
+    argparse.add_argument('--exemplar_codec' , type=str, default="float32", choices=["float32", "uint8", "int4", "pca"],
+                        help="Storage of the exemplars of BiMeCo, LwF with memory buffer and rehearsal with a buffer.")
+    argparse.add_argument('--exemplar_pca_rank' , type=int, default=32,
+                        help="Number of principal components of each class stored per exemplar with the pca codec.")
+    argparse.add_argument('--memory_bytes' , type=int, default=0,
+                        help="Size in bytes of the memory of exemplars, instead of memory_size (0: use memory_size).")
+    argparse.add_argument('--herding_cache' , type=str, default="on", choices=["off", "on"],
+                        help="Save the herding ranking of each class and reuse it for any memory size (off to only select memory_size exemplars).")
 
     # Run the main function
     main(argparse.parse_args())
@@ -0,0 +1,135 @@
+import os
+import copy
+import hashlib
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from utils.utils import state_dict_hash, dataset_hash
+from utils.metrics import Metrics
+from utils.timers import timer
+
+# Path of the trained auxiliary networks. It is outside the folder of the experiment (which is removed at the
+# start of each run), so they are reused across runs
+PATH_AUX_CACHE = "./models/models_saved/AuxNetwork_cache"
+
+
+@timer.timed("auxiliary network")
+def auxiliary_network_training(model_best, train_dataset, val_dataset, args, device, id_task, method_print):
+    """
+    Train the auxiliary network of LwF/ANCL on the current task: a copy of the model after the previous task
+    trained with cross entropy and early stopping.
+
+    The auxiliary network only depends on the starting checkpoint, the data of the task and the training
+    hyperparameters, so all the variants (LwF, LwF + BiMeCo, LwF + Memory Buffer, with or without the loss of
+    ANCL) would train the same network. It is trained once with its own random generator, seeded with
+    args.seed, and saved with the hash of its inputs (checkpoint, data, hyperparameters and type of device) as name;
+    the next calls load it.
+
+    :param model_best: model after the previous task (starting checkpoint)
+    :param train_dataset: training dataset of the current task
+    :param val_dataset: validation dataset of the current task
+    :param args: arguments from the command line
+    :param device: device of the model
+    :param id_task: id of the current task
+    :param method_print: name of the method, for the logs
+    :return: auxiliary network, frozen and in eval mode
+    """
+    # Everything that changes the training or the selection of the best epoch (the validation batches change the
+    # validation loss, and the kernels of the device change the numerics)
+    hyperparameters = [args.seed, args.epochs, args.lr, args.lr_decay, args.lr_patience, args.lr_min, args.batch_size,
+                       args.eval_batch_size, torch.device(device).type]
+    key = hashlib.sha1("-".join([state_dict_hash(model_best), dataset_hash(train_dataset), dataset_hash(val_dataset),
+                                 *[str(h) for h in hyperparameters]]).encode()).hexdigest()
+    path_file = f"{PATH_AUX_CACHE}/AuxNetwork-{args.dataset}-{key}.pt"
+
+    auxiliary_network = copy.deepcopy(model_best).to(device)
+
+    if os.path.exists(path_file):
+        print(f"Load the auxiliary network of task {id_task+1} ({path_file})")
+        auxiliary_network.load_state_dict(torch.load(path_file, map_location=device))
+    else:
+        # Own random generator, so the result only depends on the key and the caller's generator is not consumed
+        devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(args.seed)
+            train_auxiliary_network(auxiliary_network, train_dataset, val_dataset, args, device, id_task, method_print)
+
+        os.makedirs(PATH_AUX_CACHE, exist_ok=True)
+        torch.save(auxiliary_network.state_dict(), path_file)
+
+    auxiliary_network.eval()
+    for param in auxiliary_network.parameters():
+        param.requires_grad = False
+
+    return auxiliary_network
+
+
+def train_auxiliary_network(auxiliary_network, train_dataset, val_dataset, args, device, id_task, method_print):
+    # Make the dataloader
+    train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                               batch_size=args.batch_size,
+                                               shuffle=True)
+    val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
+                                             batch_size=args.eval_batch_size,
+                                             shuffle=False)
+
+    patience_aux = args.lr_patience # Patience for early stopping
+    lr_aux = args.lr # Learning rate
+    best_val_loss_aux = 1e20 # Validation loss of the previous epoch
+    model_best_aux = copy.deepcopy(auxiliary_network) # Save the best model so far
+    optimizer_aux = optim.Adam(auxiliary_network.parameters(), lr=args.lr)  # Instantiate the optimizer
+
+    for epoch in range(args.epochs):
+        print("="*100)
+        print("Train the auxiliary network...")
+        print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
+
+        # Training
+        auxiliary_network.train()
+        metrics = Metrics() # Losses of the epoch, summed on the device
+        for input, target in timer.loader(train_loader):
+            input, target = input.to(device), target.to(device)
+            optimizer_aux.zero_grad()
+            loss = F.cross_entropy(auxiliary_network(input), target)
+            metrics.add("train", loss)
+            loss.backward()
+            optimizer_aux.step()
+        print(f"Train loss: {metrics.mean('train')}")
+
+        # Validation
+        auxiliary_network.eval()
+        with torch.inference_mode():
+            for input, target in val_loader:
+                input, target = input.to(device), target.to(device)
+                metrics.add("val", F.cross_entropy(auxiliary_network(input), target))
+        val_loss_epoch_aux = metrics.mean("val")
+        print(f"Val loss: {val_loss_epoch_aux}")
+
+        # Early stopping
+        if val_loss_epoch_aux < best_val_loss_aux:
+            best_val_loss_aux = val_loss_epoch_aux
+            patience_aux = args.lr_patience
+            model_best_aux = copy.deepcopy(auxiliary_network)
+        else:
+            # if the loss does not go down, decrease patience
+            patience_aux -= 1
+            if patience_aux <= 0:
+                # if it runs out of patience, reduce the learning rate
+                lr_aux /= args.lr_decay
+                print(' lr={:.1e}'.format(lr_aux), end='')
+                if lr_aux < args.lr_min:
+                    # if the lr decreases below minimum, stop the training session
+                    print()
+                    break
+                # reset patience and recover best model so far to continue training
+                patience_aux = args.lr_patience
+                for param_group in optimizer_aux.param_groups:
+                    param_group['lr'] = lr_aux
+                auxiliary_network.load_state_dict(model_best_aux.state_dict())
+
+        print(f"Current learning rate: {optimizer_aux.param_groups[0]['lr']}, Patience: {patience_aux}")
+
+    # Keep the best auxiliary network
+    auxiliary_network.load_state_dict(model_best_aux.state_dict())
@@ -1,15 +1,24 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
 import xlsxwriter
 import sys
 import copy
-import numpy as np
 
 sys.path.append('../')
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler, eval_batches
+from utils.metrics import Metrics
+from utils.ema import EMA
+from utils.replay_sampler import ReplaySampler, MixedBatch
+from utils.herding import herding_ranking
+from utils.exemplar_memory import ExemplarMemory
+from utils.exemplar_codecs import make_codec, memory_capacity
+from utils.stacked_models import StackedModels
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
 from models.architectures.net_cifar100 import Net_cifar100
@@ -24,11 +33,10 @@ def bimeco_training(datasets, args):
     path_file = f'./results/{args.exp_name}/BiMeCo_{args.dataset}.xlsx'
     workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
     test_acc_final = []  # List to save the average accuracy of each task
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed)  # Set the seed
 
-    exemplar_set_img = []  # List to save the exemplar set
-    exemplar_set_label = []  # List to save the exemplar set labels
     
     # Create the excel file
     if args.dataset == "mnist":
@@ -50,9 +58,20 @@ def bimeco_training(datasets, args):
         img_channels = 3
         feature_dim = 2048 # 1024
         
+    # Memory to save the exemplar set (images and labels)
+    codec = make_codec(args, (img_channels, img_size, img_size), num_classes) # Storage of the exemplars
+    exemplar_memory = ExemplarMemory(memory_capacity(args, codec, num_classes), (img_channels, img_size, img_size), 
+                                     codec=codec)
+    print(f"Exemplar memory: {exemplar_memory.capacity} exemplars ({args.exemplar_codec}, "
+          f"{exemplar_memory.nbytes() / 2**20:.1f} MB of codes and labels)")
+
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, device, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
         
@@ -74,12 +93,13 @@ def bimeco_training(datasets, args):
                                                 batch_size=args.batch_size,
                                                 shuffle=True)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                                batch_size=args.batch_size,
-                                                shuffle=True)
+                                                batch_size=args.eval_batch_size,
+                                                shuffle=False)
         
         if id_task == 0:
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: BiMeCo (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
@@ -89,8 +109,10 @@ def bimeco_training(datasets, args):
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -112,7 +134,6 @@ def bimeco_training(datasets, args):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -122,10 +143,6 @@ def bimeco_training(datasets, args):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
-
         else:
 
             # Prepare the old model
@@ -146,96 +163,94 @@ def bimeco_training(datasets, args):
             model_long = copy.deepcopy(model)
             model_long.load_state_dict(torch.load(path_model))
 
-            # Create an optimizer for the short term memory model
-            optimizer_short = optim.Adam(model_short.parameters(), lr=args.lr)  # Instantiate the optimizer
-            optimizer_long = optim.Adam(model_long.parameters(), lr=args.lr)  # Instantiate the optimizer
+            # Train the two models together with vmap (only without BatchNorm, whose statistics depend on the batch)
+            stacked = None
+            if args.bimeco_vmap:
+                if any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in model.modules()):
+                    print("The model has BatchNorm layers: the short and long term memory models are trained separately")
+                else:
+                    stacked = StackedModels([model_short, model_long]) # The models become views of the stacked weights
+
+            if stacked is not None:
+                # Adam is elementwise, so a single optimizer of the stacked parameters is equivalent to one per model
+                optimizer_stacked = optim.Adam(stacked.parameters(), lr=args.lr)  # Instantiate the optimizer
+            else:
+                # Create an optimizer for the short term memory model
+                optimizer_short = optim.Adam(model_short.parameters(), lr=args.lr)  # Instantiate the optimizer
+                optimizer_long = optim.Adam(model_long.parameters(), lr=args.lr)  # Instantiate the optimizer
+
+            # The long term memory model is an exponential moving average of the short term memory model
+            ema_long = EMA(model_long, model_short, args.m, update_every=args.bimeco_ema_every, 
+                           include_buffers=args.bimeco_ema_buffers)
 
             # Compute the ratio of current task samples to previous task samples
             ratio = len(tasks_dict[id_task]) / (len(tasks_dict[id_task]) + sum([len(tasks_dict[i]) for i in range(id_task)])) 
             
             train_dataloader_s = train_loader
-            train_dataloader_l = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                                # batch_size=args.batch_size,
-                                                                batch_size=int(ratio*args.batch_size), # Same ratio as the paper
-                                                                shuffle=True)
 
-            data_loader_exem_iter = iter(data_loader_exem)
-            train_dataloader_l_iter = iter(train_dataloader_l)
+            # Samplers of the exemplars and of the current task (batches of the long term memory model), on the device
+            sampler_exem = ReplaySampler([tensor_exem_img, tensor_exem_label], device, replacement=args.replay_replacement,
+                                         class_balanced=args.replay_class_balanced, codec=exemplar_memory.codec)
+            sampler_l = ReplaySampler(train_dataset.tensors, device)
+            batch_s, batch_l = MixedBatch(device), MixedBatch(device) # Preallocated buffers of the mixed batches
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: BiMeCo (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
-                train_loss_epoch = 0
-                total_epoch_loss_short, total_epoch_loss_long = 0, 0
-                total_output_short, total_output_long = 0, 0
-                total_diff_images_l, total_diff_images_s = 0, 0
+                metrics = Metrics() # Losses of the epoch, summed on the device
                 
                 # Sample a batch of data from train_dataloader_s
-                for images_s, labels_s in train_dataloader_s:
-
-                    # Sample two different batches from data_loader_exem
-                    try:
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-                        images_exem_2, labels_exem_2 = next(data_loader_exem_iter)
-                    except StopIteration:
-                        data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                                    batch_size=args.batch_size,
-                                                                    shuffle=True)
-                        data_loader_exem_iter = iter(data_loader_exem)
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-                        images_exem_2, labels_exem_2 = next(data_loader_exem_iter)
-
-                    # Concatenate the images and labels of the first batch from data_loader_exem
-                    images_s = torch.cat((images_s, images_exem_1), dim=0).to(device)
-                    labels_s = torch.cat((labels_s, labels_exem_1), dim=0).to(device)
-
-                    # Randomly sample ratio * batch_size samples from train_dataloader_l
-                    try:
-                        images_l, labels_l = next(train_dataloader_l_iter)
-                    except StopIteration:
-                        train_dataloader_l = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                                        #  batch_size=args.batch_size,
-                                                                        batch_size=int(ratio*args.batch_size), # Same ratio as the paper
-                                                                        shuffle=True)
-                        train_dataloader_l_iter = iter(train_dataloader_l)
-                        images_l, labels_l = next(train_dataloader_l_iter)
-
-                    # Concatenate the images and labels of the second batch from data_loader_exem
-                    images_l = torch.cat((images_l, images_exem_2), dim=0).to(device)
-                    labels_l = torch.cat((labels_l, labels_exem_2), dim=0).to(device)
+                for images_s, labels_s in timer.loader(train_dataloader_s):
+
+                    # Concatenate the images and labels with a batch of exemplars
+                    images_s, labels_s = batch_s.fill([images_s, labels_s], (sampler_exem, args.batch_size))
+
+                    # Randomly sample ratio * batch_size samples of the current task and a second (different) batch of exemplars
+                    images_l, labels_l = batch_l.fill(None, (sampler_l, int(ratio*args.batch_size)), 
+                                                      (sampler_exem, args.batch_size))
 
                     # Forward pass
-                    epoch_loss_short, epoch_loss_long, output_short, output_long, diff_images_l, diff_images_s = (
+                    if stacked is not None:
+                        epoch_loss_short, epoch_loss_long, output_short, output_long, diff_images_l, diff_images_s = (
+                                                                    bimeco_train_stacked(stacked, optimizer_stacked, 
+                                                                     images_s, labels_s, images_l, labels_l, args)
+                                                                     )
+                    else:
+                        epoch_loss_short, epoch_loss_long, output_short, output_long, diff_images_l, diff_images_s = (
                                                                     bimeco_train(model_short, model_long, optimizer_short, optimizer_long, 
                                                                      images_s, labels_s, images_l, labels_l, args)
                                                                      )
-                    total_epoch_loss_short += epoch_loss_short
-                    total_epoch_loss_long += epoch_loss_long
-                    total_output_short += output_short
-                    total_output_long += output_long
-                    total_diff_images_l += diff_images_l
-                    total_diff_images_s += diff_images_s
-
+                    ema_long.step() # Update the long term memory model (if it is updated every N steps)
+                    metrics.add("loss short", epoch_loss_short)
+                    metrics.add("loss long", epoch_loss_long)
+                    metrics.add("output short", output_short)
+                    metrics.add("output long", output_long)
+                    metrics.add("diff images l", diff_images_l)
+                    metrics.add("diff images s", diff_images_s)
+
+                totals = metrics.sums() # Single copy from the device
                 # train_loss_epoch = epoch_loss_short + epoch_loss_long
-                train_loss_epoch = total_epoch_loss_long
-                print(f"Train loss: {total_epoch_loss_long}")
-                print(f"Train loss output short: {total_output_short * args.bimeco_lambda_short}")
-                print(f"Train loss output long: {total_output_long * args.bimeco_lambda_long}")
-                print(f"Train loss diff images s: {total_diff_images_s}")
-                print(f"Train loss diff images l: {total_diff_images_l}")
-                print(f"Sum diff images: {(total_diff_images_l + total_diff_images_s)*args.bimeco_lambda_diff}")
-
-                # Update the parameters of the long term memory model
-                for param_l, param_s in zip(model_long.parameters() ,  model_short.parameters()):
-                    param_l.data = args.m * param_l.data + (1 - args.m) * param_s.data
+                train_loss_epoch = totals["loss long"]
+                print(f"Train loss: {totals['loss long']}")
+                print(f"Train loss output short: {totals['output short'] * args.bimeco_lambda_short}")
+                print(f"Train loss output long: {totals['output long'] * args.bimeco_lambda_long}")
+                print(f"Train loss diff images s: {totals['diff images s']}")
+                print(f"Train loss diff images l: {totals['diff images l']}")
+                print(f"Sum diff images: {(totals['diff images l'] + totals['diff images s'])*args.bimeco_lambda_diff}")
+
+                # Update the parameters of the long term memory model (if it is updated once per epoch)
+                ema_long.epoch_end()
 
                 # Validation
                 # val_loss_epoch = normal_val(model_long, val_loader, device)
                 val_loss_epoch = bimeco_val(model_short, model_long, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model_long, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model_long,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch,
@@ -258,7 +273,6 @@ def bimeco_training(datasets, args):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -268,9 +282,12 @@ def bimeco_training(datasets, args):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, device, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
 
         # Save the results of the training
         save_training_results(dicc_results, workbook, id_task+1, training_name="BiMeCo")
@@ -280,42 +297,55 @@ def bimeco_training(datasets, args):
 
         # Update memory buffer
         if id_task != args.num_tasks-1:
-            exemplar_set_img, exemplar_set_label, tasks_dict  = after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, 
+            exemplar_memory, tasks_dict = after_train(model, exemplar_memory, train_dataset, 
                                                             device, id_task, args, img_channels, img_size, feature_dim, num_classes)
 
-            tensor_exem_img = torch.empty((0, img_channels, img_size, img_size)) # Tensor to save the exemplar set
-            tensor_exem_label = torch.empty((0), dtype=torch.long) # Tensor to save the exemplar set labels
-
-            for index in range(len(exemplar_set_img)):
-                tensor_exem_img = torch.cat((tensor_exem_img, torch.stack(exemplar_set_img[index])), dim=0) # Add the exemplar set to the tensor
-                tensor_exem_label = torch.cat((tensor_exem_label, torch.stack(exemplar_set_label[index])), dim=0) # Add the exemplar set labels to the tensor
-
-            # Make the dataloader
-            data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                           batch_size=args.batch_size,
-                                                           shuffle=True)
+            tensor_exem_img, tensor_exem_label = exemplar_memory.tensors() # Exemplar set (views of the memory)
         
 
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
     workbook.close()  # Close the excel file
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
 
 
+@timer.timed("train")
 def normal_train(model, optimizer, data_loader, device):
     model.train()
-    epoch_loss = 0
-    for input, target in data_loader:
+    metrics = Metrics()
+    for input, target in timer.loader(data_loader):
         input, target = input.to(device), target.to(device)
         optimizer.zero_grad()
         output = model(input)
         loss = F.cross_entropy(output, target)
-        epoch_loss += loss.item()
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    epoch_loss = metrics.mean("loss")
+    print(f"Train loss: {epoch_loss}")
+    return epoch_loss
 
+def forward_batches(model, *batches):
+    """
+    Get the outputs and the pooled features of a model for several batches of images.
+
+    If the model has no BatchNorm layers, all the batches go through the network in a single pass. Otherwise, each
+    batch has its own pass, so the batch statistics are computed per batch as with separate calls.
+
+    :param model: model with forward_with_features
+    :param batches: batches of images
+    :return: list with (outputs, features) for each batch
+    """
+    if any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in model.modules()):
+        return [model.forward_with_features(images) for images in batches]
+
+    outputs, features = model.forward_with_features(torch.cat(batches, dim=0))
+    sizes = [images.size(0) for images in batches]
+    return list(zip(outputs.split(sizes), features.split(sizes)))
+
+@timer.timed("train")
 def bimeco_train(model_short, model_long, optimizer_short, optimizer_long, images_s, labels_s, images_l, labels_l, args):
 
     model_short.train()
@@ -325,66 +355,112 @@ def bimeco_train(model_short, model_long, optimizer_short, optimizer_long, image
     optimizer_short.zero_grad()
     optimizer_long.zero_grad()
 
-    # Get the outputs of the models
-    output_short = model_short(images_s) 
-    output_long = model_long(images_l)
+    # Get the outputs and the features of the models (one pass of the feature extractor per batch)
+    (output_short, feat_ext_short_model_images_s), (_, feat_ext_short_model_images_l) = forward_batches(model_short, 
+                                                                                                       images_s, images_l)
+    (output_long, feat_ext_long_model_images_l), (_, feat_ext_long_model_images_s) = forward_batches(model_long, 
+                                                                                                    images_l, images_s)
+
+    loss, results = bimeco_loss(output_short, output_long, feat_ext_short_model_images_s, feat_ext_short_model_images_l,
+                                feat_ext_long_model_images_s, feat_ext_long_model_images_l, labels_s, labels_l, args)
+
+    loss.backward() # Backward pass
+
+    optimizer_short.step() # Update the parameters of the short term memory model
+    optimizer_long.step() # Update the parameters of the long term memory model
+
+    return results
+
+@timer.timed("train")
+def bimeco_train_stacked(stacked, optimizer, images_s, labels_s, images_l, labels_l, args):
+    """
+    Same training step as bimeco_train, with the short and long term memory models stacked (StackedModels) and
+    evaluated in a single vectorized call on the images of both batches.
+    """
+    stacked.models[0].train()
+    stacked.models[1].train()
+
+    optimizer.zero_grad()
+
+    # Outputs and features of both models for the images of both batches: (2, len(images_s) + len(images_l), ...)
+    outputs, features = stacked.forward_with_features(torch.cat((images_s, images_l), dim=0))
+    size_s = images_s.size(0)
+
+    loss, results = bimeco_loss(outputs[0, :size_s], outputs[1, size_s:], features[0, :size_s], features[0, size_s:],
+                                features[1, :size_s], features[1, size_s:], labels_s, labels_l, args)
+
+    loss.backward() # Backward pass
+
+    optimizer.step() # Update the parameters of both models
+
+    return results
 
+def bimeco_loss(output_short, output_long, feat_ext_short_model_images_s, feat_ext_short_model_images_l,
+                feat_ext_long_model_images_s, feat_ext_long_model_images_l, labels_s, labels_l, args):
+    """
+    Loss of BiMeCo: cross entropy of both models and difference between their normalized features.
+
+    :return: loss and the values to log, detached tensors (loss, loss, output short, output long, diff images s,
+             diff images l)
+    """
     # Compute the difference between the feature extractor outputs
-    feat_ext_short_model_images_s = F.normalize(model_short.feature_extractor(images_s))
-    feat_ext_long_model_images_s = F.normalize(model_long.feature_extractor(images_s))
+    feat_ext_short_model_images_s = F.normalize(feat_ext_short_model_images_s)
+    feat_ext_long_model_images_s = F.normalize(feat_ext_long_model_images_s)
     diff_images_s = ((feat_ext_long_model_images_s -feat_ext_short_model_images_s)**2).sum()
 
-    feat_ext_short_model_images_l = F.normalize(model_short.feature_extractor(images_l))
-    feat_ext_long_model_images_l = F.normalize(model_long.feature_extractor(images_l))
+    feat_ext_short_model_images_l = F.normalize(feat_ext_short_model_images_l)
+    feat_ext_long_model_images_l = F.normalize(feat_ext_long_model_images_l)
     diff_images_l = ((feat_ext_long_model_images_l - feat_ext_short_model_images_l)**2).sum()
 
     diff = 0.5 * (diff_images_l + diff_images_s)
 
     # Compute the loss
-    loss = (args.bimeco_lambda_short * F.cross_entropy(output_short, labels_s) +
-            args.bimeco_lambda_long * F.cross_entropy(output_long, labels_l) +
+    loss_short = F.cross_entropy(output_short, labels_s)
+    loss_long = F.cross_entropy(output_long, labels_l)
+    loss = (args.bimeco_lambda_short * loss_short +
+            args.bimeco_lambda_long * loss_long +
             args.bimeco_lambda_diff * diff)
     
-    epoch_loss_short = loss.item()
-    epoch_loss_long = loss.item()
-    output_short = F.cross_entropy(output_short, labels_s).item() * args.bimeco_lambda_short
-    output_long = F.cross_entropy(output_long, labels_l).item() * args.bimeco_lambda_long
-    loss_diff_images_s = diff_images_s.item() 
-    loss_diff_images_l = diff_images_l.item()
-    
-    loss.backward() # Backward pass
+    # Values to log, kept on the device (summed with utils.metrics)
+    epoch_loss_short = loss.detach()
+    epoch_loss_long = loss.detach()
+    output_short = loss_short.detach() * args.bimeco_lambda_short
+    output_long = loss_long.detach() * args.bimeco_lambda_long
+    loss_diff_images_s = diff_images_s.detach() 
+    loss_diff_images_l = diff_images_l.detach()
 
-    optimizer_short.step() # Update the parameters of the short term memory model
-    optimizer_long.step() # Update the parameters of the long term memory model
-
-    return epoch_loss_short, epoch_loss_long, output_short, output_long, loss_diff_images_s, loss_diff_images_l
+    return loss, (epoch_loss_short, epoch_loss_long, output_short, output_long, loss_diff_images_s, loss_diff_images_l)
 
+@timer.timed("validation")
 def bimeco_val(model_short, model_long, data_loader, device):
     model_long.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = input.to(device), target.to(device)
 
             output_long = model_long(input)
 
-            loss += F.cross_entropy(output_long, target)
+            metrics.add("loss", F.cross_entropy(output_long, target))
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
+@timer.timed("validation")
 def normal_val(model, data_loader, device):
     model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = input.to(device), target.to(device)
             output = model(input)
-            loss += F.cross_entropy(output, target)
+            metrics.add("loss", F.cross_entropy(output, target))
 
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
 def test(model, datasets, device, args):
     # Test
@@ -395,30 +471,32 @@ def test(model, datasets, device, args):
     test_task_list = []  # List to save the results of the task
     test_loss_list = []  # List to save the test loss
     test_acc_list = []  # List to save the test accuracy
+    test_confusion_list = []  # List to save the confusion matrices
 
     for id_task_test, task in enumerate(datasets):
-        test_loss, correct, accuracy = 0, 0, 0
+        metrics = Metrics() # Test loss and correct predictions, summed on the device
 
         _, _, test_dataset = task  # Get the images and labels from the task
 
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                  batch_size=args.batch_size,
-                                                  shuffle=False)
-        with torch.no_grad():
-            for input, target in test_loader:
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
+        with torch.inference_mode():
+            for input, target in test_batches:
                 input, target = input.to(device), target.to(device)
                 output = model(input)
-                test_loss += F.cross_entropy(output, target, reduction="sum").item()
-                correct += (F.softmax(output, dim=1).max(dim=1)[1] == target).sum().item()
+                metrics.add("loss", F.cross_entropy(output, target, reduction="sum"), target.size(0))
+                metrics.add_correct("accuracy", output, target)
+                metrics.add_confusion("confusion", output, target)
 
-        test_loss /= len(test_loader.dataset)
+        means = metrics.means() # Single copy from the device
+        test_loss = means["loss"]
 
-        accuracy = 100. * correct / len(test_loader.dataset)
+        accuracy = 100. * means["accuracy"]
         avg_acc += accuracy
 
         test_task_list.append(id_task_test+1)
         test_loss_list.append(test_loss)
         test_acc_list.append(accuracy)
+        test_confusion_list.append(means["confusion"])
 
         print(f"Test on task {id_task_test+1}: Average loss: {test_loss:.6f}, "
               f"Accuracy: {accuracy:.2f}%")
@@ -426,7 +504,7 @@ def test(model, datasets, device, args):
     avg_acc /= len(datasets)
     print(f"Average accuracy: {avg_acc:.2f}%")
 
-    return test_task_list, test_loss_list, test_acc_list, avg_acc
+    return test_task_list, test_loss_list, test_acc_list, avg_acc, test_confusion_list
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
                    test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
@@ -443,7 +521,8 @@ def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoc
 
     return dicc_results 
 
-def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, device, id_task, args,
+@timer.timed("after_train")
+def after_train(model, exemplar_memory, train_dataset, device, id_task, args,
                 img_channels, img_size, feature_dim, num_classes):
     """
     Construct exemplar sets for each task using the iCaRL strategy.
@@ -454,12 +533,11 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
 
     model.eval() # Set the model to evaluation mode
 
-    m = int(args.memory_size / num_classes)  # Number of exemplars per class
+    m = int(exemplar_memory.capacity / num_classes)  # Number of exemplars per class
 
     # Reduce exemplar set to the maximum size
-    exemplar_set_img = [cls[:m] for cls in exemplar_set_img]
-    exemplar_set_label = [cls[:m] for cls in exemplar_set_label]
-    print(f"Size of class {index} exemplar: {len(exemplar_set_img[index])}" for index in range(len(exemplar_set_img)))
+    exemplar_memory.reduce(m)
+    print(f"Size of the exemplar set after the reduction: {len(exemplar_memory)}")
 
     if args.dataset == "cifar100-alternative-dist":
         # Create the tasks dictionary to know the classes of each task
@@ -476,69 +554,17 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
     classes_task = [cls for cls in tasks_dict[id_task]]
     print(f"Creating the exemplar set for classes: {classes_task}")
 
-    # Create the exemplar set
-    images_ex = torch.empty((0, img_channels, img_size, img_size))
-    labels_ex = torch.empty((0), dtype=torch.long)
-
-    # Assuming train_dataset is a list of tuples (image, label)
-    train_images, train_labels = zip(*train_dataset)
-    train_images = torch.stack(train_images)
-    train_labels = torch.stack(train_labels)
+    # Select the exemplars of the classes of the current task (slices of the cached herding rankings)
+    train_images, train_labels = train_dataset.tensors
+    selection = herding_ranking(model, train_images, train_labels, classes_task, m, device, args)
 
     for class_index in classes_task:
-        selected_indexes = torch.where(train_labels == class_index)[0]
-        images_ex = torch.cat((images_ex, train_images[selected_indexes]), dim=0)
-        labels_ex = torch.cat((labels_ex, train_labels[selected_indexes]), dim=0)
-
-        # Construct the exemplar set
-        feature_extractor_output = F.normalize(model.feature_extractor(images_ex.to(device))).cpu().detach().numpy()
-        # print(f"Feature extractor output shape: {feature_extractor_output.shape}")
-        class_mean = np.mean(feature_extractor_output, axis=0)
-        # print(f"Class mean shape: {class_mean.shape}")
-
-
-        exemplar_img = [] # List to save the exemplar set
-        exemplar_label = [] # List to save the exemplar set labels
-        now_class_mean = np.zeros((1, feature_dim)) # Current class mean
-        # print(f"Now class mean shape: {now_class_mean.shape}")
-
-        selected_indexes = set() # Set to save the selected indexes
-
-        # Construct the exemplar set
-        for k in range(m):
-            exit = False
-            x = class_mean - (feature_extractor_output + now_class_mean) / (k + 1) # Equation 4
-            x = np.linalg.norm(x, axis=1)
-
-            index = np.argmin(x) # Equation 5  
-
-            if index in selected_indexes:
-                while index in selected_indexes:
-                    if len(x) == len(selected_indexes):
-                        print(f"All the images have been selected for class {class_index}")
-                        exit = True
-                        break
-                    x[index] = np.inf
-                    index = np.argmin(x)
-                selected_indexes.add(index)
-            
-            if exit:
-                break
-
-            now_class_mean += feature_extractor_output[index] # Update the current class mean
-            exemplar_img.append(images_ex[index]) # Add the exemplar to the exemplar set
-            exemplar_label.append(labels_ex[index]) # Add the exemplar label to the exemplar set labels
-            selected_indexes.add(index) # Add the index to the set
-
-        exemplar_set_img.append(exemplar_img) # Add the exemplar set to the exemplar set list
-        exemplar_set_label.append(exemplar_label) # Add the exemplar set labels to the exemplar set labels list
-        images_ex = torch.empty((0, img_channels, img_size, img_size))
-        labels_ex = torch.empty((0), dtype=torch.long) # Reset the labels variable
-        print(f"Class {class_index} exemplar set size: {len(exemplar_set_img[class_index])}")
-
+        # Add the exemplars of the class to the memory
+        exemplar_memory.add(class_index, train_images[selection[class_index]], train_labels[selection[class_index]])
+        print(f"Class {class_index} exemplar set size: {exemplar_memory.class_size(class_index)}")
 
     print(f"Number of exemplars per class: {m}")
     print(f"Number of classes in the current task: {len(classes_task)}")
-    print(f"Total size of the exemplar set images: {sum([len(exemplar_set_img[i]) for i in range(len(exemplar_set_img))])}")
+    print(f"Total size of the exemplar set images: {len(exemplar_memory)}")
 
-    return exemplar_set_img, exemplar_set_label, tasks_dict 
+    return exemplar_memory, tasks_dict
@@ -0,0 +1,69 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class _DistillationCrossEntropy(torch.autograd.Function):
+    """
+    Fused forward and backward of the distillation cross entropy, for targets that do not require gradients
+    (the outputs of the frozen old model or auxiliary network).
+
+    Only the softmax of the outputs and the weights of the gradient are saved for the backward pass, instead of
+    the intermediate tensors of each elementwise operation.
+    """
+    @staticmethod
+    def forward(ctx, outputs, targets, exp, eps, size_average):
+        log_out = F.log_softmax(outputs * exp, dim=1)
+        tar = F.softmax(targets * exp, dim=1)
+
+        # log((softmax + eps / C) / (1 + eps)), computed in log space
+        log_out_eps = torch.logaddexp(log_out, log_out.new_tensor(math.log(eps / outputs.size(1))))
+        ce = math.log1p(eps) - (tar * log_out_eps).sum(1)
+
+        # d(log_out_eps)/d(log_out) = softmax / (softmax + eps / C)
+        weights = tar * torch.exp(log_out - log_out_eps)
+        ctx.save_for_backward(log_out.exp_(), weights)
+        ctx.exp, ctx.size_average = exp, size_average
+
+        return ce.mean() if size_average else ce
+
+    @staticmethod
+    def backward(ctx, grad_ce):
+        prob, weights = ctx.saved_tensors
+        grad = prob * weights.sum(1, keepdim=True) - weights # Backward of log_softmax
+        grad = grad * ctx.exp
+        if ctx.size_average:
+            grad = grad * (grad_ce / prob.size(0))
+        else:
+            grad = grad * grad_ce.view(-1, 1)
+        return grad, None, None, None, None
+
+
+def cross_entropy(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
+    """
+    Cross entropy between the temperature-scaled softmax of the targets and of the outputs, used as distillation
+    loss in LwF and ANCL (exp = 1/T).
+
+    The softened distributions are computed as log_softmax(x * exp) and the eps smoothing of the outputs is done
+    in log space, so it is numerically stable and gives the same values and gradients as renormalizing
+    softmax(x) ** exp and adding eps.
+
+    :param outputs: logits of the current model (batch_size, num_classes)
+    :param targets: logits of the teacher (batch_size, num_classes)
+    :param exp: exponent of the probabilities (1/T)
+    :param size_average: average the loss over the batch
+    :param eps: smoothing added to the probabilities of the outputs
+    :return: loss (scalar, or per sample if size_average is False)
+    """
+    if not targets.requires_grad:
+        return _DistillationCrossEntropy.apply(outputs, targets, exp, eps, size_average)
+
+    log_out = F.log_softmax(outputs * exp, dim=1)
+    tar = F.softmax(targets * exp, dim=1)
+    log_out = torch.logaddexp(log_out, log_out.new_tensor(math.log(eps / outputs.size(1)))) - math.log1p(eps)
+    ce = -(tar * log_out).sum(1)
+    if size_average:
+        ce = ce.mean()
+    return ce
+
@@ -7,35 +7,47 @@ import copy
 
 sys.path.append('../')
 
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
 from models.architectures.net_cifar100 import Net_cifar100
 
-from methods.ewc_class import EWC, normal_train, normal_val, ewc_train, ewc_validate, test
+from methods.ewc_class import EWC, EWC_KFAC, normal_train, normal_val, ewc_train, ewc_validate, test
 
-def ewc_training(datasets, args):
+def ewc_training(datasets, args, kfac=False):
     
     """
     In this function, we train the model using the EWC approach.
 
     :param datasets: list of datasets
     :param args: arguments from the command line
+    :param kfac: if True, use a Kronecker-factored (KFAC) Fisher instead of the diagonal one
 
     :return: test_acc_final: list with the test accuracy of each task and the test average accuracy
+             costs: cost of each task (EvalScheduler.costs)
 
     """
 
+    if kfac:
+        method_cl = "EWC-KFAC"
+        ewc_class = EWC_KFAC
+    else:
+        method_cl = "EWC"
+        ewc_class = EWC
+
     print("\n")
     print("="*100)
-    print("Training on EWC approach...")
+    print(f"Training on {method_cl} approach...")
     print("="*100)
 
-    path_file = f"./results/{args.exp_name}/EWC_{args.dataset}.xlsx" # Path to save the results
+    path_file = f"./results/{args.exp_name}/{method_cl}_{args.dataset}.xlsx" # Path to save the results
     workbook = xlsxwriter.Workbook(path_file) # Create the excel file
     test_acc_final = [] # List to save the test accuracy of each task and the test average accuracy
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed) # Set the seed
 
@@ -49,7 +61,11 @@ def ewc_training(datasets, args):
         
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
 
@@ -69,14 +85,17 @@ def ewc_training(datasets, args):
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                    batch_size=args.batch_size,
                                                    shuffle=True)
+        # The Fisher of the validation penalty is computed on this loader and normalized by args.batch_size,
+        # so it keeps the training batch size (not eval_batch_size)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
                                                     batch_size=args.batch_size,
-                                                    shuffle=True)
+                                                    shuffle=False)
         
         if id_task == 0:
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
-                print(f"METHOD: EWC (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
+                print(f"METHOD: {method_cl} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
                 # Training
                 train_loss_epoch = normal_train(model, optimizer, train_loader)
@@ -84,10 +103,10 @@ def ewc_training(datasets, args):
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, 
-                                                                                         datasets, 
-                                                                                         args) 
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -109,7 +128,6 @@ def ewc_training(datasets, args):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) # Append the test accuracy of each task and the test average accuracy
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -117,13 +135,9 @@ def ewc_training(datasets, args):
                             param_group['lr'] = lr
                         model.load_state_dict(model_best.state_dict())
                 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy]) # Append the test accuracy of each task and the test average accuracy
                 
                 print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                
         else:            
             # Load the previous trained model
             old_model = copy.deepcopy(model)
@@ -135,28 +149,32 @@ def ewc_training(datasets, args):
                 tasks_id = id_task
 
             # Load the previous model
-            path_old_model = (f"./models/models_saved/{args.exp_name}/EWC_{args.dataset}/"
-                              f"EWC-aftertask{str(tasks_id)}.pt")
+            path_old_model = (f"./models/models_saved/{args.exp_name}/{method_cl}_{args.dataset}/"
+                              f"{method_cl}-aftertask{str(tasks_id)}.pt")
             old_model.load_state_dict(torch.load(path_old_model))
+
+            # The KFAC factors of the previous tasks are computed once and used in all the epochs of the task
+            ewc_task = ewc_class(model, old_model, train_loader, args) if kfac else None
                                                             
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
-                print(f"METHOD: EWC (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
+                print(f"METHOD: {method_cl} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
                 # Training
                 train_loss_epoch = ewc_train(model, optimizer, train_loader, 
-                                             EWC(model, old_model, train_loader, args),
+                                             ewc_task or ewc_class(model, old_model, train_loader, args),
                                              importance=args.ewc_lambda)
 
                 # Validation
                 val_loss_epoch = ewc_validate(model, val_loader, 
-                                              EWC(model, old_model, val_loader, args),
+                                              ewc_task or ewc_class(model, old_model, val_loader, args),
                                               importance=args.ewc_lambda)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, 
-                                                                                         datasets, 
-                                                                                         args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -178,8 +196,6 @@ def ewc_training(datasets, args):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            # Append the test accuracy of each task and the test average accuracy
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -188,23 +204,29 @@ def ewc_training(datasets, args):
                         model_best = copy.deepcopy(model)
                         model.load_state_dict(model_best.state_dict())
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    # Append the test accuracy of each task and the test average accuracy
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
 
                 print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+
         # Save the results (after each task)
-        save_training_results(dicc_results, workbook, id_task+1, training_name="EWC")
+        save_training_results(dicc_results, workbook, id_task+1, training_name=method_cl)
 
         # Save the model
-        save_model(model_best, args, id_task+1, method="EWC")
+        save_model(model_best, args, id_task+1, method=method_cl)
+
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
 
     # Close the excel file
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
 
 
 
@@ -7,6 +7,10 @@ from torch.autograd import Variable
 import torch.utils.data
 import argparse
 
+from utils.evaluation import eval_batches
+from utils.metrics import Metrics
+from utils.timers import timer
+
 
 def variable(t: torch.Tensor, use_cuda=True, **kwargs):
     if torch.cuda.is_available() and use_cuda:
@@ -30,6 +34,7 @@ class EWC(object):
         for n, p in deepcopy(self.params).items():
             self._means[n] = variable(p.data)
 
+    @timer.timed("fisher")
     def _diag_fisher(self):
         precision_matrices = {}
 
@@ -72,109 +77,240 @@ class EWC(object):
         return loss
 
 
-def normal_train(model: nn.Module, optimizer: torch.optim, data_loader: torch.utils.data.DataLoader):
+class EWC_KFAC(object):
+    """
+    EWC with a Kronecker-factored (KFAC) approximation of the Fisher information.
+
+    For every nn.Linear and nn.Conv2d layer, the Fisher block of its weights (and bias) is approximated by A ⊗ G,
+    where A is the covariance of the layer inputs and G the covariance of the gradients w.r.t. the layer outputs.
+    Both factors are collected with hooks in a single pass over the data. The rest of the parameters (e.g. the
+    BatchNorm layers of Net_cifar100) use the diagonal Fisher, as in EWC.
+
+    The factors are on the scale of the diagonal Fisher of EWC (sum over the batches of the squared gradients of the
+    batch loss, divided by args.batch_size), so both methods use the same ewc_lambda: A is the mean over the batches
+    of the input covariance, and G the sum over the batches of the output gradients of the batch loss, divided by
+    args.batch_size.
+
+    The factors belong to the solution of the previous tasks: they are computed on old_model, once per task, and
+    the same object gives the penalty of all the epochs of the task (training and validation).
+    """
+    def __init__(self, current_model: nn.Module, old_model: nn.Module,
+                 dataset: list, args: argparse.Namespace):
+
+        self.current_model = current_model
+        self.old_model = old_model
+        self.dataset = dataset
+        self.args = args
+
+        self.params = {n: p for n, p in self.old_model.named_parameters() if p.requires_grad}
+        self._kfac_layers = {n: m for n, m in self.old_model.named_modules()
+                             if isinstance(m, (nn.Linear, nn.Conv2d))}
+        self._kfac_factors, self._precision_matrices = self._kfac_fisher()
+        self._means = {}
+
+        for n, p in deepcopy(self.params).items():
+            self._means[n] = variable(p.data)
+
+    @timer.timed("fisher")
+    def _kfac_fisher(self):
+        kfac_factors = {n: [0, 0] for n in self._kfac_layers} # [A, G] of each layer
+        kfac_params = {f"{n}.{p}" for n, m in self._kfac_layers.items() for p, _ in m.named_parameters()}
+        precision_matrices = {}
+
+        for n, p in deepcopy(self.params).items():
+            if n not in kfac_params:
+                p.data.zero_() # Make sure the precision matrice is empty
+                precision_matrices[n] = variable(p.data)
+
+        def accumulate_factors(name):
+            def hook(module, input, output):
+                # A is accumulated here, so the unfolded input of each layer is freed before the next layer runs
+                a = self._layer_input(module, input[0].detach())
+                kfac_factors[name][0] += a.t() @ a / a.size(0)
+                del a
+
+                def save_grad_output(grad_output):
+                    g = grad_output.detach() # Gradients of the batch loss (mean over the samples), as in EWC
+                    if isinstance(module, nn.Conv2d):
+                        g = g.transpose(1, -1).reshape(-1, g.size(1)) # One row per spatial location
+                    kfac_factors[name][1] += g.t() @ g / self.args.batch_size
+
+                output.register_hook(save_grad_output)
+            return hook
+
+        handles = [module.register_forward_hook(accumulate_factors(n)) for n, module in self._kfac_layers.items()]
+
+        self.old_model.eval()
+        for input, label in self.dataset:
+            self.old_model.zero_grad()
+            input = variable(input)
+            label = variable(label)
+
+            output = self.old_model(input)
+            loss = F.cross_entropy(output, label)
+            loss.backward()
+
+            for n, p in self.old_model.named_parameters():
+                if n in precision_matrices:
+                    precision_matrices[n].data += p.grad.data ** 2 / self.args.batch_size
+
+        for handle in handles:
+            handle.remove()
+
+        kfac_factors = {n: (A / len(self.dataset), G) for n, (A, G) in kfac_factors.items()}
+        return kfac_factors, precision_matrices
+
+    @staticmethod
+    def _layer_input(module: nn.Module, x: torch.Tensor):
+        # Rows are the vectors that multiply the weight matrix, extended with a 1 for the bias
+        if isinstance(module, nn.Conv2d):
+            x = F.unfold(x, module.kernel_size, dilation=module.dilation,
+                         padding=module.padding, stride=module.stride) # (N, C*kh*kw, L)
+            x = x.transpose(1, 2).reshape(-1, x.size(1))
+        else:
+            x = x.reshape(-1, x.size(-1))
+        if module.bias is not None:
+            x = torch.cat([x, x.new_ones(x.size(0), 1)], dim=1)
+        return x
+
+    def penalty(self, model: nn.Module):
+        loss = 0
+        modules = dict(model.named_modules())
+        for n, (A, G) in self._kfac_factors.items():
+            module = modules[n]
+            delta = (module.weight - self._means[f"{n}.weight"]).reshape(module.weight.size(0), -1)
+            if module.bias is not None:
+                delta = torch.cat([delta, (module.bias - self._means[f"{n}.bias"]).unsqueeze(1)], dim=1)
+            # vec(dW)^T (A ⊗ G) vec(dW) = tr(dW^T G dW A)
+            loss += ((G @ delta) * (delta @ A)).sum()
+
+        for n, p in model.named_parameters():
+            if n in self._precision_matrices:
+                _loss = self._precision_matrices[n] * (p - self._means[n]) ** 2
+                loss += _loss.sum()
+        return loss
+
+
+@timer.timed("train")
+def normal_train(model: nn.Module, optimizer: torch.optim, data_loader: torch.utils.data.DataLoader,
+                 post_step=None):
     model.train()
-    epoch_loss = 0
-    for input, target in data_loader:
+    metrics = Metrics()
+    for input, target in timer.loader(data_loader):
         input, target = variable(input), variable(target)
         optimizer.zero_grad()
         output = model(input)
         loss = F.cross_entropy(output, target)
-        epoch_loss += loss.item()
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
+        if post_step is not None:
+            post_step(model) # e.g. accumulate the SI importance
     
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    epoch_loss = metrics.mean("loss")
+    print(f"Train loss: {epoch_loss}")
+    return epoch_loss
 
+@timer.timed("validation")
 def normal_val(model: nn.Module, data_loader: torch.utils.data.DataLoader):
     model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = variable(input), variable(target)
             output = model(input)
-            loss += F.cross_entropy(output, target)
+            metrics.add("loss", F.cross_entropy(output, target))
 
-    print(f"Val loss: {loss / len(data_loader)}")    
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")    
+    return loss
 
 
+@timer.timed("train")
 def ewc_train(current_model: nn.Module, optimizer: torch.optim, 
-              data_loader: torch.utils.data.DataLoader, ewc: EWC, importance: float):
+              data_loader: torch.utils.data.DataLoader, ewc: EWC, importance: float, post_step=None):
     current_model.train()
-    epoch_loss = 0
-    ce_loss = 0
-    ewc_loss = 0
+    metrics = Metrics() # Losses of the epoch, summed on the device
 
-    for input, target in data_loader:
+    for input, target in timer.loader(data_loader):
         input, target = variable(input), variable(target)
         optimizer.zero_grad()
         output = current_model(input)
 
-        ce_loss += F.cross_entropy(output, target)
-        ewc_loss += importance * ewc.penalty(current_model)
+        # Compute each term once, the KFAC penalty is not cheap
+        ce = F.cross_entropy(output, target)
+        penalty = importance * ewc.penalty(current_model)
+        loss = ce + penalty
 
-        loss = F.cross_entropy(output, target) + importance * ewc.penalty(current_model)
-        
-        epoch_loss += loss.data.item()
+        metrics.add("ce", ce)
+        metrics.add("ewc", penalty)
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
+        if post_step is not None:
+            post_step(current_model)
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    print(f"CE loss: {ce_loss / len(data_loader)}")
-    print(f"EWC loss: {ewc_loss / len(data_loader)}")
+    means = metrics.means()
+    print(f"Train loss: {means['loss']}")
+    print(f"CE loss: {means['ce']}")
+    print(f"EWC loss: {means['ewc']}")
 
-    return epoch_loss / len(data_loader)
+    return means["loss"]
 
+@timer.timed("validation")
 def ewc_validate(current_model: nn.Module, data_loader: torch.utils.data.DataLoader, 
                  ewc: EWC, importance: float):
     current_model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
+        penalty = importance * ewc.penalty(current_model) # The weights do not change during validation
         for input, target in data_loader:
             input, target = variable(input), variable(target)
             output = current_model(input)
-            loss += F.cross_entropy(output, target) + importance * ewc.penalty(current_model)
+            metrics.add("loss", F.cross_entropy(output, target) + penalty)
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
 
 def test(model: nn.Module, datasets: list, args: argparse.Namespace):
     # Test
     model.eval()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') # Device of variable()
 
     avg_acc = 0 # Average accuracy
 
     test_task_list = [] # List to save the results of the task
     test_loss_list = [] # List to save the test loss
     test_acc_list = [] # List to save the test accuracy
+    test_confusion_list = [] # List to save the confusion matrices
 
 
     for id_task_test, task in enumerate(datasets):
-        test_loss, correct, accuracy = 0, 0, 0
+        metrics = Metrics() # Test loss and correct predictions, summed on the device
 
         _, _, test_dataset = task # Get the images and labels from the task
 
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                            batch_size=args.batch_size,
-                                            shuffle=False)
-        with torch.no_grad():
-            for input, target in test_loader:
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
+        with torch.inference_mode():
+            for input, target in test_batches:
                 input, target = variable(input), variable(target)
                 output = model(input)
-                test_loss += F.cross_entropy(output, target, reduction="sum").item()
-                correct += (F.softmax(output, dim=1).max(dim=1)[1] == target).sum().item()
+                metrics.add("loss", F.cross_entropy(output, target, reduction="sum"), target.size(0))
+                metrics.add_correct("accuracy", output, target)
+                metrics.add_confusion("confusion", output, target)
 
-        test_loss /= len(test_loader.dataset)
+        means = metrics.means() # Single copy from the device
+        test_loss = means["loss"]
 
-        accuracy = 100. * correct / len(test_loader.dataset)
+        accuracy = 100. * means["accuracy"]
         avg_acc += accuracy
 
         test_task_list.append(id_task_test+1)
         test_loss_list.append(test_loss)
         test_acc_list.append(accuracy)
+        test_confusion_list.append(means["confusion"])
 
         print(f"Test on task {id_task_test+1}: Average loss: {test_loss:.6f}, "
               f"Accuracy: {accuracy:.2f}%")
@@ -183,4 +319,4 @@ def test(model: nn.Module, datasets: list, args: argparse.Namespace):
     print(f"Average accuracy: {avg_acc:.2f}%")
 
 
-    return test_task_list, test_loss_list, test_acc_list, avg_acc
\ No newline at end of file
+    return test_task_list, test_loss_list, test_acc_list, avg_acc, test_confusion_list
\ No newline at end of file
@@ -7,14 +7,18 @@ import copy
 
 sys.path.append('../')
 
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler
+from utils.teacher_cache import teacher_logits, with_teacher_logits
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
 from models.architectures.net_cifar100 import Net_cifar100
 
 from methods.lwf_class import normal_train, normal_val, lwf_train, lwf_validate, test, lwf_train_aux, lwf_validate_aux
+from methods.auxiliary_network import auxiliary_network_training
 
 def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
 
@@ -42,6 +46,7 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
 
     workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
     test_acc_final = []  # List to save the average accuracy of each task
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed) # Set the seed
 
@@ -55,7 +60,11 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
         
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
         
@@ -76,11 +85,12 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
                                                    batch_size=args.batch_size,
                                                    shuffle=True)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                                 batch_size=args.batch_size,
-                                                 shuffle=True)
+                                                 batch_size=args.eval_batch_size,
+                                                 shuffle=False)
 
         if id_task == 0:
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
@@ -90,10 +100,10 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader, loss_ANCL)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, 
-                                                                                         datasets, 
-                                                                                         args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -115,7 +125,6 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -125,64 +134,14 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-                
-            
         else:
             
             if aux_training:
-
-                patience_aux = args.lr_patience # Patience for early stopping
-                lr_aux = args.lr # Learning rate
-                best_val_loss_aux = 1e20 # Validation loss of the previous epoch
-                auxiliary_network = copy.deepcopy(model_best).to(device)
-                optimizer_aux = optim.Adam(auxiliary_network.parameters(), lr=args.lr)  # Instantiate the optimizer
-
-                for epoch in range(args.epochs):
-                    print("="*100)
-                    print("Train the auxiliary network...")
-                    print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
-
-                    normal_train(auxiliary_network, optimizer_aux, train_loader, loss_ANCL)
-                    val_loss_epoch_aux = normal_val(auxiliary_network, val_loader, loss_ANCL)
-                    test(auxiliary_network, datasets, args)
-
-                    # Early stopping
-                    if val_loss_epoch_aux < best_val_loss_aux:
-                        best_val_loss_aux = val_loss_epoch_aux
-                        patience_aux = args.lr_patience
-                        model_best_aux = copy.deepcopy(auxiliary_network)
-                    else:
-                        # if the loss does not go down, decrease patience
-                        patience_aux -= 1
-                        if patience_aux <= 0:
-                            # if it runs out of patience, reduce the learning rate
-                            lr_aux /= args.lr_decay
-                            print(' lr={:.1e}'.format(lr), end='')
-                            if lr_aux < args.lr_min:
-                                # if the lr decreases below minimum, stop the training session
-                                print()
-                                # test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-                                break
-                            # reset patience and recover best model so far to continue training
-                            patience_aux = args.lr_patience
-                            for param_group in optimizer_aux.param_groups:
-                                param_group['lr'] = lr_aux
-                            auxiliary_network.load_state_dict(model_best_aux.state_dict())
-                    
-                    print(f"Current learning rate: {optimizer_aux.param_groups[0]['lr']}, Patience: {patience_aux}")
-
-                    if epoch == args.epochs-1:
-                        auxiliary_network = copy.deepcopy(model_best_aux).to(device)
-
+                # Train the auxiliary network (or load it, if it was already trained from the same checkpoint)
+                auxiliary_network = auxiliary_network_training(model_best, train_dataset, val_dataset, args, device,
+                                                               id_task, method_print)
                 torch.save(auxiliary_network.state_dict(), (f"./models/models_saved/{args.exp_name}/{method_cl}_{args.dataset}/"
                                                            f"AuxNetwork-task{str([id_task+1])}.pt"))
-            
-                auxiliary_network.eval()
-                for param in auxiliary_network.parameters():
-                    param.requires_grad = False
 
             # Prepare the old model
             tasks_id = [x for x in range(1,id_task+1)]
@@ -197,7 +156,25 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
             old_model.load_state_dict(torch.load(path_old_model))
             old_model.eval()
 
+            if args.teacher_cache != "off":
+                # The teachers are frozen, so their logits are computed once and loaded with each batch
+                teachers_train = [teacher_logits(old_model, train_dataset, f"task{id_task+1}-train", device, args)]
+                teachers_val = [teacher_logits(old_model, val_dataset, f"task{id_task+1}-val", device, args)]
+                if aux_training:
+                    teachers_train.append(teacher_logits(auxiliary_network, train_dataset, 
+                                                         f"task{id_task+1}-train", device, args))
+                    teachers_val.append(teacher_logits(auxiliary_network, val_dataset, 
+                                                       f"task{id_task+1}-val", device, args))
+
+                train_loader = torch.utils.data.DataLoader(dataset=with_teacher_logits(train_dataset, *teachers_train),
+                                                           batch_size=args.batch_size,
+                                                           shuffle=True)
+                val_loader = torch.utils.data.DataLoader(dataset=with_teacher_logits(val_dataset, *teachers_val),
+                                                         batch_size=args.eval_batch_size,
+                                                         shuffle=False)
+
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
@@ -219,10 +196,10 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
                     val_loss_epoch = lwf_validate_aux(model, old_model, val_loader, args.lwf_lambda,
                                                   auxiliary_network, args.lwf_aux_lambda, loss_ANCL)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, 
-                                                                                         datasets, 
-                                                                                         args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -244,7 +221,6 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -254,10 +230,12 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch 
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-                
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
 
         # Save the results (after each task)
         save_training_results(dicc_results, workbook, id_task+1, training_name="LwF")
@@ -265,10 +243,13 @@ def lwf_training(datasets, args, aux_training=False, loss_ANCL=None):
         # Save the model
         save_model(model_best, args, id_task+1, method=method_cl)
 
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
+
     # Close the excel file
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
                    test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
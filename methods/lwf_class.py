@@ -7,6 +7,11 @@ from torch.autograd import Variable
 import torch.utils.data
 import argparse
 
+from methods.distillation import cross_entropy
+from utils.evaluation import eval_batches
+from utils.metrics import Metrics
+from utils.timers import timer
+
 
 def variable(t: torch.Tensor, use_cuda=True, **kwargs):
     if torch.cuda.is_available() and use_cuda:
@@ -17,11 +22,12 @@ def variable(t: torch.Tensor, use_cuda=True, **kwargs):
   
 
 
+@timer.timed("train")
 def normal_train(model: nn.Module, optimizer: torch.optim, data_loader: torch.utils.data.DataLoader,
                  loss_ANCL=None):
     model.train()
-    epoch_loss = 0
-    for input, target in data_loader:
+    metrics = Metrics()
+    for input, target in timer.loader(data_loader):
         input, target = variable(input), variable(target)
         optimizer.zero_grad()
         output = model(input)
@@ -29,45 +35,60 @@ def normal_train(model: nn.Module, optimizer: torch.optim, data_loader: torch.ut
             loss = F.cross_entropy(output, target)
         else:
             loss = criterion(output, target, task=0)
-        epoch_loss += loss.item()
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    epoch_loss = metrics.mean("loss")
+    print(f"Train loss: {epoch_loss}")
+    return epoch_loss
 
 
+@timer.timed("validation")
 def normal_val(model: nn.Module, data_loader: torch.utils.data.DataLoader, loss_ANCL=None):
     model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = variable(input), variable(target)
             output = model(input)
             if loss_ANCL is None:
-                loss += F.cross_entropy(output, target)
+                metrics.add("loss", F.cross_entropy(output, target))
             else:
-                loss += criterion(output, target, task=0)
+                metrics.add("loss", criterion(output, target, task=0))
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
 
+@timer.timed("teacher")
+def frozen_output(network: nn.Module, input: torch.Tensor, batch: list, index: int):
+    """
+    Get the logits of a frozen network (old model or auxiliary network). If the data loader yields the cached
+    logits of the network (utils.teacher_cache), batch[index] is used, otherwise the network is evaluated.
+    """
+    if len(batch) > index:
+        return variable(batch[index]).float()
+    with torch.no_grad():
+        return network(input)
+
+
+@timer.timed("train")
 def lwf_train(model: nn.Module, old_model:nn.Module, optimizer: torch.optim, 
               data_loader: torch.utils.data.DataLoader, alpha: float, loss_ANCL=None):
     model.train()
-    epoch_loss = 0
-    epoch_loss = 0
-    epoch_penalty_loss = 0
+    metrics = Metrics() # Losses of the epoch, summed on the device
 
-    for input, target in data_loader:
-        input, target = variable(input), variable(target)
+    for batch in timer.loader(data_loader):
+        input, target = variable(batch[0]), variable(batch[1])
         optimizer.zero_grad()
         output = model(input)
+        old_output = frozen_output(old_model, input, batch, 2) # The old model is frozen
 
         # Get the predictions of the current model
-        current_predictions = F.log_softmax(model(input), dim=1)
-        old_predictions = F.softmax(old_model(input), dim=1)
+        current_predictions = F.log_softmax(output, dim=1)
+        old_predictions = F.softmax(old_output, dim=1)
         
         # Calculate the KL divergence between the current and old predictions
         penalty = F.kl_div(current_predictions, old_predictions, reduction='batchmean')
@@ -75,151 +96,157 @@ def lwf_train(model: nn.Module, old_model:nn.Module, optimizer: torch.optim,
         if loss_ANCL is None:
             loss = F.cross_entropy(output, target) + alpha * penalty
         else:
-            old_pred = old_model(input)
-            loss = criterion(output, target, task=1, targets_old=old_pred, lwf_lambda=alpha)
+            loss = criterion(output, target, task=1, targets_old=old_output, lwf_lambda=alpha)
 
-        epoch_loss += loss.data.item()
-        epoch_penalty_loss += penalty.data.item() * alpha
+        metrics.add("loss", loss)
+        metrics.add("penalty", penalty * alpha)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    print(f"Penalty: {epoch_penalty_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    means = metrics.means()
+    print(f"Train loss: {means['loss']}")
+    print(f"Penalty: {means['penalty']}")
+    return means["loss"]
 
 
+@timer.timed("validation")
 def lwf_validate(model: nn.Module, old_model:nn.Module, data_loader: torch.utils.data.DataLoader, 
                  alpha: float, loss_ANCL=None):
     model.eval()
     old_model.eval()
-    loss = 0
+    metrics = Metrics()
 
-    with torch.no_grad():
-        for input, target in data_loader:
-            input, target = variable(input), variable(target)
+    with torch.inference_mode():
+        for batch in data_loader:
+            input, target = variable(batch[0]), variable(batch[1])
             output = model(input)
+            old_output = frozen_output(old_model, input, batch, 2)
             
             # Get the predictions of the current model
-            current_predictions = F.log_softmax(model(input), dim=1)
-            old_predictions = F.softmax(old_model(input), dim=1)
+            current_predictions = F.log_softmax(output, dim=1)
+            old_predictions = F.softmax(old_output, dim=1)
             
             # Calculate the KL divergence between the current and old predictions
             penalty = F.kl_div(current_predictions, old_predictions, reduction='batchmean')
 
             if loss_ANCL is None:
-                loss += F.cross_entropy(output, target) + alpha * penalty
+                metrics.add("loss", F.cross_entropy(output, target) + alpha * penalty)
             else:
-                old_pred = old_model(input)
-                loss += criterion(output, target, task=1, targets_old=old_pred, lwf_lambda=alpha)
+                metrics.add("loss", criterion(output, target, task=1, targets_old=old_output, lwf_lambda=alpha))
             
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
+@timer.timed("train")
 def lwf_train_aux(model, old_model, optimizer, data_loader, lwf_lambda, auxiliary_network, lwf_aux_lambda,
                   loss_ANCL=None):
     model.train()
     auxiliary_network.eval()
-    epoch_loss = 0
-    epoch_penalty_loss = 0
-    epoch_aux_loss = 0
+    metrics = Metrics() # Losses of the epoch, summed on the device
 
 
-    for input, target in data_loader:
-        input, target = variable(input), variable(target)
+    for batch in timer.loader(data_loader):
+        input, target = variable(batch[0]), variable(batch[1])
         optimizer.zero_grad()
         output = model(input)
+        # The old model and the auxiliary network are frozen
+        old_output = frozen_output(old_model, input, batch, 2)
+        aux_output = frozen_output(auxiliary_network, input, batch, 3)
+        old_predictions = F.softmax(old_output, dim=1)
         
         # Calculate the KL divergence between the current and old predictions
-        penalty_lwf = F.kl_div(F.log_softmax(model(input), dim=1),
-                               F.softmax(old_model(input), dim=1), reduction='batchmean')
+        penalty_lwf = F.kl_div(F.log_softmax(output, dim=1), old_predictions, reduction='batchmean')
 
         # Get the predictions of the auxiliary network
-        aux_loss_lwf = F.kl_div(F.log_softmax(auxiliary_network(input), dim=1), 
-                                F.softmax(old_model(input), dim=1), reduction='batchmean')
+        aux_loss_lwf = F.kl_div(F.log_softmax(aux_output, dim=1), old_predictions, reduction='batchmean')
 
         if loss_ANCL is None:
             loss = F.cross_entropy(output, target) + lwf_lambda * penalty_lwf + lwf_aux_lambda * aux_loss_lwf
         else:
-            old_pred = old_model(input)
-            aux_pred = auxiliary_network(input)
-            loss = criterion(output, target, task=1, targets_old=old_pred, lwf_lambda=lwf_lambda,
-                            targets_aux=aux_pred, lwf_aux_lambda=lwf_aux_lambda)
-
-        epoch_loss += loss.data.item()
-        epoch_penalty_loss += penalty_lwf.data.item() * lwf_lambda
-        epoch_aux_loss += aux_loss_lwf.data.item() * lwf_aux_lambda
+            loss = criterion(output, target, task=1, targets_old=old_output, lwf_lambda=lwf_lambda,
+                            targets_aux=aux_output, lwf_aux_lambda=lwf_aux_lambda)
+
+        metrics.add("loss", loss)
+        metrics.add("penalty", penalty_lwf * lwf_lambda)
+        metrics.add("aux", aux_loss_lwf * lwf_aux_lambda)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    print(f"Penalty: {epoch_penalty_loss / len(data_loader)}")
-    print(f"Auxiliar loss: {epoch_aux_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    means = metrics.means()
+    print(f"Train loss: {means['loss']}")
+    print(f"Penalty: {means['penalty']}")
+    print(f"Auxiliar loss: {means['aux']}")
+    return means["loss"]
 
+@timer.timed("validation")
 def lwf_validate_aux(model, old_model, data_loader, lwf_lambda, auxiliary_network, lwf_aux_lambda,
                      loss_ANCL=None):
     model.eval()
     old_model.eval()
     auxiliary_network.eval()
-    loss = 0
+    metrics = Metrics()
 
-    with torch.no_grad():
-        for input, target in data_loader:
-            input, target = variable(input), variable(target)
+    with torch.inference_mode():
+        for batch in data_loader:
+            input, target = variable(batch[0]), variable(batch[1])
             output = model(input)
+            old_output = frozen_output(old_model, input, batch, 2)
+            aux_output = frozen_output(auxiliary_network, input, batch, 3)
+            old_predictions = F.softmax(old_output, dim=1)
             
             # Calculate the KL divergence between the current and old predictions
-            penalty_lwf = F.kl_div(F.log_softmax(model(input), dim=1),
-                                   F.softmax(old_model(input), dim=1), reduction='batchmean')
+            penalty_lwf = F.kl_div(F.log_softmax(output, dim=1), old_predictions, reduction='batchmean')
 
             # Get the predictions of the auxiliary network
-            aux_loss = F.kl_div(F.log_softmax(auxiliary_network(input), dim=1),
-                                F.softmax(old_model(input), dim=1), reduction='batchmean')
+            aux_loss = F.kl_div(F.log_softmax(aux_output, dim=1), old_predictions, reduction='batchmean')
 
             if loss_ANCL is None:
-                loss += F.cross_entropy(output, target) + lwf_lambda * penalty_lwf + lwf_aux_lambda * aux_loss
+                metrics.add("loss", F.cross_entropy(output, target) + lwf_lambda * penalty_lwf + lwf_aux_lambda * aux_loss)
             else:
-                old_pred = old_model(input)
-                aux_pred = auxiliary_network(input)
-                loss += criterion(output, target, task=1, targets_old=old_pred, lwf_lambda=lwf_lambda,
-                                targets_aux=aux_pred, lwf_aux_lambda=lwf_aux_lambda)
+                metrics.add("loss", criterion(output, target, task=1, targets_old=old_output, lwf_lambda=lwf_lambda,
+                                              targets_aux=aux_output, lwf_aux_lambda=lwf_aux_lambda))
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss / len(data_loader)
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
 def test(model: nn.Module, datasets: list, args: argparse.Namespace):
     # Test
     model.eval()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') # Device of variable()
 
     avg_acc = 0  # Average accuracy
 
     test_task_list = []  # List to save the results of the task
     test_loss_list = []  # List to save the test loss
     test_acc_list = []  # List to save the test accuracy
+    test_confusion_list = []  # List to save the confusion matrices
 
     for id_task_test, task in enumerate(datasets):
-        test_loss, correct, accuracy = 0, 0, 0
+        metrics = Metrics() # Test loss and correct predictions, summed on the device
 
         _, _, test_dataset = task  # Get the images and labels from the task
 
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                  batch_size=args.batch_size,
-                                                  shuffle=False)
-        with torch.no_grad():
-            for input, target in test_loader:
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
+        with torch.inference_mode():
+            for input, target in test_batches:
                 input, target = variable(input), variable(target)
                 output = model(input)
-                test_loss += F.cross_entropy(output, target, reduction="sum").item()
-                correct += (F.softmax(output, dim=1).max(dim=1)[1] == target).sum().item()
+                metrics.add("loss", F.cross_entropy(output, target, reduction="sum"), target.size(0))
+                metrics.add_correct("accuracy", output, target)
+                metrics.add_confusion("confusion", output, target)
 
-        test_loss /= len(test_loader.dataset)
+        means = metrics.means() # Single copy from the device
+        test_loss = means["loss"]
 
-        accuracy = 100. * correct / len(test_loader.dataset)
+        accuracy = 100. * means["accuracy"]
         avg_acc += accuracy
 
         test_task_list.append(id_task_test+1)
         test_loss_list.append(test_loss)
         test_acc_list.append(accuracy)
+        test_confusion_list.append(means["confusion"])
 
         print(f"Test on task {id_task_test+1}: Average loss: {test_loss:.6f}, "
               f"Accuracy: {accuracy:.2f}%")
@@ -227,7 +254,7 @@ def test(model: nn.Module, datasets: list, args: argparse.Namespace):
     avg_acc /= len(datasets)
     print(f"Average accuracy: {avg_acc:.2f}%")
 
-    return test_task_list, test_loss_list, test_acc_list, avg_acc
+    return test_task_list, test_loss_list, test_acc_list, avg_acc, test_confusion_list
 
 
 def criterion(outputs, targets, task=0, targets_old=None, lwf_lambda=None, targets_aux=None, lwf_aux_lambda=None):
@@ -242,24 +269,6 @@ def criterion(outputs, targets, task=0, targets_old=None, lwf_lambda=None, targe
 
     return loss + F.cross_entropy(outputs, targets)
 
-def cross_entropy(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
-    # print(outputs.shape)
-    # print(targets.shape)
-    out = torch.nn.functional.softmax(outputs, dim=1)
-    tar = torch.nn.functional.softmax(targets, dim=1)
-    if exp != 1:
-        out = out.pow(exp)
-        out = out / out.sum(1).view(-1, 1).expand_as(out)
-        tar = tar.pow(exp)
-        tar = tar / tar.sum(1).view(-1, 1).expand_as(tar)
-    out = out + eps / out.size(1)
-    out = out / out.sum(1).view(-1, 1).expand_as(out)
-    ce = -(tar * out.log()).sum(1)
-    if size_average:
-        ce = ce.mean()
-        # print(ce.shape)
-    return ce    
-    
 
 # def adjust_lr_patience(val_loss_epoch, best_val_loss, patience, lr, args, model, model_best, optimizer,
 #                        test_acc_final, test_tasks_accuracy, avg_accuracy, epoch):
@@ -289,4 +298,4 @@ def cross_entropy(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
 #     # Save the results of the epoch if it is the last epoch
 #     if epoch == args.epochs-1:
 #         test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-#     return best_val_loss, patience, model_best
\ No newline at end of file
+#     return best_val_loss, patience, model_best
\ No newline at end of file
@@ -5,12 +5,23 @@ import torch.optim as optim
 import xlsxwriter
 import sys
 import copy
-import numpy as np
 
 sys.path.append('../')
 
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler, eval_batches
+from utils.metrics import Metrics
+from utils.teacher_cache import teacher_logits, with_teacher_logits
+from utils.replay_sampler import ReplaySampler, MixedBatch
+from utils.herding import herding_ranking
+from utils.exemplar_memory import ExemplarMemory
+from utils.exemplar_codecs import make_codec, memory_capacity
+
+from methods.distillation import cross_entropy
+from methods.auxiliary_network import auxiliary_network_training
+from methods.bimeco import forward_batches
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
@@ -43,11 +54,10 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
     # Create the workbook and worksheet to save the results
     workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
     test_acc_final = []  # List to save the average accuracy of each task
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed)  # Set the seed
 
-    exemplar_set_img = []  # List to save the exemplar set
-    exemplar_set_label = []  # List to save the exemplar set labels
 
     # Create the excel file
     if args.dataset == "mnist":
@@ -69,9 +79,20 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
         img_channels = 3
         feature_dim = 2048 #1024
 
+    # Memory to save the exemplar set (images and labels)
+    codec = make_codec(args, (img_channels, img_size, img_size), num_classes) # Storage of the exemplars
+    exemplar_memory = ExemplarMemory(memory_capacity(args, codec, num_classes), (img_channels, img_size, img_size), 
+                                     codec=codec)
+    print(f"Exemplar memory: {exemplar_memory.capacity} exemplars ({args.exemplar_codec}, "
+          f"{exemplar_memory.nbytes() / 2**20:.1f} MB of codes and labels)")
+
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, device, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
         
@@ -92,11 +113,12 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
                                                 batch_size=args.batch_size,
                                                 shuffle=True)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                                batch_size=args.batch_size,
-                                                shuffle=True)      
+                                                batch_size=args.eval_batch_size,
+                                                shuffle=False)      
         if id_task == 0:
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
@@ -106,8 +128,10 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, val_loss_epoch, 
@@ -128,7 +152,6 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -138,62 +161,14 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
-
         else:
 
             if aux_training:
-                patience_aux = args.lr_patience # Patience for early stopping
-                lr_aux = args.lr # Learning rate
-                best_val_loss_aux = 1e20 # Validation loss of the previous epoch
-                auxiliary_network = copy.deepcopy(model_best)
-                optimizer_aux = optim.Adam(auxiliary_network.parameters(), lr=args.lr)  # Instantiate the optimizer
-
-                for epoch in range(args.epochs):
-                    print("="*100)
-                    print("Train the auxiliary network...")
-                    print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
-
-                    normal_train(auxiliary_network, optimizer_aux, train_loader, device)
-                    val_loss_epoch_aux = normal_val(auxiliary_network, val_loader, device)
-                    test(auxiliary_network, datasets, device, args)
-
-                    # Early stopping
-                    if val_loss_epoch_aux < best_val_loss_aux:
-                        best_val_loss_aux = val_loss_epoch_aux
-                        patience_aux = args.lr_patience
-                        model_best_aux = copy.deepcopy(auxiliary_network)
-                    else:
-                        # if the loss does not go down, decrease patience
-                        patience_aux -= 1
-                        if patience_aux <= 0:
-                            # if it runs out of patience, reduce the learning rate
-                            lr_aux /= args.lr_decay
-                            print(' lr={:.1e}'.format(lr), end='')
-                            if lr_aux < args.lr_min:
-                                # if the lr decreases below minimum, stop the training session
-                                print()
-                                #test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-                                break
-                            # reset patience and recover best model so far to continue training
-                            patience_aux = args.lr_patience
-                            for param_group in optimizer_aux.param_groups:
-                                param_group['lr'] = lr_aux
-                            auxiliary_network.load_state_dict(model_best_aux.state_dict())
-                    
-                    print(f"Current learning rate: {optimizer_aux.param_groups[0]['lr']}, Patience: {patience_aux}")
-
-                    if epoch == args.epochs-1:
-                        auxiliary_network = copy.deepcopy(model_best_aux).to(device)
-                        
+                # Train the auxiliary network (or load it, if it was already trained from the same checkpoint)
+                auxiliary_network = auxiliary_network_training(model_best, train_dataset, val_dataset, args, device,
+                                                               id_task, method_print)
                 torch.save(auxiliary_network.state_dict(), (f"./models/models_saved/{args.exp_name}/{method_cl}_{args.dataset}/"
-                                                              f"AuxNetwork-task{str([id_task+1])}.pt"))
-            
-                auxiliary_network.eval()
-                for param in auxiliary_network.parameters():
-                    param.requires_grad = False
+                                                           f"AuxNetwork-task{str([id_task+1])}.pt"))
 
             # Prepare the old model
             tasks_id = [x for x in range(1,id_task+1)]
@@ -228,84 +203,70 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
             ratio = len(tasks_dict[id_task]) / (len(tasks_dict[id_task]) + sum([len(tasks_dict[i]) for i in range(id_task)])) 
             
             train_dataloader_s = train_loader
-            train_dataloader_l = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                                batch_size=args.batch_size,
-                                                                # batch_size=int(ratio*args.batch_size),
-                                                                shuffle=True)
-
-            data_loader_exem_iter = iter(data_loader_exem)
-            train_dataloader_l_iter = iter(train_dataloader_l)
+            if args.teacher_cache != "off":
+                # The teachers are frozen, so their logits are computed once and loaded with each batch
+                teachers_train = [teacher_logits(old_model, train_dataset, f"task{id_task+1}-train", device, args)]
+                if aux_training:
+                    teachers_train.append(teacher_logits(auxiliary_network, train_dataset, 
+                                                         f"task{id_task+1}-train", device, args))
+                train_dataloader_s = torch.utils.data.DataLoader(dataset=with_teacher_logits(train_dataset, *teachers_train),
+                                                                 batch_size=args.batch_size,
+                                                                 shuffle=True)
+
+            # Samplers of the exemplars and of the current task (batches of the long term memory model), on the device
+            sampler_exem = ReplaySampler([tensor_exem_img, tensor_exem_label], device, replacement=args.replay_replacement,
+                                         class_balanced=args.replay_class_balanced, codec=exemplar_memory.codec)
+            sampler_l = ReplaySampler(train_dataset.tensors, device)
+            batch_s, batch_l = MixedBatch(device), MixedBatch(device) # Preallocated buffers of the mixed batches
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
-                train_loss_epoch = 0
-                ce_loss_epoch, penalty_loss_epoch, auxiliar_loss_epoch = 0, 0, 0
-                short_loss_epoch, long_loss_epoch, diff_loss_epoch = 0, 0, 0
+                metrics = Metrics() # Losses of the epoch, summed on the device
                 
                 # Sample a batch of data from train_dataloader_s
-                for images, labels in train_dataloader_s:
-
-                    # Sample two different batches from data_loader_exem
-                    try:
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-                        images_exem_2, labels_exem_2 = next(data_loader_exem_iter)
-                    except StopIteration:
-                        data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                                    batch_size=args.batch_size,
-                                                                    shuffle=True)
-                        data_loader_exem_iter = iter(data_loader_exem)
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-                        images_exem_2, labels_exem_2 = next(data_loader_exem_iter)
-
-                    # Concatenate the images and labels of the first batch from data_loader_exem
-                    images_s = torch.cat((images, images_exem_1), dim=0).to(device)
-                    labels_s = torch.cat((labels, labels_exem_1), dim=0).to(device)
-
-                    # Randomly sample ratio * batch_size samples from train_dataloader_l
-                    try:
-                        images_l, labels_l = next(train_dataloader_l_iter)
-                    except StopIteration:
-                        train_dataloader_l = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                                         batch_size=args.batch_size,
-                                                                        # batch_size=int(ratio*args.batch_size),
-                                                                        shuffle=True)
-                        train_dataloader_l_iter = iter(train_dataloader_l)
-                        images_l, labels_l = next(train_dataloader_l_iter)
-
-                    # Concatenate the images and labels of the second batch from data_loader_exem
-                    images_l = torch.cat((images_l, images_exem_2), dim=0).to(device)
-                    labels_l = torch.cat((labels_l, labels_exem_2), dim=0).to(device)
-
-                    images, labels = images.to(device), labels.to(device) # Move the images and labels to GPU
+                for batch in timer.loader(train_dataloader_s):
+                    images, labels = batch[0].to(device), batch[1].to(device) # Move the images and labels to GPU
+                    teachers_batch = [logits.to(device) for logits in batch[2:]] # Cached logits of the teachers
+
+                    # Concatenate the images and labels with a batch of exemplars
+                    images_s, labels_s = batch_s.fill([images, labels], (sampler_exem, args.batch_size))
+
+                    # Randomly sample batch_size samples of the current task and a second (different) batch of exemplars
+                    images_l, labels_l = batch_l.fill(None, (sampler_l, args.batch_size), (sampler_exem, args.batch_size))
 
                     # Forward pass
                     if not aux_training:
                         epoch_loss, ce_loss, penalty_loss, aux_loss, loss_short, loss_long, diff_loss = ( 
                             lwf_bimeco_train(old_model, None, model_short, model_long, optimizer_short, optimizer_long,
-                                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL))
+                                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL,
+                                            *teachers_batch))
                     else:
                         epoch_loss, ce_loss, penalty_loss, aux_loss, loss_short, loss_long, diff_loss = ( 
                             lwf_bimeco_train(old_model, auxiliary_network, model_short, model_long, optimizer_short, optimizer_long,
-                                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL))
+                                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL,
+                                            *teachers_batch))
 
-                    train_loss_epoch += epoch_loss
-                    ce_loss_epoch += ce_loss
-                    penalty_loss_epoch += penalty_loss
-                    auxiliar_loss_epoch += aux_loss
-                    short_loss_epoch += loss_short
-                    long_loss_epoch += loss_long
-                    diff_loss_epoch += diff_loss
+                    metrics.add("train", epoch_loss)
+                    metrics.add("ce", ce_loss)
+                    metrics.add("penalty", penalty_loss)
+                    metrics.add("aux", aux_loss)
+                    metrics.add("short", loss_short)
+                    metrics.add("long", loss_long)
+                    metrics.add("diff", diff_loss)
 
                 # Print the results of the epoch
+                totals = metrics.sums() # Single copy from the device
+                train_loss_epoch = totals["train"]
                 print(f"Train loss: {train_loss_epoch}")
-                print(f"Cross entropy loss: {ce_loss_epoch}")
-                print(f"Penalty loss: {penalty_loss_epoch}")
-                print(f"Auxiliary loss: {auxiliar_loss_epoch}")
-                print(f"Short term memory loss: {short_loss_epoch}")
-                print(f"Long term memory loss: {long_loss_epoch}")
-                print(f"Difference loss: {diff_loss_epoch}")
+                print(f"Cross entropy loss: {totals['ce']}")
+                print(f"Penalty loss: {totals['penalty']}")
+                print(f"Auxiliary loss: {totals['aux']}")
+                print(f"Short term memory loss: {totals['short']}")
+                print(f"Long term memory loss: {totals['long']}")
+                print(f"Difference loss: {totals['diff']}")
 
                 # Update the parameters of the long term memory model
                 # for param_l, param_s in zip(model_long.parameters() ,  model_short.parameters()):
@@ -314,8 +275,10 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
                 # Validation
                 val_loss_epoch = normal_val(model_long, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model_long, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model_long,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
                 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, val_loss_epoch,
@@ -336,7 +299,6 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -346,9 +308,12 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, device, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
 
         # Save the results of the task
         save_training_results(dicc_results, workbook, id_task+1, training_name="LwF-BiMeCo") 
@@ -358,55 +323,63 @@ def lwf_with_bimeco(datasets, args, aux_training=False, loss_ANCL=None):
 
         # Update memory buffer
         if id_task != args.num_tasks-1:
-            exemplar_set_img, exemplar_set_label, tasks_dict = after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, 
+            exemplar_memory, tasks_dict = after_train(model, exemplar_memory, train_dataset, 
                                                             device, id_task, args, img_channels, img_size, feature_dim, num_classes)
 
-            tensor_exem_img = torch.empty((0, img_channels, img_size, img_size)) # Tensor to save the exemplar set
-            tensor_exem_label = torch.empty((0), dtype=torch.long) # Tensor to save the exemplar set labels
-
-            for index in range(len(exemplar_set_img)):
-                tensor_exem_img = torch.cat((tensor_exem_img, torch.stack(exemplar_set_img[index])), dim=0) # Add the exemplar set to the tensor
-                tensor_exem_label = torch.cat((tensor_exem_label, torch.stack(exemplar_set_label[index])), dim=0) # Add the exemplar set labels to the tensor
-
-            # Make the dataloader
-            data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                           batch_size=args.batch_size,
-                                                           shuffle=True)
+            tensor_exem_img, tensor_exem_label = exemplar_memory.tensors() # Exemplar set (views of the memory)
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
     # Close the workbook
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
                      
+@timer.timed("train")
 def normal_train(model, optimizer, data_loader, device):
     model.train()
-    epoch_loss = 0
-    for input, target in data_loader:
+    metrics = Metrics()
+    for input, target in timer.loader(data_loader):
         input, target = input.to(device), target.to(device)
         optimizer.zero_grad()
         output = model(input)
         loss = F.cross_entropy(output, target)
-        epoch_loss += loss.item()
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    epoch_loss = metrics.mean("loss")
+    print(f"Train loss: {epoch_loss}")
+    return epoch_loss
 
+@timer.timed("validation")
 def normal_val(model, data_loader, device):
     model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = input.to(device), target.to(device)
             output = model(input)
-            loss += F.cross_entropy(output, target)
+            metrics.add("loss", F.cross_entropy(output, target))
+
 
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss.item() / len(data_loader)
+@timer.timed("teacher")
+def frozen_output(network, images, cached_logits=None):
+    """
+    Get the logits of a frozen network (old model or auxiliary network), from the teacher cache if available.
+    """
+    if cached_logits is not None:
+        return cached_logits.float()
+    with torch.no_grad():
+        return network(images)
 
+@timer.timed("train")
 def lwf_bimeco_train(old_model, auxiliary_network, model_short, model_long, optimizer_short, optimizer_long,
-                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL=None):
+                            images, labels, images_s, labels_s, images_l, labels_l, args, device, loss_ANCL=None,
+                            old_logits=None, aux_logits=None):
 
     model_short.train() # Set the model to training mode
     model_long.train() # Set the model to training mode
@@ -415,27 +388,29 @@ def lwf_bimeco_train(old_model, auxiliary_network, model_short, model_long, opti
     optimizer_short.zero_grad()
     optimizer_long.zero_grad()
 
+    # Get the outputs and the features of the models (one pass of the feature extractor per batch)
+    (model_pred, _), (long_pred, feat_long_images_l), (_, feat_long_images_s) = forward_batches(model_long, images,
+                                                                                              images_l, images_s)
+    (short_pred, feat_short_images_s), (_, feat_short_images_l) = forward_batches(model_short, images_s, images_l)
+
     # Get the outputs of the models (LwF)
-    model_pred = model_long(images)
-    old_model_pred = old_model(images)
+    old_model_pred = frozen_output(old_model, images, old_logits) # The old model is frozen
     penalty_lwf = F.kl_div(F.log_softmax(model_pred, dim=1), 
                            F.softmax(old_model_pred, dim=1), reduction="batchmean") # Penalty term
     
     if auxiliary_network is not None:
-        aux_model_pred = auxiliary_network(images)
+        aux_model_pred = frozen_output(auxiliary_network, images, aux_logits)
         penalty_aux_lwf = F.kl_div(F.log_softmax(model_pred, dim=1),
                                     F.softmax(aux_model_pred, dim=1), reduction="batchmean") # Penalty term
 
     # Get the outputs of the models (BiMeCo)
     # ce_loss = F.cross_entropy(model_pred, labels)
-    long_loss = F.cross_entropy(model_long(images_l), labels_l)
-    short_loss = F.cross_entropy(model_short(images_s), labels_s)
+    long_loss = F.cross_entropy(long_pred, labels_l)
+    short_loss = F.cross_entropy(short_pred, labels_s)
 
     # Compute the difference between the feature extractor outputs (BiMeCo)
-    diff_images_s = ((F.normalize(model_long.feature_extractor(images_s)) - 
-                      F.normalize(model_short.feature_extractor(images_s)))**2).sum()
-    diff_images_l = ((F.normalize(model_long.feature_extractor(images_l)) -
-                        F.normalize(model_short.feature_extractor(images_l)))**2).sum()
+    diff_images_s = ((F.normalize(feat_long_images_s) - F.normalize(feat_short_images_s))**2).sum()
+    diff_images_l = ((F.normalize(feat_long_images_l) - F.normalize(feat_short_images_l))**2).sum()
     diff = 0.5 * (diff_images_s + diff_images_l) 
 
     # Compute the overall loss (LwF and BiMeCo)
@@ -462,13 +437,14 @@ def lwf_bimeco_train(old_model, auxiliary_network, model_short, model_long, opti
         loss = (loss_criterion + args.bimeco_lambda_short * short_loss + 
                 args.bimeco_lambda_long * long_loss + args.bimeco_lambda_diff * diff)
     
-    epoch_loss = loss.item() # Compute the loss
-    ce_loss = 0 # ce_loss = ce_loss.item() 
-    penalty_lwf_loss = penalty_lwf.item() * args.lwf_lambda
-    penalty_aux_lwf = penalty_aux_lwf.item() * args.lwf_aux_lambda if auxiliary_network is not None else 0
-    loss_short = short_loss.item() * args.bimeco_lambda_short
-    loss_long = long_loss.item() * args.bimeco_lambda_long
-    diff_loss = diff.item() * args.bimeco_lambda_diff
+    # Values to log, kept on the device (summed with utils.metrics)
+    epoch_loss = loss.detach() # Compute the loss
+    ce_loss = 0 # ce_loss = ce_loss.detach() 
+    penalty_lwf_loss = penalty_lwf.detach() * args.lwf_lambda
+    penalty_aux_lwf = penalty_aux_lwf.detach() * args.lwf_aux_lambda if auxiliary_network is not None else 0
+    loss_short = short_loss.detach() * args.bimeco_lambda_short
+    loss_long = long_loss.detach() * args.bimeco_lambda_long
+    diff_loss = diff.detach() * args.bimeco_lambda_diff
     
     loss.backward() # Backward pass
 
@@ -561,30 +537,32 @@ def test(model, datasets, device, args):
     test_task_list = []  # List to save the results of the task
     test_loss_list = []  # List to save the test loss
     test_acc_list = []  # List to save the test accuracy
+    test_confusion_list = []  # List to save the confusion matrices
 
     for id_task_test, task in enumerate(datasets):
-        test_loss, correct, accuracy = 0, 0, 0
+        metrics = Metrics() # Test loss and correct predictions, summed on the device
 
         _, _, test_dataset = task  # Get the images and labels from the task
 
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                  batch_size=args.batch_size,
-                                                  shuffle=False)
-        with torch.no_grad():
-            for input, target in test_loader:
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
+        with torch.inference_mode():
+            for input, target in test_batches:
                 input, target = input.to(device), target.to(device)
                 output = model(input)
-                test_loss += F.cross_entropy(output, target, reduction="sum").item()
-                correct += (F.softmax(output, dim=1).max(dim=1)[1] == target).sum().item()
+                metrics.add("loss", F.cross_entropy(output, target, reduction="sum"), target.size(0))
+                metrics.add_correct("accuracy", output, target)
+                metrics.add_confusion("confusion", output, target)
 
-        test_loss /= len(test_loader.dataset)
+        means = metrics.means() # Single copy from the device
+        test_loss = means["loss"]
 
-        accuracy = 100. * correct / len(test_loader.dataset)
+        accuracy = 100. * means["accuracy"]
         avg_acc += accuracy
 
         test_task_list.append(id_task_test+1)
         test_loss_list.append(test_loss)
         test_acc_list.append(accuracy)
+        test_confusion_list.append(means["confusion"])
 
         print(f"Test on task {id_task_test+1}: Average loss: {test_loss:.6f}, "
               f"Accuracy: {accuracy:.2f}%")
@@ -592,7 +570,7 @@ def test(model, datasets, device, args):
     avg_acc /= len(datasets)
     print(f"Average accuracy: {avg_acc:.2f}%")
 
-    return test_task_list, test_loss_list, test_acc_list, avg_acc
+    return test_task_list, test_loss_list, test_acc_list, avg_acc, test_confusion_list
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
                    test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
@@ -623,25 +601,8 @@ def criterion(model_pred, targets, old_model_pred, aux_model_pred, lwf_lambda, l
     return loss 
     # return loss + F.cross_entropy(model_pred, targets)
 
-def cross_entropy(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
-    # print(outputs.shape)
-    # print(targets.shape)
-    out = torch.nn.functional.softmax(outputs, dim=1)
-    tar = torch.nn.functional.softmax(targets, dim=1)
-    if exp != 1:
-        out = out.pow(exp)
-        out = out / out.sum(1).view(-1, 1).expand_as(out)
-        tar = tar.pow(exp)
-        tar = tar / tar.sum(1).view(-1, 1).expand_as(tar)
-    out = out + eps / out.size(1)
-    out = out / out.sum(1).view(-1, 1).expand_as(out)
-    ce = -(tar * out.log()).sum(1)
-    if size_average:
-        ce = ce.mean()
-        # print(ce.shape)
-    return ce    
-
-def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, device, id_task, args,
+@timer.timed("after_train")
+def after_train(model, exemplar_memory, train_dataset, device, id_task, args,
                 img_channels, img_size, feature_dim, num_classes):
     """
     Construct exemplar sets for each task using the iCaRL strategy.
@@ -652,12 +613,11 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
 
     model.eval() # Set the model to evaluation mode
 
-    m = int(args.memory_size / num_classes)  # Number of exemplars per class
+    m = int(exemplar_memory.capacity / num_classes)  # Number of exemplars per class
 
     # Reduce exemplar set to the maximum size
-    exemplar_set_img = [cls[:m] for cls in exemplar_set_img]
-    exemplar_set_label = [cls[:m] for cls in exemplar_set_label]
-    print(f"Size of class {index} exemplar: {len(exemplar_set_img[index])}" for index in range(len(exemplar_set_img)))
+    exemplar_memory.reduce(m)
+    print(f"Size of the exemplar set after the reduction: {len(exemplar_memory)}")
 
     if args.dataset == "cifar100-alternative-dist":
         # Create the tasks dictionary to know the classes of each task
@@ -675,63 +635,17 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
     classes_task = [cls for cls in tasks_dict[id_task]]
     print(f"Creating the exemplar set for classes: {classes_task}")
 
-    # Create the exemplar set
-    images_ex = torch.empty((0, img_channels, img_size, img_size))
-    labels_ex = torch.empty((0), dtype=torch.long)
-
-    # Assuming train_dataset is a list of tuples (image, label)
-    train_images, train_labels = zip(*train_dataset)
-    train_images = torch.stack(train_images)
-    train_labels = torch.stack(train_labels)
+    # Select the exemplars of the classes of the current task (slices of the cached herding rankings)
+    train_images, train_labels = train_dataset.tensors
+    selection = herding_ranking(model, train_images, train_labels, classes_task, m, device, args)
 
     for class_index in classes_task:
-        exit = False
-        selected_indexes = torch.where(train_labels == class_index)[0]
-        images_ex = torch.cat((images_ex, train_images[selected_indexes]), dim=0)
-        labels_ex = torch.cat((labels_ex, train_labels[selected_indexes]), dim=0)
-
-        # Construct the exemplar set
-        feature_extractor_output = F.normalize(model.feature_extractor(images_ex.to(device))).cpu().detach().numpy()
-        class_mean = np.mean(feature_extractor_output, axis=0)
-
-        exemplar_img = [] # List to save the exemplar set
-        exemplar_label = [] # List to save the exemplar set labels
-        now_class_mean = np.zeros((1, feature_dim)) # Current class mean
-
-        selected_indexes = set() # Set to save the selected indexes
-        # Construct the exemplar set
-        for k in range(m):
-            x = class_mean - (feature_extractor_output + now_class_mean) / (k + 1) # Equation 4
-            x = np.linalg.norm(x, axis=1)
-
-            index = np.argmin(x) # Equation 5  
-
-            if index in selected_indexes:
-                while index in selected_indexes:
-                    if len(x) == len(selected_indexes):
-                        print(f"All the images have been selected for class {class_index}")
-                        exit = True
-                        break
-                    x[index] = np.inf
-                    index = np.argmin(x)
-                selected_indexes.add(index)
-            
-            if exit:
-                break
-
-            now_class_mean += feature_extractor_output[index] # Update the current class mean
-            exemplar_img.append(images_ex[index]) # Add the exemplar to the exemplar set
-            exemplar_label.append(labels_ex[index]) # Add the exemplar label to the exemplar set labels
-            selected_indexes.add(index) # Add the index to the set
-
-        exemplar_set_img.append(exemplar_img) # Add the exemplar set to the exemplar set list
-        exemplar_set_label.append(exemplar_label) # Add the exemplar set labels to the exemplar set labels list
-        images_ex = torch.empty((0, img_channels, img_size, img_size))
-        labels_ex = torch.empty((0), dtype=torch.long) # Reset the labels variable
-        print(f"Class {class_index} exemplar set size: {len(exemplar_set_img[class_index])}")
+        # Add the exemplars of the class to the memory
+        exemplar_memory.add(class_index, train_images[selection[class_index]], train_labels[selection[class_index]])
+        print(f"Class {class_index} exemplar set size: {exemplar_memory.class_size(class_index)}")
 
     print(f"Number of exemplars per class: {m}")
     print(f"Number of classes in the current task: {len(classes_task)}")
-    print(f"Total size of the exemplar set images: {sum([len(exemplar_set_img[i]) for i in range(len(exemplar_set_img))])}")
+    print(f"Total size of the exemplar set images: {len(exemplar_memory)}")
 
-    return exemplar_set_img, exemplar_set_label, tasks_dict   
+    return exemplar_memory, tasks_dict
@@ -5,12 +5,22 @@ import torch.optim as optim
 import xlsxwriter
 import sys
 import copy
-import numpy as np
 
 sys.path.append('../')
 
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler, eval_batches
+from utils.metrics import Metrics
+from utils.teacher_cache import teacher_logits, with_teacher_logits
+from utils.replay_sampler import ReplaySampler, MixedBatch
+from utils.herding import herding_ranking
+from utils.exemplar_memory import ExemplarMemory
+from utils.exemplar_codecs import make_codec, memory_capacity
+
+from methods.distillation import cross_entropy
+from methods.auxiliary_network import auxiliary_network_training
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
@@ -43,11 +53,10 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
     # Create the workbook and worksheet to save the results
     workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
     test_acc_final = []  # List to save the average accuracy of each task
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed)  # Set the seed
 
-    exemplar_set_img = []  # List to save the exemplar set
-    exemplar_set_label = []  # List to save the exemplar set labels
 
     # Create the excel file
     if args.dataset == "mnist":
@@ -69,9 +78,20 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
         img_channels = 3
         feature_dim = 2048 #1024
 
+    # Memory to save the exemplar set (images and labels)
+    codec = make_codec(args, (img_channels, img_size, img_size), num_classes) # Storage of the exemplars
+    exemplar_memory = ExemplarMemory(memory_capacity(args, codec, num_classes), (img_channels, img_size, img_size), 
+                                     codec=codec)
+    print(f"Exemplar memory: {exemplar_memory.capacity} exemplars ({args.exemplar_codec}, "
+          f"{exemplar_memory.nbytes() / 2**20:.1f} MB of codes and labels)")
+
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, device, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
         
@@ -92,11 +112,12 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
                                                 batch_size=args.batch_size,
                                                 shuffle=True)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                                batch_size=args.batch_size,
-                                                shuffle=True)      
+                                                batch_size=args.eval_batch_size,
+                                                shuffle=False)      
         if id_task == 0:
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
@@ -106,8 +127,10 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, val_loss_epoch, 
@@ -128,7 +151,6 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -138,62 +160,14 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
-
         else:
 
             if aux_training:
-                patience_aux = args.lr_patience # Patience for early stopping
-                lr_aux = args.lr # Learning rate
-                best_val_loss_aux = 1e20 # Validation loss of the previous epoch
-                auxiliary_network = copy.deepcopy(model_best)
-                optimizer_aux = optim.Adam(auxiliary_network.parameters(), lr=args.lr)  # Instantiate the optimizer
-
-                for epoch in range(args.epochs):
-                    print("="*100)
-                    print("Train the auxiliary network...")
-                    print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
-
-                    normal_train(auxiliary_network, optimizer_aux, train_loader, device)
-                    val_loss_epoch_aux = normal_val(auxiliary_network, val_loader, device)
-                    test(auxiliary_network, datasets, device, args)
-
-                    # Early stopping
-                    if val_loss_epoch_aux < best_val_loss_aux:
-                        best_val_loss_aux = val_loss_epoch_aux
-                        patience_aux = args.lr_patience
-                        model_best_aux = copy.deepcopy(auxiliary_network)
-                    else:
-                        # if the loss does not go down, decrease patience
-                        patience_aux -= 1
-                        if patience_aux <= 0:
-                            # if it runs out of patience, reduce the learning rate
-                            lr_aux /= args.lr_decay
-                            print(' lr={:.1e}'.format(lr), end='')
-                            if lr_aux < args.lr_min:
-                                # if the lr decreases below minimum, stop the training session
-                                print()
-                                #test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
-                                break
-                            # reset patience and recover best model so far to continue training
-                            patience_aux = args.lr_patience
-                            for param_group in optimizer_aux.param_groups:
-                                param_group['lr'] = lr_aux
-                            auxiliary_network.load_state_dict(model_best_aux.state_dict())
-                    
-                    print(f"Current learning rate: {optimizer_aux.param_groups[0]['lr']}, Patience: {patience_aux}")
-
-                    if epoch == args.epochs-1:
-                        auxiliary_network = copy.deepcopy(model_best_aux).to(device)
-                        
+                # Train the auxiliary network (or load it, if it was already trained from the same checkpoint)
+                auxiliary_network = auxiliary_network_training(model_best, train_dataset, val_dataset, args, device,
+                                                               id_task, method_print)
                 torch.save(auxiliary_network.state_dict(), (f"./models/models_saved/{args.exp_name}/{method_cl}_{args.dataset}/"
-                                                              f"AuxNetwork-task{str([id_task+1])}.pt"))
-            
-                auxiliary_network.eval()
-                for param in auxiliary_network.parameters():
-                    param.requires_grad = False
+                                                           f"AuxNetwork-task{str([id_task+1])}.pt"))
 
             # Prepare the old model
             tasks_id = [x for x in range(1,id_task+1)]
@@ -211,58 +185,72 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
             for param in old_model.parameters():
                 param.requires_grad = False
             
-            data_loader_exem_iter = iter(data_loader_exem)
+            dataset_exem = torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label)
+            if args.teacher_cache != "off":
+                # The teachers see the decoded exemplars, as in training
+                images_exem = torch.utils.data.TensorDataset(exemplar_memory.decode(tensor_exem_img, tensor_exem_label), 
+                                                             tensor_exem_label)
+                name_exem = f"task{id_task+1}-exemplars-{args.exemplar_codec}"
+                # The teachers are frozen, so their logits are computed once and loaded with each batch
+                teachers_train = [teacher_logits(old_model, train_dataset, f"task{id_task+1}-train", device, args)]
+                teachers_exem = [teacher_logits(old_model, images_exem, name_exem, device, args)]
+                if aux_training:
+                    teachers_train.append(teacher_logits(auxiliary_network, train_dataset, 
+                                                         f"task{id_task+1}-train", device, args))
+                    teachers_exem.append(teacher_logits(auxiliary_network, images_exem, name_exem, device, args))
+                train_loader = torch.utils.data.DataLoader(dataset=with_teacher_logits(train_dataset, *teachers_train),
+                                                           batch_size=args.batch_size,
+                                                           shuffle=True)
+                dataset_exem = with_teacher_logits(dataset_exem, *teachers_exem)
+
+            # Sampler of the exemplars on the device and preallocated buffer of the mixed batches
+            sampler_exem = ReplaySampler(dataset_exem.tensors, device, replacement=args.replay_replacement,
+                                         class_balanced=args.replay_class_balanced, codec=exemplar_memory.codec)
+            batch_concat = MixedBatch(device)
 
             for epoch in range(args.epochs):
+                timer.epoch(epoch)
                 print("="*100)
                 print(f"METHOD: {method_print} (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
 
-                train_loss_epoch = 0
-                ce_loss_epoch, penalty_loss_epoch, auxiliar_loss_epoch = 0, 0, 0
+                metrics = Metrics() # Losses of the epoch, summed on the device
                 
                 # Sample a batch of data from train_dataloader_s
-                for images, labels in train_loader:
-
-                    # Sample two different batches from data_loader_exem
-                    try:
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-                    except StopIteration:
-                        data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                                    batch_size=args.batch_size,
-                                                                    shuffle=True)
-                        data_loader_exem_iter = iter(data_loader_exem)
-                        images_exem_1, labels_exem_1 = next(data_loader_exem_iter)
-
-                    # Concatenate the images and labels of the first batch from data_loader_exem
-                    images_concat = torch.cat((images, images_exem_1), dim=0).to(device)
-                    labels_concat = torch.cat((labels, labels_exem_1), dim=0).to(device)
+                for batch in timer.loader(train_loader):
+
+                    # Concatenate the images, labels (and cached logits of the teachers) with a batch of exemplars
+                    images_concat, labels_concat, *teachers_concat = batch_concat.fill(batch, (sampler_exem, args.batch_size))
 
                     # Forward pass
                     if not aux_training:
                         epoch_loss, ce_loss, lwf_loss, aux_loss = (lwf_membuffer(model, old_model, None, optimizer, 
                                                                                     images_concat, labels_concat, args, 
-                                                                                    loss_ANCL))
+                                                                                    loss_ANCL, *teachers_concat))
                     else:
                         epoch_loss, ce_loss, lwf_loss, aux_loss = (lwf_membuffer(model, old_model, auxiliary_network, 
                                                                                     optimizer, images_concat, labels_concat, 
-                                                                                    args, loss_ANCL))
+                                                                                    args, loss_ANCL, *teachers_concat))
 
-                    train_loss_epoch += epoch_loss
-                    ce_loss_epoch += ce_loss
-                    penalty_loss_epoch += lwf_loss
-                    auxiliar_loss_epoch += aux_loss
+                    metrics.add("train", epoch_loss)
+                    metrics.add("ce", ce_loss)
+                    metrics.add("penalty", lwf_loss)
+                    metrics.add("aux", aux_loss)
 
                 # Print the results of the epoch
+                totals = metrics.sums() # Single copy from the device
+                train_loss_epoch = totals["train"]
                 print(f"Train loss: {train_loss_epoch}")
-                print(f"Cross entropy loss: {ce_loss_epoch}")
-                print(f"Penalty loss: {penalty_loss_epoch}")
-                print(f"Auxiliary loss: {auxiliar_loss_epoch}")
+                print(f"Cross entropy loss: {totals['ce']}")
+                print(f"Penalty loss: {totals['penalty']}")
+                print(f"Auxiliary loss: {totals['aux']}")
 
                 # Validation
                 val_loss_epoch = normal_val(model, val_loader, device)
 
-                # Test
-                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test(model, datasets, device, args)
+                # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+                test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                    id_task, epoch, dicc_results, model,
+                    lambda eval_model, eval_datasets: test(eval_model, eval_datasets, device, args))
                 
                 # Append the results to dicc_results
                 dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, val_loss_epoch,
@@ -283,7 +271,6 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
                         if lr < args.lr_min:
                             # if the lr decreases below minimum, stop the training session
                             print()
-                            test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                             break
                         # reset patience and recover best model so far to continue training
                         patience = args.lr_patience
@@ -293,9 +280,12 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
 
                 print(f"Current learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
-                # Save the results of the epoch if it is the last epoch
-                if epoch == args.epochs-1:
-                    test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, device, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
 
         # Save the results of the task
         save_training_results(dicc_results, workbook, id_task+1, training_name="LwF-BiMeCo") 
@@ -305,68 +295,75 @@ def lwf_with_membuffer(datasets, args, aux_training=False, loss_ANCL=None):
 
         # Update memory buffer
         if id_task != args.num_tasks-1:
-            exemplar_set_img, exemplar_set_label, tasks_dict = after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, 
+            exemplar_memory, tasks_dict = after_train(model, exemplar_memory, train_dataset, 
                                                             device, id_task, args, img_channels, img_size, feature_dim, num_classes)
 
-            tensor_exem_img = torch.empty((0, img_channels, img_size, img_size)) # Tensor to save the exemplar set
-            tensor_exem_label = torch.empty((0), dtype=torch.long) # Tensor to save the exemplar set labels
-
-            for index in range(len(exemplar_set_img)):
-                tensor_exem_img = torch.cat((tensor_exem_img, torch.stack(exemplar_set_img[index])), dim=0) # Add the exemplar set to the tensor
-                tensor_exem_label = torch.cat((tensor_exem_label, torch.stack(exemplar_set_label[index])), dim=0) # Add the exemplar set labels to the tensor
-
-            # Make the dataloader
-            data_loader_exem = torch.utils.data.DataLoader(dataset=torch.utils.data.TensorDataset(tensor_exem_img, tensor_exem_label),
-                                                           batch_size=args.batch_size,
-                                                           shuffle=True)
+            tensor_exem_img, tensor_exem_label = exemplar_memory.tensors() # Exemplar set (views of the memory)
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
     # Close the workbook
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
                      
+@timer.timed("train")
 def normal_train(model, optimizer, data_loader, device):
     model.train()
-    epoch_loss = 0
-    for input, target in data_loader:
+    metrics = Metrics()
+    for input, target in timer.loader(data_loader):
         input, target = input.to(device), target.to(device)
         optimizer.zero_grad()
         output = model(input)
         loss = F.cross_entropy(output, target)
-        epoch_loss += loss.item()
+        metrics.add("loss", loss)
         loss.backward()
         optimizer.step()
 
-    print(f"Train loss: {epoch_loss / len(data_loader)}")
-    return epoch_loss / len(data_loader)
+    epoch_loss = metrics.mean("loss")
+    print(f"Train loss: {epoch_loss}")
+    return epoch_loss
 
+@timer.timed("validation")
 def normal_val(model, data_loader, device):
     model.eval()
-    loss = 0
-    with torch.no_grad():
+    metrics = Metrics()
+    with torch.inference_mode():
         for input, target in data_loader:
             input, target = input.to(device), target.to(device)
             output = model(input)
-            loss += F.cross_entropy(output, target)
+            metrics.add("loss", F.cross_entropy(output, target))
+
 
+    loss = metrics.mean("loss")
+    print(f"Val loss: {loss}")
+    return loss
 
-    print(f"Val loss: {loss / len(data_loader)}")
-    return loss.item() / len(data_loader)
+@timer.timed("teacher")
+def frozen_output(network, images, cached_logits=None):
+    """
+    Get the logits of a frozen network (old model or auxiliary network), from the teacher cache if available.
+    """
+    if cached_logits is not None:
+        return cached_logits.float()
+    with torch.no_grad():
+        return network(images)
 
+@timer.timed("train")
 def lwf_membuffer(model, old_model, auxiliary_network, optimizer, images_concat, labels_concat, 
-                     args, loss_ANCL=None):
+                     args, loss_ANCL=None, old_logits=None, aux_logits=None):
 
     model.train() # Set the model to training mode
     optimizer.zero_grad() # Clear the gradients
 
     # Get the outputs of the models (LwF)
-    ce_loss = F.cross_entropy(model(images_concat), labels_concat) # Cross-entropy loss
     model_pred = model(images_concat)
-    old_model_pred = old_model(images_concat)
+    ce_loss = F.cross_entropy(model_pred, labels_concat) # Cross-entropy loss
+    old_model_pred = frozen_output(old_model, images_concat, old_logits) # The old model is frozen
     penalty_lwf = F.kl_div(F.log_softmax(model_pred, dim=1), 
                            F.softmax(old_model_pred, dim=1), reduction="batchmean") # Penalty term
     
     if auxiliary_network is not None:
-        aux_model_pred = auxiliary_network(images_concat)
+        aux_model_pred = frozen_output(auxiliary_network, images_concat, aux_logits)
         penalty_aux_lwf = F.kl_div(F.log_softmax(model_pred, dim=1),
                                     F.softmax(aux_model_pred, dim=1), reduction="batchmean") # Penalty term
 
@@ -386,10 +383,11 @@ def lwf_membuffer(model, old_model, auxiliary_network, optimizer, images_concat,
             loss = criterion(model_pred, labels_concat, old_model_pred, None,
                                         args.lwf_lambda, None, task=1)
                 
-    epoch_loss = loss.item() # Compute the loss
-    ce_loss = ce_loss.item() # Compute the cross-entropy loss
-    lwf_loss = penalty_lwf.item() * args.lwf_lambda # Compute the LwF loss
-    aux_loss = penalty_aux_lwf.item() * args.lwf_aux_lambda if auxiliary_network is not None else 0 # Compute the auxiliary loss
+    # Values to log, kept on the device (summed with utils.metrics)
+    epoch_loss = loss.detach() # Compute the loss
+    ce_loss = ce_loss.detach() # Compute the cross-entropy loss
+    lwf_loss = penalty_lwf.detach() * args.lwf_lambda # Compute the LwF loss
+    aux_loss = penalty_aux_lwf.detach() * args.lwf_aux_lambda if auxiliary_network is not None else 0 # Compute the auxiliary loss
     
     loss.backward() # Backward pass
     optimizer.step() # Update the weights
@@ -406,30 +404,32 @@ def test(model, datasets, device, args):
     test_task_list = []  # List to save the results of the task
     test_loss_list = []  # List to save the test loss
     test_acc_list = []  # List to save the test accuracy
+    test_confusion_list = []  # List to save the confusion matrices
 
     for id_task_test, task in enumerate(datasets):
-        test_loss, correct, accuracy = 0, 0, 0
+        metrics = Metrics() # Test loss and correct predictions, summed on the device
 
         _, _, test_dataset = task  # Get the images and labels from the task
 
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                  batch_size=args.batch_size,
-                                                  shuffle=False)
-        with torch.no_grad():
-            for input, target in test_loader:
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
+        with torch.inference_mode():
+            for input, target in test_batches:
                 input, target = input.to(device), target.to(device)
                 output = model(input)
-                test_loss += F.cross_entropy(output, target, reduction="sum").item()
-                correct += (F.softmax(output, dim=1).max(dim=1)[1] == target).sum().item()
+                metrics.add("loss", F.cross_entropy(output, target, reduction="sum"), target.size(0))
+                metrics.add_correct("accuracy", output, target)
+                metrics.add_confusion("confusion", output, target)
 
-        test_loss /= len(test_loader.dataset)
+        means = metrics.means() # Single copy from the device
+        test_loss = means["loss"]
 
-        accuracy = 100. * correct / len(test_loader.dataset)
+        accuracy = 100. * means["accuracy"]
         avg_acc += accuracy
 
         test_task_list.append(id_task_test+1)
         test_loss_list.append(test_loss)
         test_acc_list.append(accuracy)
+        test_confusion_list.append(means["confusion"])
 
         print(f"Test on task {id_task_test+1}: Average loss: {test_loss:.6f}, "
               f"Accuracy: {accuracy:.2f}%")
@@ -437,7 +437,7 @@ def test(model, datasets, device, args):
     avg_acc /= len(datasets)
     print(f"Average accuracy: {avg_acc:.2f}%")
 
-    return test_task_list, test_loss_list, test_acc_list, avg_acc
+    return test_task_list, test_loss_list, test_acc_list, avg_acc, test_confusion_list
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
                    test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
@@ -468,25 +468,8 @@ def criterion(model_pred, targets, old_model_pred, aux_model_pred, lwf_lambda, l
     return loss + F.cross_entropy(model_pred, targets)
     # return loss 
 
-def cross_entropy(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
-    # print(outputs.shape)
-    # print(targets.shape)
-    out = torch.nn.functional.softmax(outputs, dim=1)
-    tar = torch.nn.functional.softmax(targets, dim=1)
-    if exp != 1:
-        out = out.pow(exp)
-        out = out / out.sum(1).view(-1, 1).expand_as(out)
-        tar = tar.pow(exp)
-        tar = tar / tar.sum(1).view(-1, 1).expand_as(tar)
-    out = out + eps / out.size(1)
-    out = out / out.sum(1).view(-1, 1).expand_as(out)
-    ce = -(tar * out.log()).sum(1)
-    if size_average:
-        ce = ce.mean()
-        # print(ce.shape)
-    return ce    
-
-def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, device, id_task, args,
+@timer.timed("after_train")
+def after_train(model, exemplar_memory, train_dataset, device, id_task, args,
                 img_channels, img_size, feature_dim, num_classes):
     """
     Construct exemplar sets for each task using the iCaRL strategy.
@@ -497,12 +480,11 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
 
     model.eval() # Set the model to evaluation mode
 
-    m = int(args.memory_size / num_classes)  # Number of exemplars per class
+    m = int(exemplar_memory.capacity / num_classes)  # Number of exemplars per class
 
     # Reduce exemplar set to the maximum size
-    exemplar_set_img = [cls[:m] for cls in exemplar_set_img]
-    exemplar_set_label = [cls[:m] for cls in exemplar_set_label]
-    print(f"Size of class {index} exemplar: {len(exemplar_set_img[index])}" for index in range(len(exemplar_set_img)))
+    exemplar_memory.reduce(m)
+    print(f"Size of the exemplar set after the reduction: {len(exemplar_memory)}")
 
     if args.dataset == "cifar100-alternative-dist":
         # Create the tasks dictionary to know the classes of each task
@@ -520,63 +502,17 @@ def after_train(model, exemplar_set_img, exemplar_set_label, train_dataset, devi
     classes_task = [cls for cls in tasks_dict[id_task]]
     print(f"Creating the exemplar set for classes: {classes_task}")
 
-    # Create the exemplar set
-    images_ex = torch.empty((0, img_channels, img_size, img_size))
-    labels_ex = torch.empty((0), dtype=torch.long)
-
-    # Assuming train_dataset is a list of tuples (image, label)
-    train_images, train_labels = zip(*train_dataset)
-    train_images = torch.stack(train_images)
-    train_labels = torch.stack(train_labels)
+    # Select the exemplars of the classes of the current task (slices of the cached herding rankings)
+    train_images, train_labels = train_dataset.tensors
+    selection = herding_ranking(model, train_images, train_labels, classes_task, m, device, args)
 
     for class_index in classes_task:
-        exit = False
-        selected_indexes = torch.where(train_labels == class_index)[0]
-        images_ex = torch.cat((images_ex, train_images[selected_indexes]), dim=0)
-        labels_ex = torch.cat((labels_ex, train_labels[selected_indexes]), dim=0)
-
-        # Construct the exemplar set
-        feature_extractor_output = F.normalize(model.feature_extractor(images_ex.to(device))).cpu().detach().numpy()
-        class_mean = np.mean(feature_extractor_output, axis=0)
-
-        exemplar_img = [] # List to save the exemplar set
-        exemplar_label = [] # List to save the exemplar set labels
-        now_class_mean = np.zeros((1, feature_dim)) # Current class mean
-
-        selected_indexes = set() # Set to save the selected indexes
-        # Construct the exemplar set
-        for k in range(m):
-            x = class_mean - (feature_extractor_output + now_class_mean) / (k + 1) # Equation 4
-            x = np.linalg.norm(x, axis=1)
-
-            index = np.argmin(x) # Equation 5  
-
-            if index in selected_indexes:
-                while index in selected_indexes:
-                    if len(x) == len(selected_indexes):
-                        print(f"All the images have been selected for class {class_index}")
-                        exit = True
-                        break
-                    x[index] = np.inf
-                    index = np.argmin(x)
-                selected_indexes.add(index)
-            
-            if exit:
-                break
-
-            now_class_mean += feature_extractor_output[index] # Update the current class mean
-            exemplar_img.append(images_ex[index]) # Add the exemplar to the exemplar set
-            exemplar_label.append(labels_ex[index]) # Add the exemplar label to the exemplar set labels
-            selected_indexes.add(index) # Add the index to the set
-
-        exemplar_set_img.append(exemplar_img) # Add the exemplar set to the exemplar set list
-        exemplar_set_label.append(exemplar_label) # Add the exemplar set labels to the exemplar set labels list
-        images_ex = torch.empty((0, img_channels, img_size, img_size))
-        labels_ex = torch.empty((0), dtype=torch.long) # Reset the labels variable
-        print(f"Class {class_index} exemplar set size: {len(exemplar_set_img[class_index])}")
+        # Add the exemplars of the class to the memory
+        exemplar_memory.add(class_index, train_images[selection[class_index]], train_labels[selection[class_index]])
+        print(f"Class {class_index} exemplar set size: {exemplar_memory.class_size(class_index)}")
 
     print(f"Number of exemplars per class: {m}")
     print(f"Number of classes in the current task: {len(classes_task)}")
-    print(f"Total size of the exemplar set images: {sum([len(exemplar_set_img[i]) for i in range(len(exemplar_set_img))])}")
+    print(f"Total size of the exemplar set images: {len(exemplar_memory)}")
 
-    return exemplar_set_img, exemplar_set_label, tasks_dict   
+    return exemplar_memory, tasks_dict
@@ -7,8 +7,11 @@ import sys
 import copy
 
 sys.path.append('../')
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler, eval_batches
+from utils.metrics import Metrics
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
@@ -24,6 +27,7 @@ def naive_training(datasets, args, joint_datasets=False):
     :param joint_datasets: boolean to indicate if we are training with joint datasets or not
     
     :return: test_acc_final: list to save the test accuracy of each task and the test average accuracy
+             costs: cost of each task (EvalScheduler.costs)
     """
     print("\n")
     print("="*100)
@@ -55,6 +59,7 @@ def naive_training(datasets, args, joint_datasets=False):
 
     workbook = xlsxwriter.Workbook(path_file) # Create the excel file
     test_acc_final = [] # List to save the test accuracy of each task and the test average accuracy
+    eval_scheduler = EvalScheduler(datasets, args, train_datasets=datasets_train) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed) # Set the seed
 
@@ -68,7 +73,11 @@ def naive_training(datasets, args, joint_datasets=False):
         
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test_epoch(model, device, eval_datasets, args))
+
     for id_task, task in enumerate(datasets_train):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
 
@@ -89,10 +98,11 @@ def naive_training(datasets, args, joint_datasets=False):
                                                    batch_size=args.batch_size,
                                                    shuffle=True)
         val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                                    batch_size=args.batch_size,
-                                                    shuffle=True)
+                                                    batch_size=args.eval_batch_size,
+                                                    shuffle=False)
         
         for epoch in range(args.epochs):
+            timer.epoch(epoch)
             print("="*100)
             if joint_datasets:
                 print(f"METHOD: Joint-training (Experiment: {args.exp_name}) -> Train on task: {id_task+1}, Epoch: {epoch+1}")
@@ -105,11 +115,10 @@ def naive_training(datasets, args, joint_datasets=False):
             # Validation 
             val_loss_epoch = val_epoch(model, device, val_loader, id_task+1)
 
-            # Test
-            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test_epoch(model, 
-                                                                                           device, 
-                                                                                           datasets, 
-                                                                                           args)
+            # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                id_task, epoch, dicc_results, model,
+                lambda eval_model, eval_datasets: test_epoch(eval_model, device, eval_datasets, args))
 
             # Append the results to dicc_results
             dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -131,8 +140,6 @@ def naive_training(datasets, args, joint_datasets=False):
                     if lr < args.lr_min:
                         # if the lr decreases below minimum, stop the training session
                         print()
-                        # Append the test accuracy of each task and the test average accuracy
-                        test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                         break
                     # reset patience and recover best model so far to continue training
                     patience = args.lr_patience
@@ -140,13 +147,16 @@ def naive_training(datasets, args, joint_datasets=False):
                         param_group['lr'] = lr
                     model.load_state_dict(model_best.state_dict())
             
-            # Save the results of the epoch if it is the last epoch
-            if epoch == args.epochs-1:
-                # Append the test accuracy of each task and the test average accuracy
-                test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
 
             print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test_epoch(model_best, device, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+
         if not joint_datasets:
             # Save the model
             save_model(model_best, args, id_task+1, method="fine-tuning", joint_datasets=False)
@@ -160,20 +170,24 @@ def naive_training(datasets, args, joint_datasets=False):
             # Save the results of the task
             save_training_results(dicc_results, workbook, id_task+1, training_name="joint-datasets")
 
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
+
     # Close the excel file
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
 
 
+@timer.timed("train")
 def train_epoch(model, device, train_loader, optimizer, id_task):
 
     # Training
     model.train() # Set the model to training mode
 
-    train_loss_accum = 0 # Training loss
+    metrics = Metrics() # Training loss, summed on the device
 
-    for images, targets in train_loader:
+    for images, targets in timer.loader(train_loader):
         # Move tensors to the configured device
         images = images.to(device)
         targets = targets.to(device)
@@ -186,7 +200,7 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
 
         # Calculate the loss
         train_loss = F.cross_entropy(outputs, targets)
-        train_loss_accum += train_loss.item()
+        metrics.add("loss", train_loss)
 
         # Backward pass
         train_loss.backward()
@@ -194,7 +208,7 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
         # Optimize
         optimizer.step()
    
-    train_loss_epoch = train_loss_accum/len(train_loader) # Training loss
+    train_loss_epoch = metrics.mean("loss") # Training loss
 
     # Print the metrics
     print(f"Train on task {id_task} -> Loss: {train_loss_epoch}")
@@ -204,14 +218,15 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
 
 
 
+@timer.timed("validation")
 def val_epoch(model, device, val_loader, id_task):
 
     # Validation
     model.eval() # Set the model to evaluation mode
 
-    val_loss_epoch = 0
+    metrics = Metrics() # Validation loss, summed on the device
             
-    with torch.no_grad():
+    with torch.inference_mode():
         for images, targets in val_loader:
             # Move tensors to the configured device
             images = images.to(device)
@@ -221,9 +236,9 @@ def val_epoch(model, device, val_loader, id_task):
             outputs = model(images)
 
             # Calculate the loss
-            val_loss_epoch += F.cross_entropy(outputs, targets).item()
+            metrics.add("loss", F.cross_entropy(outputs, targets))
 
-    val_loss_epoch /= len(val_loader) # Validation loss
+    val_loss_epoch = metrics.mean("loss") # Validation loss
 
     # Print the metrics
     print(f"Validation on task {id_task} -> Loss: {val_loss_epoch}")
@@ -240,23 +255,22 @@ def test_epoch(model, device, datasets, args):
     test_tasks_id = [] # List to save the results of the task
     test_tasks_loss = [] # List to save the test loss
     test_tasks_accuracy = [] # List to save the test accuracy
+    test_tasks_confusion = [] # List to save the confusion matrices
 
     model.eval() # Set the model to evaluation mode
 
     for id_task, task in enumerate(datasets):
 
-        # Metrics for the test task 
-        test_loss, correct_pred, accuracy = 0, 0, 0
+        # Metrics for the test task (summed on the device)
+        metrics = Metrics()
 
         _, _, test_dataset = task # Get the images and labels from the task
 
-        # Make the dataloader
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                    batch_size=args.batch_size,
-                                                    shuffle=False)
+        # Test batches (contiguous chunks on the device, built once)
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
         # Disable gradient calculation
-        with torch.no_grad():
-            for images, targets in test_loader:
+        with torch.inference_mode():
+            for images, targets in test_batches:
                 # Move tensors to the configured device
                 images = images.to(device)
                 targets = targets.to(device)
@@ -264,26 +278,24 @@ def test_epoch(model, device, datasets, args):
                 # Forward pass
                 outputs = model(images)
 
-                # Calculate the loss
-                test_loss += F.cross_entropy(outputs, targets).item()
-
-                # Get the index of the max log-probability
-                pred = torch.argmax(outputs, dim=1)
-                
-                # Update the number of correct predictions
-                correct_pred += torch.sum(pred == targets).item()
+                # Calculate the loss (sum of the losses of the samples, divided by the number of samples)
+                metrics.add("loss", F.cross_entropy(outputs, targets, reduction="sum"), targets.size(0))
 
-            # Calculate the average loss
-            test_loss /= len(test_loader.dataset)
+                # Update the number of correct predictions (index of the max log-probability)
+                metrics.add_correct("accuracy", outputs, targets)
+                metrics.add_confusion("confusion", outputs, targets)
 
-            # Calculate the average accuracy
-            accuracy = 100. * correct_pred / len(test_loader.dataset)
+            # Calculate the average loss and accuracy
+            means = metrics.means()
+            test_loss = means["loss"]
+            accuracy = 100. * means["accuracy"]
             avg_accuracy += accuracy
 
             # Append the results to the lists
             test_tasks_id.append(id_task+1)
             test_tasks_loss.append(test_loss)
             test_tasks_accuracy.append(accuracy)
+            test_tasks_confusion.append(means["confusion"])
 
             # Print the metrics
             print(f"Test on task {id_task+1}: Average loss: {test_loss:.6f}, " 
@@ -293,7 +305,7 @@ def test_epoch(model, device, datasets, args):
     avg_accuracy /= len(datasets)
     print(f"Average accuracy: {avg_accuracy:.2f}%")
 
-    return test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy
+    return test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy, test_tasks_confusion
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
                    test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
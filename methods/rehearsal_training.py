@@ -7,8 +7,14 @@ import sys
 import copy
 
 sys.path.append('../')
-from utils.save_training_results import save_training_results
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
 from utils.utils import save_model
+from utils.evaluation import EvalScheduler, eval_batches
+from utils.metrics import Metrics
+from utils.rehearsal_buffer import RehearsalBuffer
+from utils.exemplar_codecs import make_codec, memory_capacity
+from utils.replay_sampler import ReplaySampler, MixedBatch
 
 from models.architectures.net_mnist import Net_mnist
 from models.architectures.net_cifar10 import Net_cifar10
@@ -24,6 +30,7 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
     :param random_rehearsal: if True, rehearse randomly
 
     :return: test_acc_final: list with the test accuracy of each task and the test average accuracy
+             costs: cost of each task (EvalScheduler.costs)
 
     """
     rehearsal_perc = int(rehearsal_prop*100) # Percentage of rehearsal data
@@ -35,6 +42,7 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
     path_file = f"./results/{args.exp_name}/rehearsal{rehearsal_perc}%_{args.dataset}.xlsx"
     workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
     test_acc_final = [] # List to save the test accuracy of each task and the test average accuracy
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     torch.manual_seed(args.seed) # Set the seed
 
@@ -48,7 +56,11 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
         
     print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test_epoch(model, device, eval_datasets, args))
+
     for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
         print("="*100)
         print("="*100)
 
@@ -77,10 +89,11 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
                                                     shuffle=True)
         
         val_loader = torch.utils.data.DataLoader(dataset=rehearsal_data_val,
-                                                    batch_size=args.batch_size,
-                                                    shuffle=True)
+                                                    batch_size=args.eval_batch_size,
+                                                    shuffle=False)
 
         for epoch in range(args.epochs):
+            timer.epoch(epoch)
             print("="*100)
             print(f"METHOD: Rehearsal training {rehearsal_perc}% (Experiment: {args.exp_name}) "
                    f"-> Train on task {id_task+1} -> Epoch: {epoch+1}")
@@ -91,11 +104,10 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
             # Validation
             val_loss_epoch = val_epoch(model, device, val_loader, id_task+1)
 
-            # Test
-            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = test_epoch(model, 
-                                                                                           device, 
-                                                                                           datasets, 
-                                                                                           args)
+            # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                id_task, epoch, dicc_results, model,
+                lambda eval_model, eval_datasets: test_epoch(eval_model, device, eval_datasets, args))
 
             # Append the results to dicc_results
             dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
@@ -117,8 +129,6 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
                     if lr < args.lr_min:
                         # if the lr decreases below minimum, stop the training session
                         print()
-                        # Append the test accuracy of each task and the test average accuracy
-                        test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
                         break
                     # reset patience and recover best model so far to continue training
                     patience = args.lr_patience
@@ -126,13 +136,16 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
                         param_group['lr'] = lr
                     model.load_state_dict(model_best.state_dict())
             
-            # Save the results of the epoch if it is the last epoch
-            if epoch == args.epochs-1:
-                # Append the test accuracy of each task and the test average accuracy
-                test_acc_final.append([test_tasks_accuracy, avg_accuracy]) 
             
             print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
 
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test_epoch(model_best, device, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+
         # Save the results of the task
         save_training_results(dicc_results, workbook, id_task+1, 
                               training_name=f"rehearsal{rehearsal_perc}%")
@@ -140,10 +153,188 @@ def rehearsal_training(datasets, args, rehearsal_prop, random_rehearsal=False):
         # Save the best model after each task
         save_model(model_best, args, id_task+1, method=f"rehearsal{rehearsal_perc}%")
 
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
+
     # Close the excel file
     workbook.close()
 
-    return test_acc_final
+    return test_acc_final, eval_scheduler.costs
+
+
+def rehearsal_buffer_training(datasets, args):
+    """
+    In this function, we train the model using rehearsal with a buffer of fixed size (memory_size), updated with
+    class-balanced reservoir sampling after each task. Each training batch has a fraction (replay_fraction) of
+    samples replayed from the buffer, so the length of an epoch only depends on the data of the current task.
+
+    :param datasets: list of datasets
+    :param args: arguments from the command line
+
+    :return: test_acc_final: list with the test accuracy of each task and the test average accuracy
+             costs: cost of each task (EvalScheduler.costs)
+
+    """
+    replay_perc = int(args.replay_fraction*100) # Percentage of replayed samples in each batch
+    print("\n")
+    print("="*100)
+    print(f"Training: REHEARSAL approach with a buffer, replay: {replay_perc}%...")
+    print("="*100)
+
+    path_file = f"./results/{args.exp_name}/rehearsal_buffer_{args.dataset}.xlsx"
+    workbook = xlsxwriter.Workbook(path_file)  # Create the excel file
+    test_acc_final = [] # List to save the test accuracy of each task and the test average accuracy
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed) # Set the seed
+
+    # Create model
+    if args.dataset == "mnist":
+        model = Net_mnist().to(device) # Instantiate the model
+        image_shape = (1, 28, 28)
+        num_classes = 10 # MNIST and Fashion MNIST share the labels
+    elif args.dataset == "cifar10":
+        model = Net_cifar10().to(device) # Instantiate the model
+        image_shape = (3, 32, 32)
+        num_classes = 10
+    elif args.dataset == "cifar100" or args.dataset == "cifar100-alternative-dist":
+        model = Net_cifar100().to(device) # Instantiate the model
+        image_shape = (3, 32, 32)
+        num_classes = 100
+
+    print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
+
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test_epoch(model, device, eval_datasets, args))
+
+    # Buffers of the training and validation samples of the previous tasks (the validation buffer keeps the
+    # proportion between the training and validation sets of the first task). With memory_bytes both buffers share
+    # the budget; with memory_size the training buffer has memory_size samples and the validation buffer is extra
+    codec = make_codec(args, image_shape, num_classes) # Storage of the samples (shared by both buffers)
+    capacity = memory_capacity(args, codec, num_classes)
+    num_train, num_val = len(datasets[0][0]), len(datasets[0][1])
+    if args.memory_bytes > 0:
+        val_capacity = int(capacity * num_val / (num_train + num_val))
+        capacity -= val_capacity
+    else:
+        val_capacity = max(1, int(capacity * num_val / num_train))
+    train_buffer = RehearsalBuffer(capacity, image_shape, codec=codec)
+    val_buffer = RehearsalBuffer(val_capacity, image_shape, codec=codec)
+    print(f"Rehearsal buffer: {capacity} training and {val_capacity} validation samples ({args.exemplar_codec}, "
+          f"{(train_buffer.nbytes() + val_buffer.nbytes() + num_classes * codec.class_bytes()) / 2**20:.1f} MB "
+          f"of codes, labels and parameters of the codec)")
+
+    for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
+        print("="*100)
+        print("="*100)
+
+        patience = args.lr_patience # Patience for early stopping
+        lr = args.lr # Learning rate
+        best_val_loss = 1e20 # Validation loss of the previous epoch
+        model_best = copy.deepcopy(model) # Save the best model so far
+
+        optimizer = optim.Adam(model.parameters(), lr=args.lr) # Instantiate the optimizer
+
+        dicc_results = {"Train task":[], "Train epoch": [], "Train loss":[], "Val loss":[],
+                         "Test task":[], "Test loss":[], "Test accuracy":[], "Test average accuracy": []}
+
+        train_dataset, val_dataset, _ = task  # Get the images and labels from the task
+
+        # Split each batch between the current task and the buffer
+        sampler, replay_size = None, 0
+        val_data = val_dataset
+        if len(train_buffer) > 0:
+            replay_size = min(args.batch_size - 1, max(1, round(args.batch_size * args.replay_fraction)))
+            sampler = ReplaySampler(train_buffer.tensors(), device, replacement=args.replay_replacement,
+                                    class_balanced=args.replay_class_balanced, codec=codec)
+            images_val, labels_val = val_buffer.tensors()
+            val_data = torch.utils.data.ConcatDataset([val_dataset, torch.utils.data.TensorDataset(
+                                                            val_buffer.decode(images_val, labels_val), labels_val)])
+            print(f"Rehearsal buffer: {len(train_buffer)} training samples and {len(val_buffer)} validation samples, "
+                  f"{replay_size} replayed samples per batch")
+
+        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                    batch_size=args.batch_size - replay_size,
+                                                    shuffle=True)
+        
+        val_loader = torch.utils.data.DataLoader(dataset=val_data,
+                                                    batch_size=args.eval_batch_size,
+                                                    shuffle=False)
+
+        for epoch in range(args.epochs):
+            timer.epoch(epoch)
+            print("="*100)
+            print(f"METHOD: Rehearsal buffer {capacity} (Experiment: {args.exp_name}) "
+                   f"-> Train on task {id_task+1} -> Epoch: {epoch+1}")
+            
+            # Training
+            train_loss_epoch = train_epoch(model, device, train_loader, optimizer, id_task+1, sampler, replay_size)
+
+            # Validation
+            val_loss_epoch = val_epoch(model, device, val_loader, id_task+1)
+
+            # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                id_task, epoch, dicc_results, model,
+                lambda eval_model, eval_datasets: test_epoch(eval_model, device, eval_datasets, args))
+
+            # Append the results to dicc_results
+            dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch, 
+                                          val_loss_epoch, test_tasks_id, test_tasks_loss, 
+                                          test_tasks_accuracy, avg_accuracy)
+
+            # Early stopping
+            if val_loss_epoch < best_val_loss:
+                best_val_loss = val_loss_epoch
+                patience = args.lr_patience
+                model_best = copy.deepcopy(model)
+            else:
+                # if the loss does not go down, decrease patience
+                patience -= 1
+                if patience <= 0:
+                    # if it runs out of patience, reduce the learning rate
+                    lr /= args.lr_decay
+                    print(' lr={:.1e}'.format(lr), end='')
+                    if lr < args.lr_min:
+                        # if the lr decreases below minimum, stop the training session
+                        print()
+                        break
+                    # reset patience and recover best model so far to continue training
+                    patience = args.lr_patience
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+                    model.load_state_dict(model_best.state_dict())
+            
+            
+            print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
+
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test_epoch(model_best, device, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+
+        # Save the results of the task
+        save_training_results(dicc_results, workbook, id_task+1, training_name="rehearsal_buffer")
+
+        # Save the best model after each task
+        save_model(model_best, args, id_task+1, method="rehearsal_buffer")
+
+        # Update the buffers with the samples of the task
+        if id_task != len(datasets)-1:
+            train_buffer.update(*train_dataset.tensors)
+            val_buffer.update(*val_dataset.tensors)
+            print(f"Samples per class in the rehearsal buffer: {train_buffer.class_sizes()}")
+
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
+
+    # Close the excel file
+    workbook.close()
+
+    return test_acc_final, eval_scheduler.costs
 
 
 def add_prev_tasks_to_current_task(datasets, id_task, rehearsal_prop, random_rehearsal=True):
@@ -189,13 +380,19 @@ def add_prev_tasks_to_current_task(datasets, id_task, rehearsal_prop, random_reh
     
 
 
-def train_epoch(model, device, train_loader, optimizer, id_task):
+@timer.timed("train")
+def train_epoch(model, device, train_loader, optimizer, id_task, sampler=None, replay_size=0):
 
     model.train()  # Set the model to training mode
 
-    train_loss_accum = 0 # Training loss
+    metrics = Metrics() # Training loss, summed on the device
+    mixed_batch = MixedBatch(device) # Preallocated buffer of the batches with replayed samples
+
+    for images, targets in timer.loader(train_loader):
+        if sampler is not None:
+            # Complete the batch with samples replayed from the rehearsal buffer
+            images, targets = mixed_batch.fill([images, targets], (sampler, replay_size))
 
-    for images, targets in train_loader:
         # Move tensors to the configured device
         images = images.to(device)
         targets = targets.to(device)
@@ -208,7 +405,7 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
 
         # Calculate the loss
         train_loss = F.cross_entropy(outputs, targets)
-        train_loss_accum += train_loss.item()
+        metrics.add("loss", train_loss)
 
         # Backward pass
         train_loss.backward()
@@ -216,7 +413,7 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
         # Optimize
         optimizer.step()
     
-    train_loss_epoch = train_loss_accum/len(train_loader) # Training loss
+    train_loss_epoch = metrics.mean("loss") # Training loss
 
     # Print the metrics
     print(f"Train on task {id_task} -> Loss: {train_loss_epoch}")
@@ -224,13 +421,14 @@ def train_epoch(model, device, train_loader, optimizer, id_task):
     return train_loss_epoch
 
 
+@timer.timed("validation")
 def val_epoch(model, device, val_loader, id_task):
     # Validation
     model.eval() # Set the model to evaluation mode
             
-    val_loss_epoch = 0 # Validation loss
+    metrics = Metrics() # Validation loss, summed on the device
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for images, targets in val_loader:
             # Move tensors to the configured device
             images = images.to(device)
@@ -240,9 +438,9 @@ def val_epoch(model, device, val_loader, id_task):
             outputs = model(images)
 
             # Calculate the loss
-            val_loss_epoch += F.cross_entropy(outputs, targets)
+            metrics.add("loss", F.cross_entropy(outputs, targets))
 
-    val_loss_epoch /= len(val_loader) # Validation loss
+    val_loss_epoch = metrics.mean("loss") # Validation loss
 
     # Print the metrics
     print(f"Validation on task {id_task} -> Loss: {val_loss_epoch}")
@@ -258,25 +456,24 @@ def test_epoch(model, device, datasets, args):
     test_tasks_id = [] # List to save the results of the task
     test_tasks_loss = [] # List to save the test loss
     test_tasks_accuracy = [] # List to save the test accuracy
+    test_tasks_confusion = [] # List to save the confusion matrices
 
     for id_task, task in enumerate(datasets):
 
-        # Metrics for the test task
-        test_loss, correct_pred, accuracy = 0, 0, 0
+        # Metrics for the test task (summed on the device)
+        metrics = Metrics()
 
         _, _, test_dataset = task  # Get the images and labels from the task
 
-        # Make the dataloader
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                    batch_size=args.batch_size,
-                                                    shuffle=True)
+        # Test batches (contiguous chunks on the device, built once)
+        test_batches = eval_batches(test_dataset, args.eval_batch_size, device)
 
         # Set the model to evaluation mode
         model.eval()
 
         # Disable gradient calculation
-        with torch.no_grad():
-            for images, labels in test_loader:
+        with torch.inference_mode():
+            for images, labels in test_batches:
                 # Move tensors to the configured device
                 images = images.to(device)
                 labels = labels.to(device)
@@ -284,26 +481,24 @@ def test_epoch(model, device, datasets, args):
                 # Forward pass
                 outputs = model(images)
 
-                # Calculate the loss
-                test_loss += F.cross_entropy(outputs, labels).item()
-
-                # Get the index of the max log-probability
-                pred = torch.argmax(outputs, dim=1)
-
-                # Update the number of correct predictions
-                correct_pred += torch.sum(pred == labels).item()
+                # Calculate the loss (sum of the losses of the samples, divided by the number of samples)
+                metrics.add("loss", F.cross_entropy(outputs, labels, reduction="sum"), labels.size(0))
 
-            # Calculate the average loss
-            test_loss /= len(test_loader.dataset)
+                # Update the number of correct predictions (index of the max log-probability)
+                metrics.add_correct("accuracy", outputs, labels)
+                metrics.add_confusion("confusion", outputs, labels)
 
-            # Calculate the average accuracy
-            accuracy = 100. * correct_pred / len(test_loader.dataset)
+            # Calculate the average loss and accuracy
+            means = metrics.means()
+            test_loss = means["loss"]
+            accuracy = 100. * means["accuracy"]
             avg_accurracy += accuracy
 
             # Append the results to the lists
             test_tasks_id.append(id_task+1)
             test_tasks_loss.append(test_loss)
             test_tasks_accuracy.append(accuracy)
+            test_tasks_confusion.append(means["confusion"])
 
             # Print the metrics
             print(f"Test on task {id_task+1}: Average loss: {test_loss:.6f}, " 
@@ -313,7 +508,7 @@ def test_epoch(model, device, datasets, args):
     avg_accurracy /= len(datasets)
     print(f"Average accuracy: {avg_accurracy:.2f}%")
 
-    return test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accurracy
+    return test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accurracy, test_tasks_confusion
 
 
 def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch, 
@@ -0,0 +1,185 @@
+import torch
+import torch.optim as optim
+
+import xlsxwriter
+import sys
+import copy
+
+sys.path.append('../')
+
+from utils.save_training_results import save_training_results, save_accuracy_matrix, save_phase_timings
+from utils.timers import timer
+from utils.utils import save_model
+from utils.evaluation import EvalScheduler
+
+from models.architectures.net_mnist import Net_mnist
+from models.architectures.net_cifar10 import Net_cifar10
+from models.architectures.net_cifar100 import Net_cifar100
+
+from methods.ewc_class import normal_train, normal_val, ewc_train, ewc_validate, test
+from methods.si_class import SI
+
+def si_training(datasets, args):
+
+    """
+    In this function, we train the model using the SI (Synaptic Intelligence) approach.
+
+    The importance of the weights is accumulated during the normal training loop (post-step hook), so, unlike
+    EWC, no extra pass over the data is needed to compute it.
+
+    :param datasets: list of datasets
+    :param args: arguments from the command line
+
+    :return: test_acc_final: list with the test accuracy of each task and the test average accuracy
+             costs: cost of each task (EvalScheduler.costs)
+
+    """
+
+    print("\n")
+    print("="*100)
+    print("Training on SI approach...")
+    print("="*100)
+
+    path_file = f"./results/{args.exp_name}/SI_{args.dataset}.xlsx" # Path to save the results
+    workbook = xlsxwriter.Workbook(path_file) # Create the excel file
+    test_acc_final = [] # List to save the test accuracy of each task and the test average accuracy
+    eval_scheduler = EvalScheduler(datasets, args) # When and on which data the models are tested
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed) # Set the seed
+
+    # Create the excel file
+    if args.dataset == "mnist":
+        model = Net_mnist().to(device) # Instantiate the model
+    elif args.dataset == "cifar10":
+        model = Net_cifar10().to(device) # Instantiate the model
+    elif args.dataset == "cifar100" or args.dataset == "cifar100-alternative-dist":
+        model = Net_cifar100().to(device) # Instantiate the model
+
+    print(f"Number of parameters: {sum(p.numel() for p in model.parameters())}")
+
+    # Test the initial model (reference of the forward transfer)
+    eval_scheduler.baseline(lambda eval_datasets: test(model, eval_datasets, args))
+
+    si = SI(model, args.si_epsilon) # Importance of the weights, accumulated during the training
+
+    for id_task, task in enumerate(datasets):
+        timer.task(id_task) # Phases of the task (utils/timers.py)
+        print("="*100)
+        print("="*100)
+
+        patience = args.lr_patience # Patience for early stopping
+        lr = args.lr # Learning rate
+        best_val_loss = 1e20 # Validation loss of the previous epoch
+        model_best = copy.deepcopy(model) # Save the best model so far
+
+        optimizer = optim.Adam(model.parameters(), lr=args.lr) # Instantiate the optimizer
+
+        dicc_results = {"Train task":[], "Train epoch": [], "Train loss":[], "Val loss":[],
+                         "Test task":[], "Test loss":[], "Test accuracy":[], "Test average accuracy": []}
+
+        train_dataset, val_dataset, _ = task # Get the images and labels from the task
+
+        # Make the dataloader
+        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                   batch_size=args.batch_size,
+                                                   shuffle=True)
+        val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
+                                                    batch_size=args.eval_batch_size,
+                                                    shuffle=False)
+
+        for epoch in range(args.epochs):
+            timer.epoch(epoch)
+            print("="*100)
+            print(f"METHOD: SI (Experiment: {args.exp_name}) -> Train on task {id_task+1}, Epoch: {epoch+1}")
+
+            if id_task == 0:
+                # Training
+                train_loss_epoch = normal_train(model, optimizer, train_loader, post_step=si.accumulate)
+
+                # Validation
+                val_loss_epoch = normal_val(model, val_loader)
+            else:
+                # Training
+                train_loss_epoch = ewc_train(model, optimizer, train_loader, si, importance=args.si_c,
+                                             post_step=si.accumulate)
+
+                # Validation
+                val_loss_epoch = ewc_validate(model, val_loader, si, importance=args.si_c)
+
+            # Test (every eval_every epochs, on the evaluation sets of the scheduler)
+            test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.evaluate(
+                id_task, epoch, dicc_results, model,
+                lambda eval_model, eval_datasets: test(eval_model, eval_datasets, args))
+
+            # Append the results to dicc_results
+            dicc_results = append_results(dicc_results, id_task+1, epoch+1, train_loss_epoch,
+                                        val_loss_epoch, test_tasks_id, test_tasks_loss,
+                                        test_tasks_accuracy, avg_accuracy)
+
+            # Early stopping
+            if val_loss_epoch < best_val_loss:
+                best_val_loss = val_loss_epoch
+                patience = args.lr_patience
+                model_best = copy.deepcopy(model)
+            else:
+                # if the loss does not go down, decrease patience
+                patience -= 1
+                if patience <= 0:
+                    # if it runs out of patience, reduce the learning rate
+                    lr /= args.lr_decay
+                    print(' lr={:.1e}'.format(lr), end='')
+                    if lr < args.lr_min:
+                        # if the lr decreases below minimum, stop the training session
+                        print()
+                        break
+                    # reset patience and recover best model so far to continue training
+                    patience = args.lr_patience
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+                    model.load_state_dict(model_best.state_dict())
+                    si.reset_prev_params(model) # The jump to the best model is not a training step
+
+
+            print(f"Learning rate: {optimizer.param_groups[0]['lr']}, Patience: {patience}")
+
+        # Consolidate the importance of the weights, anchored to the saved (best) model
+        si.consolidate(model_best)
+        si.reset_prev_params(model)
+
+        # Test the best model of the task on the full test sets (result of the task)
+        test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy = eval_scheduler.final(
+            id_task, dicc_results, lambda eval_datasets: test(model_best, eval_datasets, args))
+        dicc_results = append_results(dicc_results, id_task+1, "Best", None, None, test_tasks_id, test_tasks_loss, 
+                                      test_tasks_accuracy, avg_accuracy)
+        test_acc_final.append([test_tasks_accuracy, avg_accuracy])
+
+        # Save the results (after each task)
+        save_training_results(dicc_results, workbook, id_task+1, training_name="SI")
+
+        # Save the model
+        save_model(model_best, args, id_task+1, method="SI")
+
+    save_accuracy_matrix(eval_scheduler.accuracy_matrix, workbook) # Accuracy matrix and continual learning metrics
+    save_phase_timings(workbook) # Time of each phase of the method (with --time_phases)
+
+    # Close the excel file
+    workbook.close()
+
+    return test_acc_final, eval_scheduler.costs
+
+
+
+def append_results(dicc_results, id_task, epoch, train_loss_epoch, val_loss_epoch,
+                   test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy):
+
+    # Append the results to dicc_results
+    dicc_results["Train task"].append(id_task)
+    dicc_results["Train epoch"].append(epoch)
+    dicc_results["Train loss"].append(train_loss_epoch)
+    dicc_results["Val loss"].append(val_loss_epoch)
+    dicc_results["Test task"].append(test_tasks_id)
+    dicc_results["Test loss"].append(test_tasks_loss)
+    dicc_results["Test accuracy"].append(test_tasks_accuracy)
+    dicc_results["Test average accuracy"].append(avg_accuracy)
+
+    return dicc_results
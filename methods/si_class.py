@@ -0,0 +1,68 @@
+import torch
+from torch import nn
+from utils.timers import timer
+
+
+class SI(object):
+    """
+    Synaptic Intelligence (SI), Zenke et al., 2017.
+
+    The importance of each parameter is accumulated online during the normal training: after every optimizer
+    step, the contribution of the update to the decrease of the loss (-grad * delta) is added to the path integral
+    of the parameter. At the end of each task, the path integral is normalized by the total displacement of the
+    parameter and added to its importance. No extra pass over the data is needed.
+
+    The object has the same penalty() interface as EWC, so it can be used with ewc_train and ewc_validate.
+    """
+    def __init__(self, model: nn.Module, epsilon: float):
+
+        self.epsilon = epsilon # Damping term of the importance
+
+        self.params = {n: p for n, p in model.named_parameters() if p.requires_grad}
+        self._omega = {n: torch.zeros_like(p.data) for n, p in self.params.items()} # Path integral of the task
+        self._importance = {n: torch.zeros_like(p.data) for n, p in self.params.items()} # Consolidated importance
+        self._means = {n: p.data.clone() for n, p in self.params.items()} # Weights at the start of the task
+        self._prev_params = {n: p.data.clone() for n, p in self.params.items()} # Weights before the last step
+
+    def accumulate(self, model: nn.Module):
+        """
+        Add the contribution of the last optimizer step to the path integral. Call it after optimizer.step().
+        """
+        with torch.no_grad():
+            for n, p in model.named_parameters():
+                if n not in self._omega:
+                    continue
+                if p.grad is not None:
+                    self._omega[n] -= p.grad * (p.data - self._prev_params[n])
+                self._prev_params[n].copy_(p.data)
+
+    def reset_prev_params(self, model: nn.Module):
+        """
+        Restart the path from the current weights, e.g. after recovering the best model so far.
+        """
+        for n, p in model.named_parameters():
+            if n in self._prev_params:
+                self._prev_params[n].copy_(p.data)
+
+    @timer.timed("importance")
+    def consolidate(self, model: nn.Module):
+        """
+        Update the importance with the path integral of the task and store the weights of the model.
+        """
+        with torch.no_grad():
+            for n, p in model.named_parameters():
+                if n not in self._omega:
+                    continue
+                delta = p.data - self._means[n]
+                self._importance[n] += self._omega[n] / (delta ** 2 + self.epsilon)
+                self._omega[n].zero_()
+                self._means[n].copy_(p.data)
+                self._prev_params[n].copy_(p.data)
+
+    def penalty(self, model: nn.Module):
+        loss = 0
+        for n, p in model.named_parameters():
+            if n in self._importance:
+                _loss = self._importance[n] * (p - self._means[n]) ** 2
+                loss += _loss.sum()
+        return loss
@@ -23,6 +23,22 @@ class Net_cifar10(nn.Module):
         self.fc2 = nn.Linear(512, 10)
 
     def forward(self, x):
+        return self.classifier(self.features(x))
+    
+    def feature_extractor(self, x):
+        return self.pooled_features(self.features(x))
+
+    def forward_with_features(self, x):
+        """
+        Compute the output and the pooled features (feature_extractor) with a single pass of the convolutional layers.
+        """
+        x = self.features(x)
+        return self.classifier(x), self.pooled_features(x)
+
+    def features(self, x):
+        """
+        Convolutional layers, shared by the output and the pooled features.
+        """
         x = self.conv1(x)
         x = self.relu1(x)
         x = self.maxpool1(x)
@@ -35,31 +51,22 @@ class Net_cifar10(nn.Module):
         x = self.relu3(x)
         x = self.maxpool3(x)
 
+        return x
+
+    def classifier(self, x):
         x = self.flatten(x)
         x = self.fc1(x)
         x = self.relu4(x)
         x = self.fc2(x)
 
         return x
-    
-    def feature_extractor(self, x):
-        x = self.conv1(x)
-        x = self.relu1(x)
-        x = self.maxpool1(x)
-
-        x = self.conv2(x)
-        x = self.relu2(x)
-        x = self.maxpool2(x)
 
-        x = self.conv3(x)
-        x = self.relu3(x)
-        x = self.maxpool3(x)
-        
+    def pooled_features(self, x):
         out_horizontal = torch.mean(x, dim=3)  # Average pooling along dimension 3 (width)
         out_vertical = torch.mean(x, dim=2) # Average pooling along dimension 2 (height)
 
         # Concatenate the two outputs
-        out_pooled = torch.cat([out_horizontal, out_vertical], dim=2).view(x.size(0), -1).view(x.size(0), -1)
+        out_pooled = torch.cat([out_horizontal, out_vertical], dim=2).view(x.size(0), -1)
 
         return out_pooled
 
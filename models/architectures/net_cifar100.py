@@ -117,21 +117,35 @@ class Net_cifar100(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
+        return self.classifier(self.features(x))
+
+    def feature_extractor(self, x):
+        return self.pooled_features(self.features(x))
+
+    def forward_with_features(self, x):
+        """
+        Compute the output and the pooled features (feature_extractor) with a single pass of the residual layers.
+        """
+        out = self.features(x)
+        return self.classifier(out), self.pooled_features(out)
+
+    def features(self, x):
+        """
+        Residual layers, shared by the output and the pooled features.
+        """
         out = F.relu(self.bn1(self.conv1(x)))
         out = self.layer1(out)
         out = self.layer2(out)
         out = self.layer3(out)
+        return out
+
+    def classifier(self, out):
         out = self.avg_pool(out)
         out = out.view(out.size(0), -1)
         out = self.fc(out)
         return out
 
-    def feature_extractor(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-
+    def pooled_features(self, out):
         horizontal_pool = torch.mean(out, dim=3)  # Average pooling along dimension 3 (width)
         vertical_pool = torch.mean(out, dim=2)  # Average pooling along dimension 2 (height)
 
@@ -31,22 +31,38 @@ class Net_mnist(nn.Module):
 
 
     def forward(self, x):
+        return self.classifier(self.features(x))
+    
+    def feature_extractor(self, x):
+        return self.pooled_features(self.features(x))
+
+    def forward_with_features(self, x):
+        """
+        Compute the output and the pooled features (feature_extractor) with a single pass of the convolutional layers.
+        """
+        x = self.features(x)
+        return self.classifier(x), self.pooled_features(x)
+
+    def features(self, x):
+        """
+        Convolutional layers, shared by the output and the pooled features.
+        """
         x = F.relu(F.max_pool2d(self.conv1(x), 2))
         x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2))
+        return x
+
+    def classifier(self, x):
         x = x.view(-1, 320)
         x = F.relu(self.fc1(x))
         x = F.dropout(x, training=self.training)
         x = self.fc2(x)
         return x
-    
-    def feature_extractor(self, x):
-        x = F.relu(F.max_pool2d(self.conv1(x), 2))
-        x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2))
 
+    def pooled_features(self, x):
         out_horizontal = torch.mean(x, dim=3)  # Average pooling along dimension 3 (width)
         out_vertical = torch.mean(x, dim=2) # Average pooling along dimension 2 (height)
 
         # Concatenate the two outputs
-        out_pooled = torch.cat([out_horizontal, out_vertical], dim=2).view(x.size(0), -1).view(x.size(0), -1)
+        out_pooled = torch.cat([out_horizontal, out_vertical], dim=2).view(x.size(0), -1)
         
         return out_pooled
\ No newline at end of file
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from methods.distillation import cross_entropy
+
+
+def cross_entropy_reference(outputs, targets, exp=1.0, size_average=True, eps=1e-5):
+    # Original implementation of the distillation loss, in probability space
+    out = torch.nn.functional.softmax(outputs, dim=1)
+    tar = torch.nn.functional.softmax(targets, dim=1)
+    if exp != 1:
+        out = out.pow(exp)
+        out = out / out.sum(1).view(-1, 1).expand_as(out)
+        tar = tar.pow(exp)
+        tar = tar / tar.sum(1).view(-1, 1).expand_as(tar)
+    out = out + eps / out.size(1)
+    out = out / out.sum(1).view(-1, 1).expand_as(out)
+    ce = -(tar * out.log()).sum(1)
+    if size_average:
+        ce = ce.mean()
+    return ce
+
+
+@pytest.mark.parametrize("batch_size, num_classes", [(200, 10), (200, 100)])
+@pytest.mark.parametrize("exp", [1.0, 1.0 / 2.0])
+@pytest.mark.parametrize("size_average", [True, False])
+@pytest.mark.parametrize("targets_grad", [False, True])
+def test_cross_entropy_matches_reference(batch_size, num_classes, exp, size_average, targets_grad):
+    """
+    The log-space loss (fused autograd function when the targets are frozen) gives the values and gradients of
+    the original implementation.
+    """
+    torch.manual_seed(0)
+    outputs = (torch.randn(batch_size, num_classes, dtype=torch.float64) * 5).requires_grad_()
+    targets = (torch.randn(batch_size, num_classes, dtype=torch.float64) * 5).requires_grad_(targets_grad)
+    weights = torch.rand(batch_size, dtype=torch.float64) # Gradient of the per-sample losses
+
+    grads = []
+    for loss_fn in (cross_entropy_reference, cross_entropy):
+        loss = loss_fn(outputs, targets, exp=exp, size_average=size_average)
+        loss = loss if size_average else (loss * weights).sum()
+        inputs = (outputs, targets) if targets_grad else (outputs,)
+        grads.append((loss.detach(), torch.autograd.grad(loss, inputs)))
+
+    (loss_reference, grads_reference), (loss, grads) = grads
+    torch.testing.assert_close(loss, loss_reference)
+    for grad, grad_reference in zip(grads, grads_reference):
+        torch.testing.assert_close(grad, grad_reference)
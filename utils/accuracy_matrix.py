@@ -0,0 +1,100 @@
+import numpy as np
+
+
+# Continual learning metrics of AccuracyMatrix.metrics, in the order they are written in the workbooks
+CL_METRICS = ["Average accuracy", "Learning accuracy", "Backward transfer (BWT)", "Forward transfer (FWT)",
+              "Forgetting", "Intransigence"]
+
+
+class AccuracyMatrix(object):
+    """
+    Test accuracies of a method, in a preallocated array [train task, test task, epoch]: accuracies[i, j, e] is the
+    accuracy (%) on the test set of task j after epoch e of the training on task i. The last epoch index is the
+    best model of the task (the result of the task, tested on the full test sets). Missing tests are NaN.
+
+    The confusion matrices of the same tests (true class x predicted class, counts of the test set of each task)
+    are kept with the accuracies, in int32 arrays [test task, class, class] for each tested epoch.
+
+    The metrics are computed on the results of the tasks, R[i, j] = accuracies[i, j, -1] (Lopez-Paz and Ranzato,
+    2017; Chaudhry et al., 2018):
+
+        - Average accuracy: mean of R[T-1, j] over the tasks.
+        - Learning accuracy: mean of R[j, j], accuracy on each task just after learning it.
+        - Backward transfer: mean of R[T-1, j] - R[j, j] over the tasks before the last one.
+        - Forward transfer: mean of R[j-1, j] - b[j] over the tasks after the first one, with b[j] the accuracy of
+          the initial (untrained) model on task j.
+        - Forgetting: mean of max(R[l, j], j <= l < T-1) - R[T-1, j] over the tasks before the last one.
+        - Intransigence: mean of a[j] - R[j, j], with a[j] the accuracy on task j of a reference model trained
+          on the data of all the tasks (joint training).
+    """
+    def __init__(self, num_train_tasks, num_test_tasks, num_epochs):
+        """
+        :param num_train_tasks: number of tasks the method is trained on (1 for joint training)
+        :param num_test_tasks: number of tasks with a test set
+        :param num_epochs: maximum number of epochs of a task
+        """
+        self.accuracies = np.full((num_train_tasks, num_test_tasks, num_epochs + 1), np.nan)
+        self.baseline = np.full(num_test_tasks, np.nan) # Accuracy of the initial model on each task
+        self.confusion = {} # {(train task, epoch or None for the best model): confusion matrices}
+        self.baseline_confusion = None # Confusion matrices of the initial model
+
+    def record(self, id_task, epoch, accuracies, confusion=None):
+        """
+        :param id_task: train task (from 0)
+        :param epoch: epoch of the task (from 0), or None for the best model of the task
+        :param accuracies: accuracy on each test task
+        :param confusion: confusion matrix of each test task (class x class)
+        """
+        self.accuracies[id_task, :len(accuracies), -1 if epoch is None else epoch] = accuracies
+        if confusion is not None:
+            self.confusion[(id_task, epoch)] = np.stack(confusion).astype(np.int32)
+
+    def record_baseline(self, accuracies, confusion=None):
+        self.baseline[:len(accuracies)] = accuracies
+        if confusion is not None:
+            self.baseline_confusion = np.stack(confusion).astype(np.int32)
+
+    def results(self):
+        """
+        :return: matrix R[train task, test task] with the results of the tasks
+        """
+        return self.accuracies[:, :, -1]
+
+    @classmethod
+    def from_results(cls, test_acc_final, baseline=None):
+        """
+        Build the matrix from the results returned by the methods: [[accuracy on each task, average accuracy]
+        after each task].
+        """
+        matrix = cls(len(test_acc_final), len(test_acc_final[0][0]), 0)
+        for id_task, (accuracies, _) in enumerate(test_acc_final):
+            matrix.record(id_task, None, accuracies)
+        if baseline is not None:
+            matrix.record_baseline(baseline)
+        return matrix
+
+    def metrics(self, reference=None):
+        """
+        :param reference: accuracy on each task of a model trained on all the tasks (for the intransigence)
+        :return: dict {name of the metric (CL_METRICS): value}, NaN if it is not defined (e.g. a single task)
+        """
+        R = self.results()
+        num_tasks = min(R.shape)
+        diagonal = np.diagonal(R)[:num_tasks]
+        metrics = dict.fromkeys(CL_METRICS, np.nan)
+
+        metrics["Average accuracy"] = R[-1].mean()
+        if R.shape[0] != R.shape[1]:
+            return metrics # Joint training: a single train task
+
+        metrics["Learning accuracy"] = diagonal.mean()
+        if num_tasks > 1:
+            metrics["Backward transfer (BWT)"] = (R[-1, :-1] - diagonal[:-1]).mean()
+            metrics["Forward transfer (FWT)"] = (np.diagonal(R, offset=1) - self.baseline[1:]).mean()
+            # Best accuracy on task j after learning it (train tasks l >= j, before the last one)
+            learned = np.arange(num_tasks - 1)[:, None] >= np.arange(num_tasks - 1)[None, :]
+            best = np.where(learned, R[:-1, :-1], -np.inf).max(axis=0)
+            metrics["Forgetting"] = (best - R[-1, :-1]).mean()
+        if reference is not None:
+            metrics["Intransigence"] = (np.asarray(reference, dtype=float) - diagonal).mean()
+        return metrics
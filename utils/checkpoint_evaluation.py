@@ -0,0 +1,91 @@
+import os
+import re
+import copy
+
+import torch
+import torch.nn.functional as F
+
+from utils.evaluation import eval_batches
+
+
+def find_checkpoints(path_exp, dataset):
+    """
+    Find the models saved by save_model in the folder of an experiment: {method}_{dataset}/{method}-aftertask[...].pt
+    after each task, and {method}_{dataset}/{method}.pt for joint training.
+
+    :param path_exp: folder of the experiment (./models/models_saved/{exp_name})
+    :param dataset: name of the dataset
+    :return: dict {method: {number of tasks trained (None for joint training): path}}, in order of training
+    """
+    checkpoints = {}
+    suffix = f"_{dataset}"
+    folders = [folder for folder in os.listdir(path_exp)
+               if folder.endswith(suffix) and os.path.isdir(os.path.join(path_exp, folder))]
+
+    for folder in folders:
+        method = folder[:-len(suffix)]
+        for name in os.listdir(os.path.join(path_exp, folder)):
+            match = re.fullmatch(re.escape(method) + r"(?:-aftertask(\[[\d, ]+\]|\d+))?\.pt", name)
+            if match is None:
+                continue # e.g. the auxiliary networks of LwF
+            tasks = match.group(1)
+            if tasks is None:
+                num_tasks = None
+            elif tasks.startswith("["):
+                num_tasks = len(tasks.strip("[]").split(","))
+            else:
+                num_tasks = int(tasks) # save_model writes the id of the task after 6 tasks
+            checkpoints.setdefault(method, {})[num_tasks] = os.path.join(path_exp, folder, name)
+
+    # Methods in the order they were trained (first checkpoint saved)
+    return dict(sorted(checkpoints.items(), key=lambda item: min(os.path.getmtime(p) for p in item[1].values())))
+
+
+def evaluate_checkpoints(model, state_dicts, datasets, device, batch_size, models_per_pass=8):
+    """
+    Test many checkpoints of the same architecture on the test sets of all the tasks.
+
+    Each test batch is moved to the device once (eval_batches) and goes through all the checkpoints: the weights
+    of the checkpoints are stacked in groups of models_per_pass and each group is a single call of the model
+    vectorized with torch.vmap (torch.func.functional_call on a copy of the model without weights). The models are in eval
+    mode, so BatchNorm uses the running statistics of each checkpoint.
+
+    :param model: model with the architecture of the checkpoints
+    :param state_dicts: list of state dicts
+    :param datasets: list of tasks [train, val, test]
+    :param device: device of the evaluation
+    :param batch_size: batch size of the test sets
+    :param models_per_pass: maximum number of checkpoints evaluated in the same call
+    :return: accuracy (%) and average loss of each checkpoint on each task, tensors (num_checkpoints, num_tasks)
+    """
+    base = copy.deepcopy(model).to("meta").eval()
+    names = set(base.state_dict().keys())
+    for state_dict in state_dicts:
+        if set(state_dict.keys()) != names:
+            raise ValueError("The checkpoints do not have the architecture of the model")
+
+    # Stacked weights of each group of checkpoints, on the device
+    groups = []
+    for start in range(0, len(state_dicts), models_per_pass):
+        group = state_dicts[start:start + models_per_pass]
+        groups.append((start, len(group), {name: torch.stack([sd[name] for sd in group]).to(device) for name in names}))
+
+    def call(weights, images):
+        return torch.func.functional_call(base, weights, (images,))
+
+    correct = torch.zeros((len(state_dicts), len(datasets)), device=device)
+    losses = torch.zeros((len(state_dicts), len(datasets)), device=device)
+    sizes = []
+
+    with torch.inference_mode():
+        for id_task, (_, _, test_dataset) in enumerate(datasets):
+            for images, labels in eval_batches(test_dataset, batch_size, device):
+                for start, size, weights in groups:
+                    outputs = torch.vmap(call, in_dims=(0, None))(weights, images) # (size, batch, classes)
+                    correct[start:start + size, id_task] += (outputs.argmax(dim=2) == labels).sum(dim=1)
+                    losses[start:start + size, id_task] += F.cross_entropy(
+                        outputs.flatten(0, 1), labels.repeat(size), reduction="none").view(size, -1).sum(dim=1)
+            sizes.append(len(test_dataset))
+
+    sizes = torch.tensor(sizes, dtype=torch.float, device=device)
+    return (100. * correct / sizes).cpu(), (losses / sizes).cpu()
@@ -0,0 +1,65 @@
+import torch
+
+
+class EMA(object):
+    """
+    Exponential moving average of the weights of a model, updated in place:
+
+        weights_ema = momentum * weights_ema + (1 - momentum) * weights
+
+    The tensors are grouped by device and dtype and each group is updated with two fused multi-tensor operations
+    (torch._foreach_mul_ and torch._foreach_add_), instead of a Python loop that allocates a new tensor per
+    parameter, so it is cheap enough to be called after every optimizer step.
+
+    The integer buffers (e.g. num_batches_tracked of BatchNorm) are copied instead of averaged.
+    """
+    def __init__(self, model_ema, model, momentum, update_every=0, include_buffers=False):
+        """
+        :param model_ema: model with the moving average (e.g. long term memory model of BiMeCo)
+        :param model: model being trained (e.g. short term memory model of BiMeCo)
+        :param momentum: weight of the moving average
+        :param update_every: number of optimizer steps between updates (0: once per epoch)
+        :param include_buffers: also average the buffers (e.g. running statistics of BatchNorm)
+        """
+        self.momentum = momentum
+        self.update_every = update_every
+        self.num_steps = 0
+
+        tensors_ema = [p.data for p in model_ema.parameters()]
+        tensors = [p.data for p in model.parameters()]
+        if include_buffers:
+            tensors_ema += list(model_ema.buffers())
+            tensors += list(model.buffers())
+
+        self.groups = {} # {(device, dtype): (tensors_ema, tensors)}
+        self.copies = [] # Integer buffers: (tensor_ema, tensor)
+        for tensor_ema, tensor in zip(tensors_ema, tensors):
+            if not tensor_ema.is_floating_point():
+                self.copies.append((tensor_ema, tensor))
+                continue
+            group = self.groups.setdefault((tensor_ema.device, tensor_ema.dtype), ([], []))
+            group[0].append(tensor_ema)
+            group[1].append(tensor)
+
+    @torch.no_grad()
+    def update(self):
+        for tensors_ema, tensors in self.groups.values():
+            torch._foreach_mul_(tensors_ema, self.momentum)
+            torch._foreach_add_(tensors_ema, tensors, alpha=1 - self.momentum)
+        for tensor_ema, tensor in self.copies:
+            tensor_ema.copy_(tensor)
+
+    def step(self):
+        """
+        Call it after each optimizer step: update the moving average every update_every steps.
+        """
+        self.num_steps += 1
+        if self.update_every > 0 and self.num_steps % self.update_every == 0:
+            self.update()
+
+    def epoch_end(self):
+        """
+        Call it at the end of each epoch: update the moving average if it is updated once per epoch.
+        """
+        if self.update_every == 0:
+            self.update()
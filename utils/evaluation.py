@@ -0,0 +1,410 @@
+import copy
+import math
+import time
+import queue
+import threading
+import functools
+import statistics
+
+import torch
+import numpy as np
+
+from utils.accuracy_matrix import AccuracyMatrix
+from utils.timers import timer
+
+# Stratified subsets of the test sets already built in this run: {(id of the dataset, samples per class, seed): subset}
+_subsets = {}
+
+# Random chunks of the test sets already built in this run: {(id of the dataset, seed, start, stop): chunk}
+_chunks = {}
+
+# Test batches already built in this run: {(id of the dataset, batch size, device): (dataset, batches)}
+_batches = {}
+
+# Evaluator thread of the asynchronous tests (eval_async), started by the first scheduler that uses it
+_evaluator = None
+
+# Initial model on the test sets of this run: {ids of the test sets: (datasets, accuracies, confusion matrices)}
+_baselines = {}
+
+
+def eval_batches(dataset, batch_size, device):
+    """
+    Split a TensorDataset in contiguous batches on the device, in dataset order. The batches are built once and
+    reused by all the evaluations of the run, so the test sets are not copied to the device (nor wrapped in a new
+    DataLoader) at each epoch.
+
+    :param dataset: TensorDataset with the images and labels
+    :param batch_size: batch size of the evaluation (eval_batch_size)
+    :param device: device of the model
+    :return: list of batches (images, labels)
+    """
+    key = (id(dataset), batch_size, str(device))
+    if key not in _batches:
+        tensors = [tensor.to(device) for tensor in dataset.tensors]
+        # The dataset is kept with its batches, so its id is not reused by another dataset
+        _batches[key] = (dataset, list(zip(*(tensor.split(batch_size) for tensor in tensors))))
+    return _batches[key][1]
+
+
+def stratified_subset(dataset, samples_per_class, seed):
+    """
+    Take the same number of random samples of each class of a TensorDataset (all the samples of the classes with
+    fewer samples). The subset is a new TensorDataset with contiguous tensors, cached for the next calls.
+
+    :param dataset: TensorDataset with the images and labels
+    :param samples_per_class: number of samples of each class
+    :param seed: seed of the random selection (the global random generator is not used)
+    :return: TensorDataset with the selected samples, in dataset order
+    """
+    key = (id(dataset), samples_per_class, seed)
+    if key in _subsets:
+        return _subsets[key]
+
+    images, labels = dataset.tensors[:2]
+    generator = torch.Generator().manual_seed(seed)
+    indices = []
+    for cls in labels.unique().tolist():
+        indices_class = torch.where(labels == cls)[0]
+        indices.append(indices_class[torch.randperm(len(indices_class), generator=generator)[:samples_per_class]])
+    indices = torch.cat(indices).sort()[0]
+
+    _subsets[key] = torch.utils.data.TensorDataset(images[indices], labels[indices])
+    return _subsets[key]
+
+
+def random_chunk(dataset, seed, start, stop):
+    """
+    Take the samples start:stop of a random permutation of a TensorDataset (the same permutation for a dataset and a
+    seed). The chunk is a new TensorDataset with contiguous tensors, cached for the next calls.
+    """
+    key = (id(dataset), seed, start, stop)
+    if key not in _chunks:
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(len(dataset), generator=generator)[start:stop].sort()[0]
+        _chunks[key] = torch.utils.data.TensorDataset(*(tensor[indices] for tensor in dataset.tensors))
+    return _chunks[key]
+
+
+def wilson_width(correct, n, total, z):
+    """
+    Width (%) of the Wilson score interval of an accuracy estimated on n samples drawn without replacement from a
+    test set of total samples, with the finite population correction (0 when the whole test set is used).
+    """
+    p = correct / n
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return 100. * 2 * half * math.sqrt((total - n) / max(total - 1, 1))
+
+
+def sequential_test(test_fn, model, datasets, tolerance, confidence, first_size, seed):
+    """
+    Approximate test: test the model on random chunks of the test set of each task, of first_size samples and then
+    twice the previous chunk, until the confidence interval of the accuracy of the task (wilson_width) is narrower
+    than tolerance, or the whole test set has been used. Each round calls test_fn on the tasks that are not
+    finished, so the number of calls grows with the log of the size of the test sets.
+
+    :param test_fn: function test_fn(model, datasets) that tests a model on a list of tasks
+    :param model: model to test
+    :param datasets: list of tasks [train, val, test]
+    :param tolerance: maximum width of the interval (accuracy points, %)
+    :param confidence: confidence level of the interval (e.g. 0.95)
+    :param first_size: number of samples of the first chunk
+    :param seed: seed of the random order of the samples
+    :return: results of test_fn on the samples used, with the number of samples and the width of the interval of
+             each task: (test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy, test_tasks_confusion,
+             test_tasks_samples, test_tasks_width)
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    num_tasks = len(datasets)
+    samples, correct, loss, confusion = [0] * num_tasks, [0.] * num_tasks, [0.] * num_tasks, [0] * num_tasks
+    width = [100.] * num_tasks
+
+    open_tasks, start, size = list(range(num_tasks)), 0, first_size
+    while open_tasks:
+        chunks = [random_chunk(datasets[j][2], seed, start, start + size) for j in open_tasks]
+        results = test_fn(model, [(None, None, chunk) for chunk in chunks])
+        for j, chunk, loss_chunk, accuracy_chunk, confusion_chunk in zip(open_tasks, chunks, *results[1:3],
+                                                                         results[4]):
+            samples[j] += len(chunk)
+            correct[j] += round(accuracy_chunk * len(chunk) / 100.)
+            loss[j] += loss_chunk * len(chunk)
+            confusion[j] = confusion[j] + confusion_chunk
+            width[j] = wilson_width(correct[j], samples[j], len(datasets[j][2]), z)
+        open_tasks = [j for j in open_tasks if width[j] > tolerance and samples[j] < len(datasets[j][2])]
+        start, size = start + size, 2 * size
+
+    accuracy = [100. * c / n for c, n in zip(correct, samples)]
+    print(f"Sequential test: Samples: {samples}, Interval width: {[round(w, 2) for w in width]}, "
+          f"Average accuracy: {sum(accuracy) / num_tasks:.2f}%")
+    return (list(range(1, num_tasks + 1)), [l / n for l, n in zip(loss, samples)], accuracy,
+            sum(accuracy) / num_tasks, confusion, samples, width)
+
+
+class AsyncEvaluator(object):
+    """
+    Thread that tests snapshots of the weights while the training continues. Each snapshot (a copy of the
+    state_dict on the device) is loaded in a replica of the model owned by the evaluator, so the model being trained
+    is never read by the evaluator. The snapshots are tested one by one, in the order they were submitted.
+
+    At most max_pending snapshots wait in the queue: when the tests are slower than the training, submit blocks
+    until the evaluator catches up, so the number of copies of the weights is bounded.
+
+    The intra-op threads of PyTorch are shared by the whole process, so the evaluator uses the same thread pool as
+    the training (torch.set_num_threads is never called from the evaluator thread).
+    """
+    def __init__(self, max_pending=2):
+        """
+        :param max_pending: maximum number of snapshots waiting to be tested
+        """
+        self.snapshots = queue.Queue(maxsize=max_pending)
+        self.done = queue.Queue() # (tag, results of the test, exception)
+        self.pending = 0 # Snapshots submitted and not collected yet
+        threading.Thread(target=self._run, name="evaluator", daemon=True).start()
+
+    def _run(self):
+        while True:
+            replica, state_dict, test_fn, datasets, tag = self.snapshots.get()
+            try:
+                replica.load_state_dict(state_dict)
+                self.done.put((tag, test_fn(replica, datasets), None))
+            except Exception as error: # Raised in the training thread when the results are collected
+                self.done.put((tag, None, error))
+
+    def submit(self, replica, model, test_fn, datasets, tag):
+        """
+        :param replica: model with the architecture of model, used only by the evaluator
+        :param model: model to test (its weights are copied now)
+        :param test_fn: function test_fn(model, datasets) that tests a model on a list of tasks
+        :param datasets: list of tasks of the test
+        :param tag: returned with the results (collect)
+        """
+        state_dict = {name: value.detach().clone() for name, value in model.state_dict().items()}
+        self.pending += 1
+        self.snapshots.put((replica, state_dict, test_fn, datasets, tag))
+
+    def collect(self, wait=False):
+        """
+        :param wait: wait for all the snapshots submitted (otherwise, only the tests already finished)
+        :return: list of (tag, results of test_fn), in the order of submission
+        """
+        collected = []
+        while self.pending > 0 and (wait or not self.done.empty()):
+            tag, results, error = self.done.get()
+            self.pending -= 1
+            if error is not None:
+                raise error
+            collected.append((tag, results))
+        return collected
+
+
+class EvalScheduler(object):
+    """
+    Decide when and on which data the models are tested during the training of a task:
+
+        - The test runs every eval_every epochs (the other epochs only have the training and validation losses).
+        - With eval_subset > 0, it uses a stratified subset of the test set of each task, with eval_subset
+          samples per class, built once.
+        - At the end of each task, the best model is always tested on the full test sets. This is the result of
+          the task (test_acc_final).
+        - With eval_async, the tests during training run in the evaluator thread (AsyncEvaluator) on snapshots of
+          the weights, and the training goes on with the next epoch. Their results are written in the row of their
+          epoch in the results of the task when they are ready, at the latest before the test of the best model.
+          The early stopping only uses the validation loss, so it does not wait for the tests.
+        - With eval_tolerance > 0, the tests during training are approximate (sequential_test): each test set is
+          sampled until the interval of the accuracy (eval_confidence) is narrower than eval_tolerance. The number
+          of samples and the width of the interval of each task are kept in the results of the task ("Test
+          samples", "Test interval width"), with the full size and a width of 0 for the exact tests.
+
+    The scheduler also measures the cost of each task (costs): wall-clock and CPU time from the end of the previous
+    task (or from the test of the initial model), epochs, training samples of the task (epochs x size of its training
+    set, without the exemplars replayed by some methods), and the epochs and seconds until the average test accuracy
+    reaches time_to_accuracy x the accuracy of the best model of the task.
+
+    Each evaluation is tagged in the results of the task ("Test set"), so the curves of the workbook show which
+    data was used for each epoch, and its accuracies and confusion matrices are stored in the accuracy matrix of
+    the method (utils/accuracy_matrix.py).
+    """
+    def __init__(self, datasets, args, train_datasets=None):
+        """
+        :param datasets: list of tasks [train, val, test]
+        :param args: arguments from the command line (eval_every, eval_subset, eval_async, eval_tolerance,
+                     eval_confidence, eval_batch_size, time_to_accuracy, time_phases, seed, epochs)
+        :param train_datasets: list of tasks the method is trained on (default: datasets)
+        """
+        self.datasets = datasets
+        self.train_datasets = train_datasets or datasets
+        self.every = max(1, args.eval_every)
+        self.accuracy_matrix = AccuracyMatrix(len(self.train_datasets), len(datasets), args.epochs)
+
+        timer.enable(args.time_phases) # The scheduler is created at the start of each method
+        self.time_to_accuracy = args.time_to_accuracy
+        self.costs = [] # Cost of each task (dict)
+        self.epoch_times = [] # (wall, CPU) seconds of the task at the end of each epoch
+        self.task_start = (time.perf_counter(), time.process_time())
+
+        if args.eval_subset > 0:
+            self.name = f"subset ({args.eval_subset} per class)"
+            self.eval_datasets = [(None, None, stratified_subset(test_dataset, args.eval_subset, args.seed))
+                                  for _, _, test_dataset in datasets]
+        else:
+            self.name = "full"
+            self.eval_datasets = datasets
+
+        self.sequential = None
+        if args.eval_tolerance > 0:
+            self.name += f", sequential (interval width <= {args.eval_tolerance}%)"
+            self.sequential = dict(tolerance=args.eval_tolerance, confidence=args.eval_confidence,
+                                   first_size=args.eval_batch_size, seed=args.seed)
+
+        self.evaluator = None
+        self.replicas = {} # {id of a tested model: (model, replica of the model for the evaluator)}
+        if args.eval_async:
+            global _evaluator
+            if _evaluator is None:
+                _evaluator = AsyncEvaluator()
+            self.evaluator = _evaluator
+
+    @timer.timed("baseline test")
+    def baseline(self, test_fn):
+        """
+        Test the initial model on the full test sets (reference of the forward transfer). The methods start from
+        the same initialization (args.seed), so the test runs once and the next methods reuse its accuracies.
+        """
+        key = tuple(id(test_dataset) for _, _, test_dataset in self.datasets)
+        if key not in _baselines:
+            print("="*100)
+            print("Test of the initial model on the full test sets")
+            results = test_fn(self.datasets)
+            _baselines[key] = (self.datasets, results[2], results[4])
+        self.accuracy_matrix.record_baseline(*_baselines[key][1:])
+        self.task_start = (time.perf_counter(), time.process_time()) # The first task starts after this test
+
+    @timer.timed("test")
+    def evaluate(self, id_task, epoch, dicc_results, model, test_fn):
+        """
+        Test the model after an epoch, if it is scheduled.
+
+        :param id_task: task being trained (from 0)
+        :param epoch: epoch of the task (from 0)
+        :param dicc_results: results of the task, where the evaluation set is tagged
+        :param model: model to test
+        :param test_fn: function test_fn(model, datasets) that tests a model on a list of tasks and returns
+                        (test_tasks_id, test_tasks_loss, test_tasks_accuracy, avg_accuracy, test_tasks_confusion)
+        :return: results of test_fn without the confusion matrices (stored in the accuracy matrix), or empty
+                 results if the test is not scheduled or runs in the evaluator thread
+        """
+        self.epoch_times.append(self._elapsed()) # End of the training of the epoch
+
+        if self.evaluator is not None:
+            self._write_async_results()
+
+        if (epoch + 1) % self.every != 0:
+            dicc_results.setdefault("Test set", []).append("-")
+            print(f"Test skipped (evaluation every {self.every} epochs)")
+            return [], [], [], None
+
+        dicc_results.setdefault("Test set", []).append(self.name)
+        row = len(dicc_results["Test set"]) - 1 # Row of this epoch (appended by the method after this call)
+        if self.sequential is not None:
+            test_fn = functools.partial(sequential_test, test_fn, **self.sequential)
+
+        if self.evaluator is not None:
+            self.evaluator.submit(self._replica(model), model, test_fn, self.eval_datasets,
+                                  (dicc_results, row, id_task, epoch))
+            print("Test submitted to the evaluator thread")
+            return [], [], [], None
+
+        results = test_fn(model, self.eval_datasets)
+        self._record(dicc_results, row, id_task, epoch, results)
+        return results[:4]
+
+    def _record(self, dicc_results, row, id_task, epoch, results):
+        """
+        Store the accuracies and confusion matrices of a test in the accuracy matrix, and the number of samples and
+        the width of the interval of each task in the row of the test (approximate tests).
+        """
+        self.accuracy_matrix.record(id_task, epoch, results[2], results[4])
+        if self.sequential is None:
+            return
+        samples, width = results[5:7] if len(results) > 5 else ([len(test_dataset) for _, _, test_dataset in
+                                                                  self.datasets], [0.] * len(self.datasets))
+        for key, value in [("Test samples", samples), ("Test interval width", width)]:
+            column = dicc_results.setdefault(key, [])
+            column += [[]] * (row + 1 - len(column)) # Rows of the epochs that were not tested
+            column[row] = value
+
+    def _replica(self, model):
+        """
+        :return: replica of the model for the evaluator, copied again if the architecture of the model changed
+        """
+        entry = self.replicas.get(id(model))
+        if entry is None or entry[1].state_dict().keys() != model.state_dict().keys():
+            entry = (model, copy.deepcopy(model)) # The model is kept with its replica, so its id is not reused
+            self.replicas[id(model)] = entry
+        return entry[1]
+
+    def _write_async_results(self, wait=False):
+        """
+        Write the results of the tests finished by the evaluator thread in the rows of their epochs.
+        """
+        for (dicc_results, row, id_task, epoch), results in self.evaluator.collect(wait):
+            self._record(dicc_results, row, id_task, epoch, results)
+            for key, value in zip(["Test task", "Test loss", "Test accuracy", "Test average accuracy"], results):
+                dicc_results[key][row] = value
+
+    @timer.timed("final test")
+    def final(self, id_task, dicc_results, test_fn):
+        """
+        Test the best model of the task on the full test sets.
+        """
+        timer.epoch(None) # The next phases of the task are after its epochs
+        if self.evaluator is not None:
+            self._write_async_results(wait=True)
+
+        print("="*100)
+        print("Test of the best model of the task on the full test sets")
+        dicc_results.setdefault("Test set", []).append("full (best model)")
+        results = test_fn(self.datasets)
+        self._record(dicc_results, len(dicc_results["Test set"]) - 1, id_task, None, results)
+        self._record_cost(id_task, results[3])
+        return results[:4]
+
+    def _elapsed(self):
+        return time.perf_counter() - self.task_start[0], time.process_time() - self.task_start[1]
+
+    def _record_cost(self, id_task, final_accuracy):
+        """
+        Add the cost of the task to costs, and start the clock of the next task.
+        """
+        wall, cpu = self._elapsed()
+        epochs = len(self.epoch_times)
+
+        # First tested epoch with an average accuracy above the target (a fraction of the accuracy of the task)
+        target = self.time_to_accuracy * final_accuracy
+        epochs_to_target, seconds_to_target = None, None
+        for epoch, (wall_epoch, _) in enumerate(self.epoch_times):
+            accuracies = self.accuracy_matrix.accuracies[id_task, :, epoch]
+            if not np.isnan(accuracies).any() and accuracies.mean() >= target:
+                epochs_to_target, seconds_to_target = epoch + 1, wall_epoch
+                break
+
+        self.costs.append({"Task": id_task + 1, "Wall time (s)": wall, "CPU time (s)": cpu, "Epochs": epochs,
+                           "Samples": epochs * len(self.train_datasets[id_task][0]),
+                           "Final average accuracy": final_accuracy, "Epochs to target": epochs_to_target,
+                           "Seconds to target": seconds_to_target})
+        reached = "not reached" if epochs_to_target is None else \
+            f"reached after {epochs_to_target} epochs ({seconds_to_target:.1f}s)"
+        print(f"Cost of the task: {wall:.1f}s ({cpu:.1f}s CPU), {epochs} epochs, "
+              f"{self.time_to_accuracy:.0%} of the accuracy of the task {reached}")
+
+        self.epoch_times = []
+        self.task_start = (time.perf_counter(), time.process_time())
+
+
+def baseline_accuracy(datasets):
+    """
+    :return: accuracy of the initial model on the test sets of the tasks (EvalScheduler.baseline), or None if it
+             has not been tested in this run
+    """
+    key = tuple(id(test_dataset) for _, _, test_dataset in datasets)
+    return _baselines[key][1] if key in _baselines else None
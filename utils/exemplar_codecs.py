@@ -0,0 +1,161 @@
+import math
+
+import torch
+
+
+class Float32Codec(object):
+    """
+    Storage of the exemplars without compression (4 bytes per pixel).
+
+    A codec turns the images of the exemplars into codes of fixed shape (encode) and the codes of a batch back
+    into images (decode), so the exemplars are stored compressed and only the sampled ones are decoded.
+    """
+    def __init__(self, image_shape):
+        self.image_shape = tuple(image_shape)
+        self.num_pixels = math.prod(self.image_shape)
+        self.code_shape = self.image_shape
+        self.code_dtype = torch.float32
+
+    def sample_bytes(self):
+        """
+        Number of bytes of the code of an image.
+        """
+        return math.prod(self.code_shape) * torch.empty((), dtype=self.code_dtype).element_size()
+
+    def class_bytes(self):
+        """
+        Number of bytes shared by the exemplars of a class (e.g. the basis of PCA).
+        """
+        return 0
+
+    def fit(self, images, labels):
+        """
+        Fit the parameters of the codec to the images of the classes that have not been seen yet.
+        """
+        pass
+
+    def encode(self, images, labels):
+        return images.to(self.code_dtype)
+
+    def decode(self, codes, labels):
+        return codes.float()
+
+
+class Uint8Codec(Float32Codec):
+    """
+    The pixels (in [0, 1]) are stored as integers in [0, 255] (1 byte per pixel). The datasets are loaded from
+    8-bit images, so the exemplars are recovered without loss.
+    """
+    def __init__(self, image_shape):
+        super(Uint8Codec, self).__init__(image_shape)
+        self.code_dtype = torch.uint8
+
+    def encode(self, images, labels):
+        return (images.clamp(0, 1) * 255).round().to(torch.uint8)
+
+    def decode(self, codes, labels):
+        return codes.float() / 255
+
+
+class Int4Codec(Float32Codec):
+    """
+    The pixels (in [0, 1]) are quantized to 16 levels and two pixels are packed in each byte (0.5 bytes per
+    pixel).
+    """
+    def __init__(self, image_shape):
+        super(Int4Codec, self).__init__(image_shape)
+        self.code_shape = ((self.num_pixels + 1) // 2,)
+        self.code_dtype = torch.uint8
+
+    def encode(self, images, labels):
+        levels = (images.reshape(images.size(0), -1).clamp(0, 1) * 15).round().to(torch.uint8)
+        if self.num_pixels % 2:
+            levels = torch.cat((levels, levels.new_zeros((levels.size(0), 1))), dim=1)
+        return levels[:, 0::2] | (levels[:, 1::2] << 4)
+
+    def decode(self, codes, labels):
+        levels = torch.stack((codes & 15, codes >> 4), dim=2).reshape(codes.size(0), -1)[:, :self.num_pixels]
+        return (levels.float() / 15).reshape(codes.size(0), *self.image_shape)
+
+
+class PCACodec(Float32Codec):
+    """
+    The images of each class are projected on the first principal components of the class (rank coefficients
+    in float16 per image), and the mean and the basis of each class are stored once in float16.
+
+    The basis of a class is fitted the first time the class is seen (with the exemplars that are encoded).
+    """
+    def __init__(self, image_shape, num_classes, rank):
+        super(PCACodec, self).__init__(image_shape)
+        self.rank = rank
+        self.code_shape = (rank,)
+        self.code_dtype = torch.float16
+        self.means = torch.zeros((num_classes, self.num_pixels), dtype=torch.float16)
+        self.bases = torch.zeros((num_classes, rank, self.num_pixels), dtype=torch.float16)
+        self.fitted = set()
+
+    def class_bytes(self):
+        return (self.rank + 1) * self.num_pixels * 2
+
+    def fit(self, images, labels):
+        flat = images.reshape(images.size(0), -1).float()
+        for cls in labels.unique().tolist():
+            if cls in self.fitted:
+                continue
+            samples = flat[labels == cls]
+            mean = samples.mean(dim=0)
+            # Right singular vectors of the centered samples (at most as many components as samples)
+            _, _, components = torch.linalg.svd(samples - mean, full_matrices=False)
+            rank = min(self.rank, components.size(0))
+            self.means[cls] = mean.to(self.means)
+            self.bases[cls].zero_()
+            self.bases[cls, :rank] = components[:rank].to(self.bases)
+            self.fitted.add(cls)
+
+    def encode(self, images, labels):
+        flat = images.reshape(images.size(0), -1).float()
+        means, bases = self.means.to(flat.device), self.bases.to(flat.device)
+        codes = flat.new_empty((flat.size(0), self.rank))
+        for cls in labels.unique().tolist():
+            mask = labels == cls
+            codes[mask] = (flat[mask] - means[cls].float()) @ bases[cls].float().t()
+        return codes.to(self.code_dtype)
+
+    def decode(self, codes, labels):
+        means, bases = self.means.to(codes.device), self.bases.to(codes.device)
+        images = means[labels].float()
+        # One product per class of the batch, instead of gathering a basis per image
+        for cls in labels.unique().tolist():
+            mask = labels == cls
+            images[mask] += codes[mask].float() @ bases[cls].float()
+        return images.reshape(codes.size(0), *self.image_shape)
+
+
+def make_codec(args, image_shape, num_classes):
+    """
+    Create the codec of the exemplars chosen in the arguments (exemplar_codec).
+    """
+    if args.exemplar_codec == "uint8":
+        return Uint8Codec(image_shape)
+    elif args.exemplar_codec == "int4":
+        return Int4Codec(image_shape)
+    elif args.exemplar_codec == "pca":
+        return PCACodec(image_shape, num_classes, args.exemplar_pca_rank)
+    return Float32Codec(image_shape)
+
+
+def memory_capacity(args, codec, num_classes):
+    """
+    Number of exemplars that fit in the memory: memory_size, or the number of exemplars (code and label) that fit
+    in memory_bytes once the parameters of each class of the codec are stored.
+
+    Raises ValueError if memory_bytes cannot hold the parameters of the codec and one exemplar per class.
+    """
+    if args.memory_bytes <= 0:
+        return args.memory_size
+    bytes_per_exemplar = codec.sample_bytes() + torch.empty((), dtype=torch.long).element_size()
+    min_bytes = num_classes * (codec.class_bytes() + bytes_per_exemplar)
+    if args.memory_bytes < min_bytes:
+        raise ValueError(f"memory_bytes={args.memory_bytes} cannot hold the parameters of the {args.exemplar_codec} "
+                         f"codec and one exemplar per class ({num_classes} classes): at least {min_bytes} bytes")
+    return (args.memory_bytes - num_classes * codec.class_bytes()) // bytes_per_exemplar
@@ -0,0 +1,106 @@
+import torch
+
+
+class ExemplarMemory(object):
+    """
+    Memory of exemplars with a fixed capacity: one preallocated tensor for the images and one for the labels,
+    with a table of (offset, size) for each class.
+
+    Reducing the number of exemplars per class only updates the table (the exemplars are sorted by herding, so
+    the first m of a class are kept), and the gaps are removed when the memory is compacted. The exemplars are
+    copied into the memory, so they do not keep alive the tensors they were taken from.
+
+    With a codec (utils/exemplar_codecs.py), the memory stores the codes of the images instead of the images, and
+    the exemplars are decoded when they are sampled (ReplaySampler with the same codec) or with decode.
+    """
+    def __init__(self, capacity, image_shape, dtype=torch.float32, codec=None):
+        """
+        :param capacity: maximum number of exemplars (memory_size)
+        :param image_shape: shape of an image (channels, height, width)
+        :param dtype: dtype of the images
+        :param codec: codec of the images (None to store them as they are)
+        """
+        self.capacity = capacity
+        self.codec = codec
+        if codec is not None:
+            self.images = torch.empty((capacity, *codec.code_shape), dtype=codec.code_dtype)
+        else:
+            self.images = torch.empty((capacity, *image_shape), dtype=dtype)
+        self.labels = torch.empty((capacity,), dtype=torch.long)
+        self.classes = {} # {class: [offset, size]}, in order of insertion
+        self.end = 0 # First free position after the last class
+        self.compacted = True # No gaps between the classes
+
+    def __len__(self):
+        return sum(size for _, size in self.classes.values())
+
+    def class_size(self, cls):
+        return self.classes[cls][1] if cls in self.classes else 0
+
+    def reduce(self, m):
+        """
+        Keep only the first m exemplars of each class.
+        """
+        for table in self.classes.values():
+            if table[1] > m:
+                table[1] = m
+                self.compacted = False
+
+    def add(self, cls, images, labels):
+        """
+        Add the exemplars of a class (sorted by priority) at the end of the memory.
+        """
+        size = images.size(0)
+        if self.end + size > self.capacity:
+            self.compact()
+        if self.end + size > self.capacity:
+            raise ValueError(f"The exemplar memory is full: {len(self)} + {size} > {self.capacity} exemplars")
+
+        if self.codec is not None:
+            self.codec.fit(images, labels)
+            images = self.codec.encode(images, labels)
+        self.images[self.end:self.end + size].copy_(images)
+        self.labels[self.end:self.end + size].copy_(labels)
+        self.classes[cls] = [self.end, size]
+        self.end += size
+
+    def compact(self):
+        """
+        Move the classes to remove the gaps left by reduce.
+        """
+        if self.compacted:
+            return
+        position = 0
+        for table in self.classes.values():
+            offset, size = table
+            if offset != position:
+                # The source and the destination may overlap
+                self.images[position:position + size] = self.images[offset:offset + size].clone()
+                self.labels[position:position + size] = self.labels[offset:offset + size].clone()
+                table[0] = position
+            position += size
+        self.end = position
+        self.compacted = True
+
+    def tensors(self):
+        """
+        :return: images (or codes) and labels of all the exemplars (views of the memory, valid until it is modified)
+        """
+        self.compact()
+        return self.images[:self.end], self.labels[:self.end]
+
+    def decode(self, images, labels):
+        """
+        :return: images of exemplars returned by tensors (decoded if the memory has a codec)
+        """
+        if self.codec is None:
+            return images
+        return self.codec.decode(images, labels)
+
+    def nbytes(self):
+        """
+        :return: number of bytes of the memory (images or codes, labels and parameters of the codec)
+        """
+        class_bytes = self.codec.class_bytes() * len(self.classes) if self.codec is not None else 0
+        return (self.images.numel() * self.images.element_size() + self.labels.numel() * self.labels.element_size() +
+                class_bytes)
@@ -0,0 +1,165 @@
+import os
+import hashlib
+
+import torch
+import torch.nn.functional as F
+
+from utils.utils import state_dict_hash
+from utils.timers import timer
+
+# Path of the herding rankings. It is outside the folder of the experiment (which is removed at the start of each
+# run), so the rankings are reused across runs and memory sizes
+PATH_HERDING_CACHE = "./models/models_saved/Herding_cache"
+
+
+def extract_features(model, images, device, chunk_size=512):
+    """
+    Compute the normalized outputs of the feature extractor of a model, in chunks of bounded size.
+
+    :param model: model with feature_extractor (in evaluation mode)
+    :param images: tensor with the images
+    :param device: device of the model
+    :param chunk_size: maximum number of images per forward pass
+    :return: tensor (num_images, feature_dim) on the device
+    """
+    features = []
+    with torch.no_grad():
+        for chunk in images.split(chunk_size):
+            features.append(F.normalize(model.feature_extractor(chunk.to(device))))
+    if not features:
+        return torch.empty((0, 0), device=device)
+    return torch.cat(features, dim=0)
+
+
+def herding_selection(model, images, labels, classes, m, device, chunk_size=512, max_elements=2**25):
+    """
+    Select the exemplars of each class with the herding strategy of iCaRL: the k-th exemplar is the sample that
+    brings the mean of the k selected features closest to the mean of the class (Equations 4 and 5), and each
+    sample is selected at most once.
+
+    The classes are processed in groups, with their features padded in a (classes, samples, feature_dim) tensor
+    of at most max_elements elements. Instead of computing the distances from scratch at each step, the dot
+    products between the features and the sum of the selected features are updated incrementally, so each step
+    is a batched matrix-vector product plus a masked argmin for all the classes of the group.
+
+    :param model: model with feature_extractor (in evaluation mode)
+    :param images: tensor with the images of the task
+    :param labels: tensor with the labels of the task
+    :param classes: classes to select exemplars from
+    :param m: number of exemplars per class
+    :param device: device of the model
+    :param chunk_size: maximum number of images per forward pass of the feature extractor
+    :param max_elements: maximum number of elements of the padded features of a group of classes
+    :return: dict {class: indices of the selected samples in images, in order of selection}
+    """
+    indices_classes = [torch.where(labels == cls)[0] for cls in classes]
+    selection = {}
+    if len(images) == 0:
+        return {cls: indices for cls, indices in zip(classes, indices_classes)}
+
+    with torch.no_grad():
+        feature_dim = model.feature_extractor(images[:1].to(device)).size(1)
+
+    # Group the classes, so the padded features of a group fit in max_elements
+    groups, group, group_max = [], [], 0
+    for position, indices in enumerate(indices_classes):
+        size = max(group_max, len(indices))
+        if group and (len(group) + 1) * size * feature_dim > max_elements:
+            groups.append(group)
+            group, size = [], len(indices)
+        group.append(position)
+        group_max = size
+    if group:
+        groups.append(group)
+
+    for group in groups:
+        indices_group = [indices_classes[position] for position in group]
+        sizes = torch.tensor([len(indices) for indices in indices_group], device=device)
+        num_classes, max_size = len(group), int(sizes.max())
+
+        if max_size == 0:
+            for position in group:
+                selection[classes[position]] = indices_classes[position]
+            continue
+
+        # Features of the group, padded to (num_classes, max_size, feature_dim)
+        features = extract_features(model, images[torch.cat(indices_group)], device, chunk_size)
+        padded = features.new_zeros((num_classes, max_size, features.size(1)))
+        valid = torch.arange(max_size, device=device).unsqueeze(0) < sizes.unsqueeze(1) # (num_classes, max_size)
+        padded[valid] = features
+        del features
+
+        class_mean = padded.sum(dim=1) / sizes.clamp(min=1).unsqueeze(1) # (num_classes, feature_dim)
+        mean_dot = torch.bmm(padded, class_mean.unsqueeze(2)).squeeze(2) # mean . f, (num_classes, max_size)
+        norm_sq = (padded ** 2).sum(dim=2) # ||f||^2
+        sum_dot = torch.zeros_like(mean_dot) # (sum of the selected features) . f
+
+        available = valid.clone()
+        selected = torch.full((num_classes, m), -1, dtype=torch.long, device=device)
+        rows = torch.arange(num_classes, device=device)
+
+        for k in range(min(m, max_size)):
+            # ||mean - (f + S) / (k + 1)||^2 without the terms that do not depend on f (Equation 4)
+            score = norm_sq / (k + 1) ** 2 - 2 / (k + 1) * (mean_dot - sum_dot / (k + 1))
+            score = score.masked_fill(~available, float("inf"))
+            index = score.argmin(dim=1) # Equation 5
+            active = available[rows, index] # Classes with samples left
+
+            selected[rows[active], k] = index[active]
+            available[rows[active], index[active]] = False
+            sum_dot += torch.bmm(padded, (padded[rows, index] * active.unsqueeze(1)).unsqueeze(2)).squeeze(2)
+
+        for row, position in enumerate(group):
+            chosen = selected[row][selected[row] >= 0].to(indices_classes[position].device)
+            selection[classes[position]] = indices_classes[position][chosen]
+
+    return selection
+
+
+@timer.timed("herding")
+def herding_ranking(model, images, labels, classes, m, device, args, chunk_size=512, max_elements=2**25):
+    """
+    Select the exemplars of each class with herding, reusing the rankings computed for other memory sizes.
+
+    Herding is greedy, so the m exemplars of a class are the first m samples of its full ranking (e.g. the 45
+    exemplars of a memory of 10% are the first 45 of the 225 of a memory of 50%). The full ranking of each class
+    is computed once and saved with the hash of the model and of the images of the class as name, so the runs
+    with other memory sizes, and the methods that select the exemplars with the same model, only slice it.
+
+    :param model: model with feature_extractor (in evaluation mode)
+    :param images: tensor with the images of the task
+    :param labels: tensor with the labels of the task
+    :param classes: classes to select exemplars from
+    :param m: number of exemplars per class
+    :param device: device of the model
+    :param args: arguments from the command line (herding_cache: "on" or "off")
+    :param chunk_size: maximum number of images per forward pass of the feature extractor
+    :param max_elements: maximum number of elements of the padded features of a group of classes
+    :return: dict {class: indices of the selected samples in images, in order of selection}
+    """
+    if args.herding_cache == "off":
+        return herding_selection(model, images, labels, classes, m, device, chunk_size, max_elements)
+
+    model_hash = state_dict_hash(model)
+    indices_classes, paths, rankings = {}, {}, {}
+    for cls in classes:
+        indices_classes[cls] = torch.where(labels == cls)[0]
+        images_class = images[indices_classes[cls]]
+        sha = hashlib.sha1(f"{model_hash}-{tuple(images_class.shape)}".encode())
+        sha.update(images_class.detach().cpu().contiguous().numpy().tobytes())
+        paths[cls] = f"{PATH_HERDING_CACHE}/Herding-{args.dataset}-{sha.hexdigest()}.pt"
+        if os.path.exists(paths[cls]):
+            rankings[cls] = torch.load(paths[cls]) # Positions of the samples in the class, in order of selection
+
+    missing = [cls for cls in classes if cls not in rankings]
+    if missing:
+        print(f"Computing the herding ranking of classes: {missing}")
+        max_size = max(len(indices_classes[cls]) for cls in missing)
+        selection = herding_selection(model, images, labels, missing, max_size, device, chunk_size, max_elements)
+        os.makedirs(PATH_HERDING_CACHE, exist_ok=True)
+        for cls in missing:
+            # The indices of the class are sorted, so their positions are found with a binary search
+            rankings[cls] = torch.searchsorted(indices_classes[cls], selection[cls]).cpu()
+            torch.save(rankings[cls], paths[cls])
+
+    return {cls: indices_classes[cls][rankings[cls][:m].to(indices_classes[cls].device)] for cls in classes}
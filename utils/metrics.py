@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+
+class Metrics(object):
+    """
+    Sums of the losses and correct predictions of an epoch, accumulated on the device.
+
+    The values of each batch are added as tensors (no .item() and no synchronization with the device per batch),
+    and the sums or the averages are copied to the host once, at the end of the epoch (sums, means).
+    """
+    def __init__(self):
+        self.totals = {} # {name: sum of the values (tensor on the device, or number)}
+        self.counts = {} # {name: number of terms of the sum}
+
+    def add(self, name, value, count=1):
+        """
+        :param name: name of the metric
+        :param value: tensor (or number) to add, e.g. the mean loss of a batch
+        :param count: number of terms of value (1 for a mean of the batch, the batch size for a sum over the batch)
+        """
+        if torch.is_tensor(value):
+            value = value.detach()
+        self.totals[name] = self.totals[name] + value if name in self.totals else value
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def add_correct(self, name, outputs, targets):
+        """
+        Add the number of correct predictions of a batch (argmax of the outputs).
+        """
+        self.add(name, (outputs.argmax(dim=1) == targets).sum(), targets.size(0))
+
+    def add_confusion(self, name, outputs, targets):
+        """
+        Add the confusion matrix of a batch (true class x predicted class, one class per output of the model),
+        counted with a single bincount.
+        """
+        num_classes = outputs.size(1)
+        pairs = targets * num_classes + outputs.argmax(dim=1)
+        self.add(name, torch.bincount(pairs, minlength=num_classes * num_classes).view(num_classes, num_classes),
+                 targets.size(0))
+
+    def sums(self):
+        """
+        :return: dict {name: sum}, with a single copy of the sums from the device (numbers, and int32 arrays for
+                 the confusion matrices)
+        """
+        values = dict(self.totals)
+        tensors = {name: value for name, value in values.items() if torch.is_tensor(value)}
+        if tensors:
+            flat = torch.cat([value.double().reshape(-1) for value in tensors.values()]).cpu().numpy()
+            start = 0
+            for name, value in tensors.items():
+                if value.dim() == 0:
+                    values[name] = float(flat[start])
+                else:
+                    values[name] = flat[start:start + value.numel()].astype(np.int32).reshape(value.shape)
+                start += value.numel()
+        return values
+
+    def means(self):
+        """
+        :return: dict {name: sum / count}, with a single copy of the sums from the device (the confusion matrices
+                 are returned as counts)
+        """
+        return {name: value if isinstance(value, np.ndarray) else value / self.counts[name]
+                for name, value in self.sums().items()}
+
+    def mean(self, name):
+        return self.means()[name]
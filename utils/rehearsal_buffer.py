@@ -0,0 +1,114 @@
+import torch
+
+
+class RehearsalBuffer(object):
+    """
+    Rehearsal buffer of fixed size, stored in one preallocated tensor for the images and one for the labels, and
+    updated with class-balanced reservoir sampling (Chrysakis and Moens, 2020):
+
+        - While the buffer is not full, every sample is stored.
+        - When it is full, a sample of a class that is not among the largest ones in the buffer replaces a random
+          sample of one of the largest classes.
+        - Otherwise, the n-th sample seen of its class replaces a random sample of the same class with
+          probability (samples of the class in the buffer) / n, as in reservoir sampling.
+
+    So the classes end up with the same number of samples whatever their frequency, and the size of the buffer
+    (and the cost of replaying it) does not grow with the number of tasks.
+
+    With a codec (utils/exemplar_codecs.py), the buffer stores the codes of the images instead of the images.
+    """
+    def __init__(self, capacity, image_shape, dtype=torch.float32, codec=None):
+        """
+        :param capacity: maximum number of samples (memory_size)
+        :param image_shape: shape of an image (channels, height, width)
+        :param dtype: dtype of the images
+        :param codec: codec of the images (None to store them as they are)
+        """
+        self.capacity = capacity
+        self.codec = codec
+        if codec is not None:
+            self.images = torch.empty((capacity, *codec.code_shape), dtype=codec.code_dtype)
+        else:
+            self.images = torch.empty((capacity, *image_shape), dtype=dtype)
+        self.labels = torch.empty((capacity,), dtype=torch.long)
+        self.size = 0
+        self.slots = {} # {class: positions of its samples in the buffer}
+        self.seen = {} # {class: number of samples seen}
+
+    def __len__(self):
+        return self.size
+
+    def update(self, images, labels):
+        """
+        Stream the samples of a task (in random order) through the buffer.
+
+        The positions to overwrite are decided first, so the images are copied with a single indexed assignment.
+
+        :param images: tensor with the images of the task
+        :param labels: tensor with the labels of the task
+        """
+        num_samples = labels.size(0)
+        order = torch.randperm(num_samples).tolist()
+        labels_order = labels[order].tolist()
+        draws = torch.rand((num_samples, 3)).tolist() # Random numbers of each sample
+
+        sources = {} # {position in the buffer: index of the sample in images}
+        for index, cls, (accept, pick_class, pick_slot) in zip(order, labels_order, draws):
+            self.seen[cls] = self.seen.get(cls, 0) + 1
+            slots_class = self.slots.setdefault(cls, [])
+
+            if self.size < self.capacity:
+                slot = self.size
+                self.size += 1
+                slots_class.append(slot)
+            else:
+                largest = max(len(slots) for slots in self.slots.values())
+                if len(slots_class) < largest:
+                    # Take the place of a sample of one of the largest classes
+                    candidates = [c for c, slots in self.slots.items() if len(slots) == largest]
+                    slots_victim = self.slots[candidates[int(pick_class * len(candidates))]]
+                    position = int(pick_slot * len(slots_victim))
+                    slot = slots_victim[position]
+                    slots_victim[position] = slots_victim[-1]
+                    slots_victim.pop()
+                    slots_class.append(slot)
+                elif accept * self.seen[cls] < len(slots_class):
+                    # Reservoir sampling inside the class
+                    slot = slots_class[int(pick_slot * len(slots_class))]
+                else:
+                    continue
+
+            sources[slot] = index
+
+        if sources:
+            slots = torch.tensor(list(sources.keys()), dtype=torch.long)
+            indices = torch.tensor(list(sources.values()), dtype=torch.long)
+            images_new, labels_new = images[indices], labels[indices]
+            if self.codec is not None:
+                self.codec.fit(images_new, labels_new)
+                images_new = self.codec.encode(images_new, labels_new)
+            self.images[slots] = images_new.to(self.images.dtype)
+            self.labels[slots] = labels_new
+
+    def class_sizes(self):
+        return {cls: len(slots) for cls, slots in sorted(self.slots.items()) if slots}
+
+    def tensors(self):
+        """
+        :return: images (or codes) and labels of the samples of the buffer (views of the buffer)
+        """
+        return self.images[:self.size], self.labels[:self.size]
+
+    def decode(self, images, labels):
+        """
+        :return: images of samples returned by tensors (decoded if the buffer has a codec)
+        """
+        if self.codec is None:
+            return images
+        return self.codec.decode(images, labels)
+
+    def nbytes(self):
+        """
+        :return: number of bytes of the images (or codes) and labels of the buffer
+        """
+        return self.images.numel() * self.images.element_size() + self.labels.numel() * self.labels.element_size()
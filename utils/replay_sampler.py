@@ -0,0 +1,126 @@
+import torch
+
+
+class ReplaySampler(object):
+    """
+    Sampler of batches from a set of samples stored as contiguous tensors on the device (e.g. the exemplar set
+    of BiMeCo, or the training data of the current task).
+
+    The batches are drawn by gathering random indices, so no DataLoader has to be created again when the samples
+    run out. Without replacement, the samples are drawn from a random permutation, which is renewed when there
+    are not enough samples left for a batch. With class_balanced, every class has the same probability of being
+    drawn, whatever its number of samples. With a codec, the first tensor has the codes of the images, and only
+    the images of the batches are decoded.
+    """
+    def __init__(self, tensors, device, replacement=False, class_balanced=False, codec=None):
+        """
+        :param tensors: list of tensors with the same number of samples (images, labels, ...). The labels must
+                        be the second tensor
+        :param device: device where the samples are stored
+        :param replacement: draw the samples with replacement
+        :param class_balanced: draw the samples with probability inversely proportional to the size of their class
+        :param codec: codec of the images (utils/exemplar_codecs.py), or None if the first tensor has the images
+        """
+        self.tensors = [tensor.to(device).contiguous() for tensor in tensors]
+        self.device = device
+        self.codec = codec
+        # Empty tensors with the shape and dtype of the samples that are drawn (the images are decoded)
+        self.templates = [tensor[:0] for tensor in self.tensors]
+        if codec is not None:
+            self.templates[0] = torch.empty((0, *codec.image_shape), device=device)
+        self.replacement = replacement
+        self.num_samples = self.tensors[0].size(0)
+
+        self.weights = None # Probability of each sample (class balanced)
+        if class_balanced:
+            labels = self.tensors[1]
+            self.weights = 1.0 / torch.bincount(labels).float()[labels]
+
+        self._permutation = None # Samples not drawn yet (without replacement)
+        self._position = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def sample_indices(self, batch_size):
+        """
+        Draw the indices of a batch of samples.
+        """
+        batch_size = min(batch_size, self.num_samples)
+
+        if self.weights is not None:
+            return torch.multinomial(self.weights, batch_size, replacement=self.replacement)
+
+        if self.replacement:
+            return torch.randint(self.num_samples, (batch_size,), device=self.device)
+
+        if self._permutation is None or self._position + batch_size > self.num_samples:
+            self._permutation = torch.randperm(self.num_samples, device=self.device)
+            self._position = 0
+        indices = self._permutation[self._position:self._position + batch_size]
+        self._position += batch_size
+        return indices
+
+    def sample(self, batch_size):
+        """
+        Draw a batch of samples (a new tensor for each of the stored tensors).
+        """
+        indices = self.sample_indices(batch_size)
+        samples = [tensor.index_select(0, indices) for tensor in self.tensors]
+        if self.codec is not None:
+            samples[0] = self.codec.decode(samples[0], samples[1])
+        return samples
+
+    def sample_into(self, outputs, batch_size):
+        """
+        Draw a batch of samples and write it in the given tensors (e.g. slices of a preallocated buffer).
+
+        :return: number of samples drawn
+        """
+        indices = self.sample_indices(batch_size)
+        size = indices.size(0)
+        for position, (tensor, output) in enumerate(zip(self.tensors, outputs)):
+            if position == 0 and self.codec is not None:
+                continue
+            torch.index_select(tensor, 0, indices, out=output[:size])
+        if self.codec is not None:
+            outputs[0][:size].copy_(self.codec.decode(self.tensors[0].index_select(0, indices), outputs[1][:size]))
+        return size
+
+
+class MixedBatch(object):
+    """
+    Preallocated buffer to build the batches that mix samples of the current task and exemplars
+    (e.g. torch.cat((images, images_exem))), without allocating new tensors at each training step.
+
+    The buffer grows if a larger batch is needed. The returned tensors are views of the buffer, so they are
+    overwritten by the next call to fill.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.buffers = None
+
+    def _allocate(self, tensors, size):
+        if self.buffers is None or self.buffers[0].size(0) < size:
+            self.buffers = [torch.empty((size, *tensor.shape[1:]), dtype=tensor.dtype, device=self.device)
+                            for tensor in tensors]
+
+    def fill(self, batch, *draws):
+        """
+        :param batch: list of tensors of the batch of the current task (copied first), or None
+        :param draws: pairs (sampler, batch_size) of samples to draw after the batch
+        :return: list of tensors with the mixed batch
+        """
+        reference = batch if batch is not None else draws[0][0].templates
+        size = (batch[0].size(0) if batch is not None else 0) + sum(min(n, len(s)) for s, n in draws)
+        self._allocate(reference, size)
+
+        position = 0
+        if batch is not None:
+            position = batch[0].size(0)
+            for tensor, buffer in zip(batch, self.buffers):
+                buffer[:position].copy_(tensor, non_blocking=True)
+        for sampler, batch_size in draws:
+            position += sampler.sample_into([buffer[position:] for buffer in self.buffers], batch_size)
+
+        return [buffer[:position] for buffer in self.buffers]
@@ -1,11 +1,20 @@
 import os
 import xlsxwriter
+import numpy as np
 
+from utils.accuracy_matrix import AccuracyMatrix, CL_METRICS
 
-def save_global_results(dicc_results_test, args):
+
+def save_global_results(dicc_results_test, args, baseline=None, costs=None):
     """
-    Create an excel file to save the results of the experiments
-    
+    Create an excel file to save the results of the experiments, followed by the continual learning metrics of
+    each method (utils/accuracy_matrix.py).
+
+    :param dicc_results_test: {method: [[test accuracy of each task, average accuracy] after each task]}
+    :param args: arguments from the command line
+    :param baseline: accuracy of the initial model on each task, for the forward transfer (None to skip it)
+    :param costs: {method: [cost of each task (EvalScheduler.costs)]}, for the "Cost efficiency" worksheet (None
+                  to skip it)
     """
     # Path to save the results
     path_file = f'./results/{args.exp_name}/global_results_{args.dataset}.xlsx'
@@ -43,6 +52,13 @@ def save_global_results(dicc_results_test, args):
         cont_avg_task += args.num_tasks + 1
         cont_tasks += 1
 
+    row_metrics = cont_tasks + 1 # Continual learning metrics, after an empty row
+    for i, name in enumerate(CL_METRICS):
+        worksheet.write(row_metrics + i, 0, name)
+
+    # The model trained on all the tasks is the reference of the intransigence
+    reference = dicc_results_test["Joint datasets"][0][0] if "Joint datasets" in dicc_results_test else None
+
     # Write the results in the excel file
     col = 0
     for key, value in dicc_results_test.items():
@@ -51,6 +67,10 @@ def save_global_results(dicc_results_test, args):
 
         worksheet.write(row, col, key)
         row += 1
+
+        metrics = AccuracyMatrix.from_results(value, baseline).metrics(reference)
+        for i, name in enumerate(CL_METRICS):
+            worksheet.write(row_metrics + i, col, "-" if np.isnan(metrics[name]) else metrics[name])
         if key == "Joint datasets":
             for i in range(args.num_tasks):
                 for j in range(args.num_tasks):
@@ -66,10 +86,54 @@ def save_global_results(dicc_results_test, args):
                 row += 1
             worksheet.write(row, col, value[i][1])
             row += 1
-        
+
+    if costs is not None:
+        save_costs(workbook, merge_format, dicc_results_test, costs, args)
+
     workbook.close()  # Close the workbook
 
 
+def save_costs(workbook, merge_format, dicc_results_test, costs, args):
+    """
+    Add a worksheet with the cost of each task of each method, and the total of each method with its accuracy per
+    CPU hour. The Pareto front is the set of methods that no other method beats in both final average accuracy
+    and CPU time.
+    """
+    worksheet = workbook.add_worksheet("Cost efficiency") # Create a worksheet
+    target = f"{args.time_to_accuracy:.0%} of the accuracy"
+    headers = ["Method", "Task", "Wall time (s)", "CPU time (s)", "Epochs", "Samples", "Final average accuracy",
+               f"Epochs to {target}", f"Seconds to {target}", "Accuracy per CPU hour", "Pareto front"]
+    worksheet.merge_range(0, 0, 0, len(headers) - 1, f"Cost efficiency, Dataset: {args.dataset}", merge_format)
+    for col, header in enumerate(headers):
+        worksheet.write(1, col, header)
+
+    # Total CPU time and final average accuracy of each method
+    totals = {method: (sum(cost["CPU time (s)"] for cost in costs[method]), dicc_results_test[method][-1][1])
+              for method in dicc_results_test if method in costs}
+    def dominated(cpu, accuracy):
+        return any(cpu_other <= cpu and accuracy_other >= accuracy and (cpu_other, accuracy_other) != (cpu, accuracy)
+                   for cpu_other, accuracy_other in totals.values())
+    pareto = {method for method, (cpu, accuracy) in totals.items() if not dominated(cpu, accuracy)}
+
+    row = 2
+    for method, (cpu, accuracy) in totals.items():
+        for cost in costs[method]:
+            worksheet.write(row, 0, method)
+            for col, key in enumerate(["Task", "Wall time (s)", "CPU time (s)", "Epochs", "Samples",
+                                       "Final average accuracy", "Epochs to target", "Seconds to target"], 1):
+                worksheet.write(row, col, "-" if cost[key] is None else cost[key])
+            row += 1
+
+        worksheet.write(row, 0, method)
+        worksheet.write(row, 1, "Total")
+        for col, key in [(2, "Wall time (s)"), (3, "CPU time (s)"), (4, "Epochs"), (5, "Samples")]:
+            worksheet.write(row, col, sum(cost[key] for cost in costs[method]))
+        worksheet.write(row, 6, accuracy)
+        worksheet.write(row, 9, accuracy / (cpu / 3600) if cpu > 0 else "-")
+        worksheet.write(row, 10, "Yes" if method in pareto else "No")
+        row += 2
+
+
 # {'Fine-tuning': [[[95.0, 6.3], 50.65], [[22.42, 75.58], 49.0]], 
 #  'Joint datasets': [[[84.43], 84.43]], 
 #  'Rehearsal 0.1': [[[93.57, 8.72], 51.144999999999996], [[84.5, 73.45], 78.975]], 
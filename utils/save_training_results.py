@@ -1,5 +1,11 @@
+import os
 import xlsxwriter
+import numpy as np
 
+from utils.accuracy_matrix import CL_METRICS
+from utils.timers import timer
+
+@timer.timed("excel")
 def save_training_results(dicc_results, workbook, id_task, training_name="naive"):
     """
     Create an excel file to save the results of the experiments
@@ -17,7 +23,7 @@ def save_training_results(dicc_results, workbook, id_task, training_name="naive"
         'valign': 'vcenter',
         'fg_color': '#D7E4BC'})
     
-    worksheet.merge_range('A1:E1', 'Global metrics', merge_format)
+    worksheet.merge_range('A1:F1', 'Global metrics', merge_format)
     worksheet.merge_range('G1:K1', 'Test task metrics', merge_format)    
 
     # Create the headers
@@ -26,11 +32,15 @@ def save_training_results(dicc_results, workbook, id_task, training_name="naive"
     worksheet.write(1, 2, "Train loss")
     worksheet.write(1, 3, "Val loss")
     worksheet.write(1, 4, "Test average accuracy")
+    worksheet.write(1, 5, "Test set") # Data of the test of each epoch (see utils/evaluation.py)
 
     worksheet.write(1, 6, "Task")
     worksheet.write(1, 7, "Epoch")
     worksheet.write(1, 8, "Test loss")
     worksheet.write(1, 9, "Test accuracy")
+    if "Test samples" in dicc_results: # Approximate tests (see utils/evaluation.py)
+        worksheet.write(1, 10, "Test samples")
+        worksheet.write(1, 11, "Test interval width")
 
     # Write the results in the excel file    
     row = 2
@@ -41,6 +51,8 @@ def save_training_results(dicc_results, workbook, id_task, training_name="naive"
         worksheet.write(row, col+2, dicc_results["Train loss"][i])
         worksheet.write(row, col+3, dicc_results["Val loss"][i])
         worksheet.write(row, col+4, dicc_results["Test average accuracy"][i])
+        if "Test set" in dicc_results:
+            worksheet.write(row, col+5, dicc_results["Test set"][i])
         row += 1
 
     row = 2
@@ -52,7 +64,142 @@ def save_training_results(dicc_results, workbook, id_task, training_name="naive"
             worksheet.write(row, col+7, count)
             worksheet.write(row, col+8, dicc_results["Test loss"][i][j])
             worksheet.write(row, col+9, dicc_results["Test accuracy"][i][j])
+            if i < len(dicc_results.get("Test samples", [])) and dicc_results["Test samples"][i]:
+                worksheet.write(row, col+10, dicc_results["Test samples"][i][j])
+                worksheet.write(row, col+11, dicc_results["Test interval width"][i][j])
             row += 1
         count += 1
     
 
+
+
+@timer.timed("excel")
+def save_accuracy_matrix(accuracy_matrix, workbook):
+    """
+    Add a worksheet with the accuracy matrix of a method (test accuracy on each task after each epoch of each task
+    and of the best model of each task), the accuracy of the initial model and the continual learning metrics.
+    The tests that were not run are written as "-".
+
+    The confusion matrices of the same tests are saved next to the workbook ({name of the workbook}_confusion.npz,
+    one int32 array [test task, true class, predicted class] for each test), and their per-class accuracies are
+    written in a "Per-class accuracy" worksheet.
+    """
+    worksheet = workbook.add_worksheet("Accuracy matrix") # Create a worksheet
+
+    merge_format = workbook.add_format({
+        'bold': 1,
+        'border': 1,
+        'align': 'center',
+        'valign': 'vcenter',
+        'fg_color': '#D7E4BC'})
+
+    num_train_tasks, num_test_tasks, num_epochs = accuracy_matrix.accuracies.shape
+    worksheet.merge_range(0, 0, 0, num_test_tasks + 1, "Accuracy matrix", merge_format)
+
+    def write_value(row, col, value):
+        worksheet.write(row, col, "-" if np.isnan(value) else value)
+
+    # Create the headers
+    worksheet.write(1, 0, "Train task")
+    worksheet.write(1, 1, "Epoch")
+    for j in range(num_test_tasks):
+        worksheet.write(1, j+2, f"Test accuracy on task {j+1}")
+
+    # Write the accuracies of the epochs that were tested, and of the best model of each task
+    row = 2
+    for i in range(num_train_tasks):
+        for epoch in range(num_epochs):
+            accuracies = accuracy_matrix.accuracies[i, :, epoch]
+            if epoch < num_epochs - 1 and np.isnan(accuracies).all():
+                continue
+            worksheet.write(row, 0, i+1)
+            worksheet.write(row, 1, "Best" if epoch == num_epochs - 1 else epoch+1)
+            for j in range(num_test_tasks):
+                write_value(row, j+2, accuracies[j])
+            row += 1
+
+    # Accuracy of the initial model (reference of the forward transfer)
+    worksheet.write(row, 0, "Initial model")
+    for j in range(num_test_tasks):
+        write_value(row, j+2, accuracy_matrix.baseline[j])
+    row += 2
+
+    # Continual learning metrics
+    metrics = accuracy_matrix.metrics()
+    for name in CL_METRICS:
+        worksheet.write(row, 0, name)
+        write_value(row, 2, metrics[name])
+        row += 1
+
+    if accuracy_matrix.confusion:
+        save_confusion_matrices(accuracy_matrix, workbook, merge_format)
+
+
+def save_confusion_matrices(accuracy_matrix, workbook, merge_format):
+    # Tests in the order of the accuracy matrix: epochs of each task, best model of the task, initial model
+    tests = [] # (name in the npz file, train task, epoch, confusion matrices)
+    for (i, epoch), confusion in sorted(accuracy_matrix.confusion.items(),
+                                        key=lambda item: (item[0][0], item[0][1] is None, item[0][1] or 0)):
+        if epoch is None:
+            tests.append((f"task{i+1}_best", i+1, "Best", confusion))
+        else:
+            tests.append((f"task{i+1}_epoch{epoch+1}", i+1, epoch+1, confusion))
+    if accuracy_matrix.baseline_confusion is not None:
+        tests.append(("initial", "Initial model", "", accuracy_matrix.baseline_confusion))
+
+    np.savez_compressed(os.path.splitext(workbook.filename)[0] + "_confusion.npz",
+                        **{name: confusion for name, _, _, confusion in tests})
+
+    worksheet = workbook.add_worksheet("Per-class accuracy") # Create a worksheet
+    num_classes = tests[0][3].shape[1]
+    worksheet.merge_range(0, 0, 0, num_classes + 2, "Per-class accuracy", merge_format)
+
+    # Create the headers
+    worksheet.write(1, 0, "Train task")
+    worksheet.write(1, 1, "Epoch")
+    worksheet.write(1, 2, "Test task")
+    for c in range(num_classes):
+        worksheet.write(1, c+3, f"Class {c}")
+
+    # Accuracy (%) of each class of the test set of each task, "-" for the classes that are not in the task
+    row = 2
+    for _, train_task, epoch, confusion in tests:
+        for j, matrix in enumerate(confusion):
+            worksheet.write(row, 0, train_task)
+            worksheet.write(row, 1, epoch)
+            worksheet.write(row, 2, j+1)
+            for c, (correct, total) in enumerate(zip(np.diagonal(matrix), matrix.sum(axis=1))):
+                worksheet.write(row, c+3, 100. * correct / total if total > 0 else "-")
+            row += 1
+
+
+def save_phase_timings(workbook):
+    """
+    Print the summary of the phase timer (utils/timers.py) and add a worksheet with the time of each phase in each
+    epoch of each task ("-" for the phases outside the epochs), followed by the totals of the method. Nothing is done
+    if the timer is disabled.
+    """
+    if not timer.enabled:
+        return
+    timer.summary()
+
+    worksheet = workbook.add_worksheet("Phase timings") # Create a worksheet
+    for col, header in enumerate(["Task", "Epoch", "Phase", "Seconds", "Calls"]):
+        worksheet.write(0, col, header)
+
+    def order(key):
+        id_task, epoch, path = key
+        return (-1 if id_task is None else id_task, epoch is None, epoch or 0, path)
+
+    row = 1
+    for id_task, epoch, path in sorted(timer.totals, key=order):
+        seconds, calls = timer.totals[(id_task, epoch, path)]
+        worksheet.write(row, 0, "-" if id_task is None else id_task+1)
+        worksheet.write(row, 1, "-" if epoch is None else epoch+1)
+        worksheet.write_row(row, 2, [path, seconds, calls])
+        row += 1
+
+    row += 1
+    for path, (seconds, calls) in sorted(timer.paths().items()):
+        worksheet.write_row(row, 0, ["Total", "", path, seconds, calls])
+        row += 1
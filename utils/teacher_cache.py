@@ -0,0 +1,65 @@
+import os
+import hashlib
+import torch
+
+from utils.utils import state_dict_hash, dataset_hash
+from utils.timers import timer
+
+PATH_TEACHER_CACHE = "./models/models_saved/Teacher_cache"
+
+# Logits already computed in this run: {key: tensor}
+_teacher_logits = {}
+
+
+@timer.timed("teacher")
+def teacher_logits(teacher, dataset, name, device, args):
+    """
+    Get the logits of a frozen teacher (old model or auxiliary network) for every sample of a dataset.
+
+    The teacher does not change during a task and the data is not augmented, so its logits are computed only
+    once, in dataset order, instead of every epoch. They are cached in memory and saved to disk with the hashes of
+    the teacher and of the images and labels of the dataset as key, so the methods that start from the same checkpoint (e.g. the LwF variants) and the next runs share them.
+
+    :param teacher: frozen model
+    :param dataset: TensorDataset with the images and labels
+    :param name: name of the dataset (e.g. "task2-train"), used in the messages
+    :param device: device of the teacher
+    :param args: arguments from the command line (teacher_cache: "float32" or "float16")
+    :return: tensor (num_samples, num_classes) with the logits, stored on the cpu
+    """
+    dtype = torch.float16 if args.teacher_cache == "float16" else torch.float32
+    key = hashlib.sha1("-".join([state_dict_hash(teacher), dataset_hash(dataset), args.teacher_cache]).encode()).hexdigest()
+
+    if key in _teacher_logits:
+        return _teacher_logits[key]
+
+    path_file = f"{PATH_TEACHER_CACHE}/Teacher-{args.dataset}-{key}.pt"
+
+    if os.path.exists(path_file):
+        logits = torch.load(path_file)
+    else:
+        print(f"Computing the teacher logits of {name} ({len(dataset)} samples)...")
+        loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=args.batch_size, shuffle=False)
+
+        teacher.eval()
+        logits = []
+        # Iterating the loader draws a seed from the global generator: keep it untouched, so the training does
+        # not depend on whether the logits were already cached
+        devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+        with torch.no_grad(), torch.random.fork_rng(devices=devices):
+            for input, _ in loader:
+                logits.append(teacher(input.to(device)).to("cpu", dtype))
+        logits = torch.cat(logits, dim=0)
+
+        os.makedirs(PATH_TEACHER_CACHE, exist_ok=True)
+        torch.save(logits, path_file)
+
+    _teacher_logits[key] = logits
+    return logits
+
+
+def with_teacher_logits(dataset, *logits):
+    """
+    Add the cached logits of the teachers to a TensorDataset, so the batches are (images, labels, *logits).
+    """
+    return torch.utils.data.TensorDataset(*dataset.tensors, *logits)
@@ -0,0 +1,136 @@
+import time
+import functools
+import threading
+import contextlib
+
+import torch
+
+
+class PhaseTimer(object):
+    """
+    Hierarchical timer of the phases of a method (training, data loading, validation, tests, Fisher, teacher
+    forwards, herding, checkpoints, Excel files...).
+
+    The phases are context managers (phase) or decorators (timed), and nest: a phase started inside another one is
+    recorded under its path ("train/data"). The times are accumulated for each task and epoch of the method (task,
+    epoch), and the phases outside the epochs of a task (before the first epoch and after the last one) are
+    recorded with the epoch None.
+
+    When the timer is disabled, phase returns the same empty context and timed calls the function directly, so
+    the instrumented code runs as without the timer. When it is enabled, the end of each phase waits for the
+    kernels of the GPU (the time of a phase includes its GPU work). Only the main thread is timed (the tests of the
+    evaluator thread are not).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.totals = {} # {(task, epoch, path): [seconds, calls]}
+        self.stack = [] # Names of the phases that are running
+        self.id_task = None
+        self.id_epoch = None
+
+    def enable(self, enabled):
+        """
+        Enable or disable the timer, and clear the times (start of a method).
+        """
+        self.enabled = enabled
+        self.reset()
+
+    def task(self, id_task):
+        """
+        :param id_task: task being trained (from 0), the next phases are outside its epochs
+        """
+        self.id_task, self.id_epoch = id_task, None
+
+    def epoch(self, epoch):
+        """
+        :param epoch: epoch being trained (from 0), or None after the last epoch of the task
+        """
+        self.id_epoch = epoch
+
+    def phase(self, name):
+        """
+        :return: context manager that times the phase name
+        """
+        if not self.enabled or threading.current_thread() is not threading.main_thread():
+            return _no_phase
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        self.stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            total = self.totals.setdefault((self.id_task, self.id_epoch, "/".join(self.stack)), [0., 0])
+            total[0] += time.perf_counter() - start
+            total[1] += 1
+            self.stack.pop()
+
+    def timed(self, name):
+        """
+        :return: decorator that times each call of a function as the phase name
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def loader(self, iterable, name="data"):
+        """
+        :return: iterable with the same items, where getting each item is timed as the phase name (data loading)
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_items(iterable, name)
+
+    def _timed_items(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, _end)
+            if item is _end:
+                return
+            yield item
+
+    def paths(self):
+        """
+        :return: dict {path of a phase: [seconds, calls]} over all the tasks and epochs, in order of first call
+        """
+        paths = {}
+        for (_, _, path), (seconds, calls) in self.totals.items():
+            total = paths.setdefault(path, [0., 0])
+            total[0] += seconds
+            total[1] += calls
+        return paths
+
+    def summary(self):
+        """
+        Print the time of each phase over the method, with its self time (without the phases inside it).
+        """
+        paths = self.paths()
+        print("="*100)
+        print(f"{'Phase':<40}{'Calls':>10}{'Seconds':>12}{'Self':>12}")
+        for path in sorted(paths):
+            seconds, calls = paths[path]
+            children = sum(paths[other][0] for other in paths
+                           if other.startswith(path + "/") and "/" not in other[len(path) + 1:])
+            print(f"{'  ' * path.count('/') + path.split('/')[-1]:<40}{calls:>10}{seconds:>12.3f}"
+                  f"{seconds - children:>12.3f}")
+
+
+_no_phase = contextlib.nullcontext()
+_end = object() # End of the items of a timed loader
+
+# Timer of the phases of the methods (enabled by EvalScheduler with --time_phases)
+timer = PhaseTimer()
@@ -1,6 +1,9 @@
 import os
+import hashlib
 import torch
+from utils.timers import timer
 
+@timer.timed("checkpoint")
 def save_model(model, args, id_task_dataset, method="naive", joint_datasets=False):
     """
     This function saves the model in the path: "./models/models_saved/{args.dataset}/{method}_training/
@@ -26,4 +29,31 @@ def save_model(model, args, id_task_dataset, method="naive", joint_datasets=Fals
     if not joint_datasets:
         torch.save(model.state_dict(), f'{path}/{method}-aftertask{str(tasks_id)}.pt')
     else:
-        torch.save(model.state_dict(), f'{path}/{method}.pt')
\ No newline at end of file
+        torch.save(model.state_dict(), f'{path}/{method}.pt')
+
+def state_dict_hash(model):
+    """
+    Compute a hash of the weights and buffers of a model. It is used as the key of the results that only
+    depend on a checkpoint (e.g. the logits of a frozen teacher), so they can be shared between methods.
+
+    :param model: model to hash
+    :return: hexadecimal SHA-1 digest of the state dict
+    """
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+def dataset_hash(dataset):
+    """
+    Compute a hash of the tensors of a TensorDataset (images and labels).
+
+    :param dataset: TensorDataset to hash
+    :return: hexadecimal SHA-1 digest of the tensors
+    """
+    sha = hashlib.sha1()
+    for tensor in dataset.tensors:
+        sha.update(str(tuple(tensor.shape)).encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()